@@ -0,0 +1,580 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import logging
+import os
+import posixpath
+import shutil
+import tarfile
+import threading
+import time
+import zlib
+
+import yaml
+
+from docker_meta import __name__ as docker_meta_name
+from docker_meta.build_context import ContextStream
+from docker_meta.chunk_store import ChunkStore
+from docker_meta.compression import BlockWriter, CODECS
+from docker_meta.fanout import make_thread
+
+
+log = logging.getLogger(docker_meta_name)
+
+_CHUNK_SIZE = 1024 * 1024
+
+MANIFEST_EXTENSION = '.manifest.yaml'
+# directory of the volume archives, while they are written
+PARTIAL_EXTENSION = '.partial'
+# directory of the earlier volume archives, while they are replaced
+OLD_EXTENSION = '.old'
+SNAPSHOTS_EXTENSION = '.snapshots'
+# directory of the chunk store in the backup directory
+CHUNK_STORE_DIR = 'chunks'
+
+# the maximum size of a chunk of an incremental backup, and the share of
+# files, that start a new chunk
+CHUNK_SIZE = 4 * 1024 * 1024
+_CHUNK_FILES = 32
+
+
+class BackupLimits(object):
+    """
+    bounds the number of volumes backed up or restored concurrently, and the
+    bandwidth of all their streams together.
+
+    The bandwidth is given in bytes per second and is unlimited, if it is
+    ``None``.
+    """
+
+    def __init__(self, streams=4, bandwidth=None):
+        self._lock = threading.Lock()
+        self.configure(streams, bandwidth)
+
+    def configure(self, streams=None, bandwidth=None):
+        """
+        changes the limits for streams started afterwards.
+        """
+        with self._lock:
+            if streams is not None:
+                self.streams = max(streams, 1)
+            self.bandwidth = bandwidth
+            self._semaphore = threading.BoundedSemaphore(self.streams)
+            self._next = 0
+
+    @contextlib.contextmanager
+    def stream(self, name):
+        """
+        waits until a volume may be streamed from or to the file ``name``.
+        """
+        semaphore = self._semaphore
+        if not semaphore.acquire(False):
+            log.debug("Waiting for a free backup slot for {}".format(name))
+            semaphore.acquire()
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+    def throttle(self, size):
+        """
+        waits until ``size`` more bytes may be transferred.
+        """
+        if not self.bandwidth:
+            return
+        with self._lock:
+            now = time.time()
+            self._next = max(self._next, now) + size / float(self.bandwidth)
+            delay = self._next - now - 1.
+        # a second worth of data may be transferred without waiting
+        if delay > 0:
+            time.sleep(delay)
+
+
+default_backup_limits = BackupLimits()
+
+
+class _Throttled(object):
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        default_backup_limits.throttle(len(data))
+        return data
+
+
+def archive_prefix(source):
+    """
+    returns the directory, under which the archive endpoint of the docker
+    daemon stores the members of ``source``, relative to the root directory.
+
+    The daemon names the members after the last component of ``source``,
+    whereas ``tar`` in the root directory of a container stores the whole
+    path without the leading slash.
+    """
+    source = posixpath.normpath(posixpath.join('/', source))
+    return posixpath.dirname(source).lstrip('/')
+
+
+def _volume_members(dc, container, source):
+    """
+    generates the members of the volume ``source`` of ``container`` with
+    file objects for their content, named like by ``tar`` in the root
+    directory of the container.
+    """
+    prefix = archive_prefix(source)
+    raw, _ = dc.get_archive(container, source)
+    with tarfile.open(fileobj=_Throttled(raw), mode='r|') as volume:
+        for member in volume:
+            fh = volume.extractfile(member) if member.isreg() else None
+            member.name = posixpath.join(prefix, member.name)
+            if member.islnk():
+                member.linkname = posixpath.join(prefix, member.linkname)
+            yield member, fh
+
+
+def copy_volume(dc, container, source, tar):
+    """
+    streams the files below ``source`` in ``container`` from the archive
+    endpoint of the docker daemon into the open tar archive ``tar``.
+
+    Returns the number of members and bytes copied.
+    """
+    members = 0
+    size = 0
+    for member, fh in _volume_members(dc, container, source):
+        tar.addfile(member, fh)
+        members += 1
+        size += member.size
+    return members, size
+
+
+def write_backup(dc, container, sources, filename, codec):
+    """
+    writes the volumes ``sources`` of ``container`` as a tar archive
+    compressed with ``codec`` to ``filename`` in a single pass.
+
+    The archive is written to a temporary file first, so that a failed backup
+    does not leave a truncated archive behind.
+    """
+    tmpname = filename + '.tmp'
+    members = 0
+    size = 0
+    try:
+        with default_backup_limits.stream(filename), \
+                open(tmpname, 'wb') as fh:
+            writer = codec.writer(fh)
+            try:
+                with tarfile.open(
+                        fileobj=writer, mode='w|',
+                        format=tarfile.GNU_FORMAT) as tar:
+                    for source in sources:
+                        m, s = copy_volume(dc, container, source, tar)
+                        members += m
+                        size += s
+            except Exception:
+                writer.abort()
+                raise
+            writer.close()
+    except Exception:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+    os.rename(tmpname, filename)
+    log.info(
+        "Wrote {} files ({:.1f} MB) of container {} to {} with {} level {} "
+        "in {} blocks".format(
+            members, size / 1024. ** 2, container, filename, codec.name,
+            codec.level, writer.blocks))
+    return members, size
+
+
+def backup_files(directory, name):
+    """
+    returns the existing files of the backup ``name`` in ``directory``, as a
+    single archive or as archives of its volumes with a manifest.
+    """
+    filename = os.path.join(directory, '{}.tar'.format(name))
+    res = [filename] + [
+        filename + codec.extension for _, codec in sorted(CODECS.items())]
+    res.append(os.path.join(directory, name + MANIFEST_EXTENSION))
+    volumes = os.path.join(directory, name)
+    if os.path.isdir(volumes):
+        res.extend(
+            os.path.join(volumes, f) for f in sorted(os.listdir(volumes))
+            if '.tar' in f)
+    return [f for f in res if os.path.exists(f)]
+
+
+def find_archive(directory, name):
+    """
+    returns the file name of the backup ``name`` in ``directory`` and the
+    codec it is compressed with, or ``None`` for an uncompressed archive.
+    """
+    filename = os.path.join(directory, '{}.tar'.format(name))
+    candidates = [
+        (filename + codec.extension, codec)
+        for _, codec in sorted(CODECS.items())] + [(filename, None)]
+    for archive, codec in candidates:
+        if os.path.exists(archive):
+            return archive, codec and codec()
+    raise RuntimeError(
+        "Restore failed: None of the archives {} exists in directory {}"
+        .format(
+            ', '.join(os.path.basename(a) for a, _ in candidates),
+            directory))
+
+
+def read_backup(dc, container, filename, codec):
+    """
+    uploads the archive ``filename`` compressed with ``codec`` into the root
+    directory of ``container`` through the archive endpoint of the docker
+    daemon.
+
+    The archive is decompressed while it is uploaded, so that it is read
+    once and no uncompressed copy is written.
+    """
+    with default_backup_limits.stream(filename), open(filename, 'rb') as fh:
+        reader = _Throttled(fh if codec is None else codec.reader(fh))
+        stream = ContextStream(iter(lambda: reader.read(_CHUNK_SIZE), ''))
+        if not dc.put_archive(container, '/', stream):
+            raise RuntimeError(
+                "Restore failed: The docker daemon did not accept the "
+                "archive {} for container {}".format(filename, container))
+    log.info("Restored {} into container {}".format(filename, container))
+
+
+def volume_archives(sources, name, codec):
+    """
+    returns the archive names of the volumes ``sources`` in the directory
+    ``name`` relative to the backup directory.
+    """
+    res = []
+    for source in sources:
+        base = slug = posixpath.normpath(
+            posixpath.join('/', source)).strip('/').replace('/', '_') or 'root'
+        i = 1
+        while any(a.startswith('{}/{}.'.format(name, slug)) for a in res):
+            i += 1
+            slug = '{}_{}'.format(base, i)
+        res.append('{}/{}.tar{}'.format(name, slug, codec.extension))
+    return res
+
+
+def _run_threads(target, items, name):
+    """
+    calls ``target`` for every item in a separate thread, and re-raises the
+    first error after all threads returned.
+    """
+    results = [None] * len(items)
+    errors = []
+
+    def _run(i):
+        try:
+            results[i] = target(items[i])
+        except Exception as e:
+            log.error("{} of {} failed: {}".format(name, items[i], e))
+            errors.append(e)
+
+    threads = [
+        make_thread(_run, '{} {}'.format(name, i), (i,))
+        for i in range(len(items))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+def write_volume_backups(dc, container, sources, directory, name, codec):
+    """
+    writes every volume in ``sources`` of ``container`` to its own archive
+    in the directory ``name`` below ``directory``, concurrently within the
+    :data:`default_backup_limits`.
+
+    The archives are written to the directory ``<name>.partial`` first.
+    Only after all of them are complete, the manifest mapping the volumes to
+    their archives is written to a temporary file.  Then the earlier
+    archives are moved aside, the new archives and manifest are moved into
+    place, and the earlier archives are removed last.  So a failed backup
+    leaves an earlier one intact, and an interrupted swap is completed or
+    rolled back by :func:`find_manifest`.  Returns the paths of the written
+    files.
+    """
+    _finish_swap(directory, name)
+    archives = volume_archives(sources, name, codec)
+    target = os.path.join(directory, name)
+    partial = target + PARTIAL_EXTENSION
+    old = target + OLD_EXTENSION
+    # a crashed backup may have left its archives behind
+    if os.path.exists(partial):
+        shutil.rmtree(partial)
+    os.makedirs(partial)
+
+    def _backup(item):
+        source, archive = item
+        return write_backup(
+            dc, container, [source],
+            os.path.join(partial, posixpath.basename(archive)), codec)
+
+    try:
+        results = _run_threads(
+            _backup, zip(sources, archives),
+            'backup of {}'.format(container))
+    except Exception:
+        shutil.rmtree(partial)
+        raise
+    manifest = {
+        'container': container,
+        'codec': codec.name,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'volumes': [
+            {'source': source, 'archive': archive, 'files': members,
+             'size': size}
+            for source, archive, (members, size)
+            in zip(sources, archives, results)],
+    }
+    filename = os.path.join(directory, name + MANIFEST_EXTENSION)
+    with open(filename + '.tmp', 'w') as fh:
+        yaml.safe_dump(manifest, fh, default_flow_style=False)
+    if os.path.isdir(target):
+        os.rename(target, old)
+    os.rename(partial, target)
+    os.rename(filename + '.tmp', filename)
+    if os.path.isdir(old):
+        shutil.rmtree(old)
+    return [filename] + [os.path.join(directory, a) for a in archives]
+
+
+def _finish_swap(directory, name):
+    """
+    completes or rolls back the swap of a per-volume backup ``name`` in
+    ``directory``, that was interrupted by :func:`write_volume_backups`.
+    """
+    target = os.path.join(directory, name)
+    old = target + OLD_EXTENSION
+    tmp = os.path.join(directory, name + MANIFEST_EXTENSION + '.tmp')
+    if os.path.exists(tmp):
+        if os.path.isdir(target + PARTIAL_EXTENSION):
+            # the new archives were not moved into place
+            os.remove(tmp)
+        elif os.path.isdir(target):
+            log.warn("Completing the interrupted backup {}".format(target))
+            os.rename(tmp, tmp[:-len('.tmp')])
+    if os.path.isdir(old):
+        if os.path.isdir(target):
+            shutil.rmtree(old)
+        else:
+            log.warn("Restoring the earlier backup {}".format(target))
+            os.rename(old, target)
+
+
+def find_manifest(directory, name):
+    """
+    returns the manifest of the per-volume backup ``name`` in ``directory``,
+    or None.
+    """
+    _finish_swap(directory, name)
+    filename = os.path.join(directory, name + MANIFEST_EXTENSION)
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'r') as fh:
+        return yaml.safe_load(fh)
+
+
+def read_volume_backups(dc, container, directory, manifest):
+    """
+    restores the volume archives of the ``manifest`` in ``directory`` into
+    ``container`` concurrently within the :data:`default_backup_limits`.
+    """
+    if manifest['codec'] not in CODECS:
+        raise RuntimeError(
+            "Restore failed: Unknown compression codec {} in the manifest"
+            .format(manifest['codec']))
+    codec = CODECS[manifest['codec']]()
+    archives = [os.path.join(directory, v['archive'])
+                for v in manifest['volumes']]
+    missing = [a for a in archives if not os.path.exists(a)]
+    if missing:
+        raise RuntimeError(
+            "Restore failed: The archives {} of the manifest are missing"
+            .format(', '.join(missing)))
+    _run_threads(
+        lambda archive: read_backup(dc, container, archive, codec),
+        archives, 'restore of {}'.format(container))
+
+
+class _ChunkIndex(object):
+
+    def __init__(self):
+        self.digests = []
+
+    def write(self, digest):
+        self.digests.append(digest)
+
+
+def _starts_chunk(member, previous):
+    """
+    decides, whether a new chunk starts with ``member``.
+
+    Large files start their own chunks, such that their chunks do not change
+    with the files around them.  Small files are packed into chunks, which
+    end before files, whose names have a certain hash, so that an added or
+    removed file only changes the chunk it is in.
+    """
+    large = CHUNK_SIZE // 4
+    return (
+        member.size >= large or
+        previous is not None and previous.size >= large or
+        zlib.crc32(member.name) % _CHUNK_FILES == 0)
+
+
+def write_chunks(dc, container, source, store):
+    """
+    writes the tar stream of the volume ``source`` of ``container`` into the
+    chunk ``store``.  The chunks are hashed, compressed and stored by the
+    threads of the codec of the store.
+
+    Returns the hashes of the chunks, and the number of members and bytes of
+    the volume.
+    """
+    index = _ChunkIndex()
+    members = 0
+    size = 0
+    with default_backup_limits.stream(source):
+        writer = BlockWriter(
+            index, store.put, store.codec.threads, CHUNK_SIZE)
+        try:
+            previous = None
+            for member, fh in _volume_members(dc, container, source):
+                if _starts_chunk(member, previous):
+                    writer.cut()
+                writer.write(member.tobuf(tarfile.GNU_FORMAT))
+                if fh is not None:
+                    for chunk in iter(lambda: fh.read(_CHUNK_SIZE), ''):
+                        writer.write(chunk)
+                    if member.size % tarfile.BLOCKSIZE:
+                        writer.write('\0' * (
+                            tarfile.BLOCKSIZE -
+                            member.size % tarfile.BLOCKSIZE))
+                previous = member
+                members += 1
+                size += member.size
+            writer.write('\0' * (2 * tarfile.BLOCKSIZE))
+        except Exception:
+            writer.abort()
+            raise
+        writer.close()
+    return index.digests, members, size
+
+
+def list_snapshots(directory, name):
+    """
+    returns the ids of the snapshots of the incremental backup ``name`` in
+    ``directory`` from the oldest to the newest one.
+    """
+    snapshots = os.path.join(directory, name + SNAPSHOTS_EXTENSION)
+    if not os.path.isdir(snapshots):
+        return []
+    return sorted(
+        f[:-len('.yaml')] for f in os.listdir(snapshots)
+        if f.endswith('.yaml'))
+
+
+def write_snapshot(dc, container, sources, directory, name, codec):
+    """
+    stores the volumes ``sources`` of ``container`` in the chunk store of
+    ``directory`` and writes the snapshot index
+    ``<name>.snapshots/<id>.yaml`` with the hashes of their chunks.
+
+    Only chunks, that the chunk store does not have yet, are written.  The
+    volumes are processed concurrently.  Returns the file name of the
+    snapshot.
+    """
+    store = ChunkStore(os.path.join(directory, CHUNK_STORE_DIR), codec)
+    results = _run_threads(
+        lambda source: write_chunks(dc, container, source, store), sources,
+        'incremental backup of {}'.format(container))
+    snapshots = os.path.join(directory, name + SNAPSHOTS_EXTENSION)
+    if not os.path.exists(snapshots):
+        os.makedirs(snapshots)
+    snapshot_id = base = time.strftime('%Y%m%dT%H%M%S')
+    i = 1
+    while os.path.exists(os.path.join(snapshots, snapshot_id + '.yaml')):
+        i += 1
+        snapshot_id = '{}-{}'.format(base, i)
+    snapshot = {
+        'container': container,
+        'codec': codec.name,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'volumes': [
+            {'source': source, 'files': members, 'size': size,
+             'chunks': digests}
+            for source, (digests, members, size) in zip(sources, results)],
+    }
+    filename = os.path.join(snapshots, snapshot_id + '.yaml')
+    with open(filename + '.tmp', 'w') as fh:
+        yaml.safe_dump(snapshot, fh, default_flow_style=False)
+    os.rename(filename + '.tmp', filename)
+    log.info(
+        "Wrote snapshot {} of container {} with {} chunks, {} of them new "
+        "({:.1f} MB)".format(
+            snapshot_id, container, store.chunks, store.new_chunks,
+            store.new_size / 1024. ** 2))
+    return filename
+
+
+def find_snapshot(directory, name, snapshot=None):
+    """
+    returns the file name of the snapshot ``snapshot`` (default: the newest
+    one) of the incremental backup ``name`` in ``directory``, or None, if the
+    backup has no snapshots.
+    """
+    snapshots = list_snapshots(directory, name)
+    if snapshot is None:
+        if not snapshots:
+            return None
+        snapshot = snapshots[-1]
+    elif snapshot not in snapshots:
+        raise RuntimeError(
+            "Restore failed: The snapshot {} of {} does not exist.  Choose "
+            "one of {}".format(
+                snapshot, name, ', '.join(snapshots) or 'none'))
+    return os.path.join(
+        directory, name + SNAPSHOTS_EXTENSION, snapshot + '.yaml')
+
+
+def read_snapshot(dc, container, directory, filename):
+    """
+    restores the volumes of the snapshot ``filename`` into ``container`` by
+    uploading their chunks from the chunk store of ``directory`` in order.
+    The volumes are restored concurrently.
+    """
+    with open(filename, 'r') as fh:
+        snapshot = yaml.safe_load(fh)
+    store = ChunkStore(os.path.join(directory, CHUNK_STORE_DIR), None)
+
+    def _chunks(digests):
+        for digest in digests:
+            data = store.get(digest)
+            default_backup_limits.throttle(len(data))
+            yield data
+
+    def _restore(volume):
+        with default_backup_limits.stream(volume['source']):
+            if not dc.put_archive(
+                    container, '/', ContextStream(_chunks(volume['chunks']))):
+                raise RuntimeError(
+                    "Restore failed: The docker daemon did not accept the "
+                    "volume {} of the snapshot {}".format(
+                        volume['source'], filename))
+
+    _run_threads(
+        _restore, snapshot['volumes'], 'restore of {}'.format(container))
+    log.info("Restored {} into container {}".format(filename, container))
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import os
+import stat
+import tarfile
+import threading
+import time
+
+from docker.utils import exclude_paths
+
+from docker_meta import __name__ as docker_meta_name
+
+
+log = logging.getLogger(docker_meta_name)
+
+
+REMOTE_PREFIXES = ('http://', 'https://', 'git://', 'github.com/', 'git@')
+
+
+def is_remote(path):
+    return path.startswith(REMOTE_PREFIXES)
+
+
+def resolve_context(global_config, build):
+    """
+    returns the local build context of the ``build`` configuration.  Relative
+    paths are resolved against the configuration directory, and only against
+    the current directory, if they do not exist there.
+    """
+    path = build.get('path')
+    if not path or is_remote(path):
+        return None
+    return (global_config and global_config.get_abspath(path) or
+            os.path.abspath(path))
+
+
+def read_dockerignore(path):
+    dockerignore = os.path.join(path, '.dockerignore')
+    if os.path.exists(dockerignore):
+        with open(dockerignore, 'r') as fh:
+            return list(filter(bool, fh.read().splitlines()))
+    return []
+
+
+def context_files(path, dockerfile=None):
+    """
+    returns the sorted relative paths of the build context in ``path``, that
+    are not excluded by its ``.dockerignore`` file.
+    """
+    root = os.path.abspath(path)
+    return sorted(
+        exclude_paths(root, read_dockerignore(root), dockerfile=dockerfile))
+
+
+def _file_digest(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as fh:
+        for block in iter(lambda: fh.read(65536), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class DigestCache(object):
+    """
+    caches the digests of the files in build contexts, so that only files,
+    whose size, modification time or inode changed, are read again.
+
+    The cache is stored as JSON in the file ``filename``.  Files modified
+    less than ``racy_seconds`` before their digest was computed are not
+    cached, because a later change within the resolution of the modification
+    time would go unnoticed.
+    """
+
+    racy_seconds = 2
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._entries = None
+        self._dirty = False
+
+    def _load(self):
+        if self._entries is None:
+            self._entries = {}
+            if self.filename and os.path.exists(self.filename):
+                try:
+                    with open(self.filename, 'r') as fh:
+                        self._entries = json.load(fh)
+                except (IOError, ValueError) as e:
+                    log.debug(
+                        "Ignoring the invalid digest cache {}: {}"
+                        .format(self.filename, e))
+        return self._entries
+
+    def digest(self, filename, st):
+        """
+        returns the digest of the content of the file ``filename`` with the
+        stat result ``st``.
+        """
+        stamp = [st.st_size, st.st_mtime, st.st_ino]
+        with self._lock:
+            entry = self._load().get(filename)
+            if entry and entry[:3] == stamp:
+                return entry[3]
+        digest = _file_digest(filename)
+        if st.st_mtime < time.time() - self.racy_seconds:
+            with self._lock:
+                self._load()[filename] = stamp + [digest]
+                self._dirty = True
+        return digest
+
+    def forget(self, root, keep):
+        """
+        removes the entries of files below ``root``, that are not in
+        ``keep``.
+        """
+        prefix = os.path.join(root, '')
+        with self._lock:
+            entries = self._load()
+            for filename in entries.keys():
+                if filename.startswith(prefix) and filename not in keep:
+                    del entries[filename]
+                    self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not (self.filename and self._dirty):
+                return
+            tmpname = self.filename + '.tmp'
+            try:
+                with open(tmpname, 'w') as fh:
+                    json.dump(self._entries, fh)
+                os.rename(tmpname, self.filename)
+                self._dirty = False
+            except (IOError, OSError) as e:
+                log.debug(
+                    "Could not write the digest cache {}: {}"
+                    .format(self.filename, e))
+
+
+default_digest_cache = DigestCache()
+
+
+def context_digest(path, dockerfile=None, cache=None):
+    """
+    computes a digest over the names, modes and contents of all files in the
+    build context.
+
+    With a :class:`DigestCache` ``cache``, only the contents of changed files
+    are read.  A missing build context raises a ValueError, because its
+    digest would not depend on the context.
+    """
+    root = os.path.abspath(path)
+    if not os.path.isdir(root):
+        raise ValueError(
+            "The build context {} does not exist".format(root))
+    digest = hashlib.sha256()
+    seen = set([])
+    for name in context_files(root, dockerfile):
+        fullname = os.path.join(root, name)
+        st = os.lstat(fullname)
+        digest.update('{}\0{:o}\0'.format(name, st.st_mode))
+        if os.path.islink(fullname):
+            digest.update(os.readlink(fullname))
+        elif os.path.isfile(fullname):
+            if cache is None:
+                digest.update(_file_digest(fullname))
+            else:
+                digest.update(cache.digest(fullname, st))
+                seen.add(fullname)
+        digest.update('\0')
+    if cache is not None:
+        cache.forget(root, seen)
+        cache.save()
+    return digest.hexdigest()
+
+
+_BLOCKSIZE = tarfile.BLOCKSIZE
+_CHUNKSIZE = 65536
+
+
+def _linkname(fullname, st):
+    if stat.S_ISLNK(st.st_mode):
+        return os.readlink(fullname)
+    return ''
+
+
+def _tar_header(arcname, st, linkname=''):
+    info = tarfile.TarInfo(arcname)
+    info.mode = stat.S_IMODE(st.st_mode)
+    info.uid, info.gid = st.st_uid, st.st_gid
+    info.mtime = int(st.st_mtime)
+    if stat.S_ISLNK(st.st_mode):
+        info.type = tarfile.SYMTYPE
+        info.linkname = linkname
+    elif stat.S_ISDIR(st.st_mode):
+        info.type = tarfile.DIRTYPE
+    else:
+        info.size = st.st_size
+    return info.tobuf()
+
+
+def _padding(size):
+    return '\0' * ((_BLOCKSIZE - size % _BLOCKSIZE) % _BLOCKSIZE)
+
+
+def _stream_file(fullname, size):
+    remaining = size
+    with open(fullname, 'rb') as fh:
+        while remaining > 0:
+            block = fh.read(min(_CHUNKSIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+    if remaining:
+        raise RuntimeError(
+            "The file {} changed while sending the build context."
+            .format(fullname))
+    yield _padding(size)
+
+
+class ContextStream(object):
+    """
+    a tar archive of a build context, that is generated while it is read.
+
+    The archive can be iterated over in chunks, e.g. by requests for a
+    chunked upload, or read like a file.  Only one file of the context is
+    held in memory at a time.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = ''
+
+    def __iter__(self):
+        if self._buffer:
+            buf, self._buffer = self._buffer, ''
+            yield buf
+        for chunk in self._chunks:
+            if chunk:
+                yield chunk
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return ''.join(self)
+        while len(self._buffer) < size:
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                break
+        res, self._buffer = self._buffer[:size], self._buffer[size:]
+        return res
+
+
+def stream_context(path, dockerfile=None, labels={}):
+    """
+    generates the chunks of a tar archive of the build context in ``path``,
+    whose Dockerfile has a ``LABEL`` instruction with ``labels`` appended.
+    """
+    root = os.path.abspath(path)
+    dockerfile = dockerfile or 'Dockerfile'
+    for name in context_files(root, dockerfile):
+        fullname = os.path.join(root, name)
+        st = os.lstat(fullname)
+        if name == dockerfile:
+            with open(fullname, 'rb') as fh:
+                content = label_dockerfile(fh.read(), labels)
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mode = 0o644
+            info.mtime = int(st.st_mtime)
+            yield info.tobuf() + content + _padding(len(content))
+            continue
+        yield _tar_header(name, st, _linkname(fullname, st))
+        if stat.S_ISREG(st.st_mode):
+            for block in _stream_file(fullname, st.st_size):
+                yield block
+    # end of archive
+    yield '\0' * (2 * _BLOCKSIZE)
+
+
+def labelled_context(path, dockerfile=None, labels={}):
+    """
+    returns a :class:`ContextStream` of the build context in ``path``, whose
+    Dockerfile has a ``LABEL`` instruction with ``labels`` appended.
+    """
+    return ContextStream(stream_context(path, dockerfile, labels))
+
+
+def label_dockerfile(content, labels):
+    """
+    appends a ``LABEL`` instruction to the content of a Dockerfile.
+    """
+    if not labels:
+        return content
+    instruction = 'LABEL {}'.format(' '.join(
+        '"{}"="{}"'.format(k, v) for k, v in sorted(labels.items())))
+    return '{}\n{}\n'.format(content.rstrip('\n'), instruction)
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import io
+import json
+import logging
+import os
+import posixpath
+import tarfile
+import time
+
+import yaml
+
+from docker_meta import __name__ as docker_meta_name
+from docker_meta.build_context import ContextStream
+
+
+log = logging.getLogger(docker_meta_name)
+
+BUNDLE_FILE = 'bundle.yaml'
+PLAN_FILE = 'plan.yaml'
+# directory of the bundle with the output of ``docker save``
+IMAGES_DIR = 'images'
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+def chain_ids(diff_ids):
+    """
+    returns the chain ids of the layers with the ``diff_ids``, which
+    identify a layer together with all layers below it.
+    """
+    res = []
+    for diff_id in diff_ids:
+        if res:
+            diff_id = 'sha256:' + hashlib.sha256(
+                '{} {}'.format(res[-1], diff_id)).hexdigest()
+        res.append(diff_id)
+    return res
+
+
+def local_chain_ids(dc):
+    """
+    returns the chain ids of all layers, that the docker daemon has.
+    """
+    res = set([])
+    for image in dc.images():
+        info = dc.inspect_image(image['Id'])
+        res.update(chain_ids((info.get('RootFS') or {}).get('Layers') or []))
+    return res
+
+
+def export_images(dc, images):
+    """
+    returns a stream of ``docker save`` for all ``images``, in which the
+    layers shared by several images are only stored once.
+    """
+    res = dc._get(
+        dc._url('/images/get'), params={'names': images}, stream=True)
+    dc._raise_for_status(res)
+    return res.raw
+
+
+def import_images(dc, data):
+    """
+    sends the archive ``data`` of ``docker save`` to the docker daemon.  The
+    daemon reports failures in the streamed response, which are raised as a
+    RuntimeError.
+    """
+    res = dc._post(
+        dc._url('/images/load'), params={'quiet': 0}, data=data, stream=True)
+    dc._raise_for_status(res)
+    error = None
+    for line in res.iter_lines():
+        if not line:
+            continue
+        log.debug(line)
+        try:
+            message = json.loads(line)
+        except ValueError:
+            continue
+        error = (
+            message.get('error') or
+            (message.get('errorDetail') or {}).get('message') or error)
+    if error:
+        raise RuntimeError("Could not load the images: {}".format(error))
+
+
+def _add_yaml(tar, name, content):
+    data = yaml.safe_dump(content, default_flow_style=False)
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = time.time()
+    tar.addfile(info, io.BytesIO(data))
+
+
+def write_bundle(filename, plan, images, stream):
+    """
+    writes the bundle ``filename`` with the ``plan`` of a unit command and
+    the ``docker save`` ``stream`` of its ``images``.
+    """
+    layers = []
+    size = 0
+    tmpname = filename + '.tmp'
+    with tarfile.open(tmpname, 'w', format=tarfile.GNU_FORMAT) as tar:
+        _add_yaml(tar, PLAN_FILE, plan)
+        with tarfile.open(fileobj=stream, mode='r|') as saved:
+            for member in saved:
+                fh = saved.extractfile(member) if member.isreg() else None
+                if posixpath.basename(member.name) == 'layer.tar':
+                    layers.append(member.name)
+                    size += member.size
+                member.name = posixpath.join(IMAGES_DIR, member.name)
+                tar.addfile(member, fh)
+        _add_yaml(tar, BUNDLE_FILE, {
+            'unitcommand': plan['unitcommand'],
+            'images': sorted(images),
+            'layers': len(layers),
+            'size': size,
+        })
+    os.rename(tmpname, filename)
+    log.info(
+        "Wrote {} images with {} layers ({:.1f} MB) to {}".format(
+            len(images), len(layers), size / 1024. ** 2, filename))
+
+
+def _read_json(tar, name):
+    return json.load(tar.extractfile(posixpath.join(IMAGES_DIR, name)))
+
+
+def _resolve(tar, member):
+    while member.issym():
+        name = posixpath.normpath(posixpath.join(
+            posixpath.dirname(member.name), member.linkname))
+        member = tar.getmember(name)
+    return member
+
+
+def _needed_layers(tar, known):
+    """
+    returns the names of the layer files of the bundle, whose layers are not
+    in the chain ids ``known`` by the docker daemon.
+    """
+    needed = set([])
+    for image in _read_json(tar, 'manifest.json'):
+        config = _read_json(tar, image['Config'])
+        chains = chain_ids(config['rootfs']['diff_ids'])
+        for layer, chain in zip(image['Layers'], chains):
+            if chain not in known:
+                member = tar.getmember(posixpath.join(IMAGES_DIR, layer))
+                needed.add(member.name)
+                needed.add(_resolve(tar, member).name)
+    return needed
+
+
+def _stream_members(tar, members):
+    """
+    generates the chunks of a tar archive with the ``members`` of ``tar``,
+    whose names are relative to the images directory.
+    """
+    prefix = IMAGES_DIR + '/'
+    for member in members:
+        fh = tar.extractfile(member) if member.isreg() else None
+        info = tarfile.TarInfo(member.name[len(prefix):])
+        for attr in ['size', 'mtime', 'mode', 'type', 'linkname', 'uid',
+                     'gid', 'uname', 'gname']:
+            setattr(info, attr, getattr(member, attr))
+        yield info.tobuf(tarfile.GNU_FORMAT)
+        if fh is not None:
+            for chunk in iter(lambda: fh.read(_CHUNK_SIZE), ''):
+                yield chunk
+            if info.size % tarfile.BLOCKSIZE:
+                yield '\0' * (
+                    tarfile.BLOCKSIZE - info.size % tarfile.BLOCKSIZE)
+    yield '\0' * (2 * tarfile.BLOCKSIZE)
+
+
+def load_bundle(dc, filename):
+    """
+    imports the images of the bundle ``filename`` into the docker daemon.
+
+    Only the layers, that the daemon does not have yet, are sent, because
+    ``docker load`` does not read the files of existing layers.  Returns the
+    plan of the unit command stored in the bundle.
+    """
+    with tarfile.open(filename, 'r:') as tar:
+        bundle = yaml.safe_load(tar.extractfile(BUNDLE_FILE))
+        plan = yaml.safe_load(tar.extractfile(PLAN_FILE))
+        needed = _needed_layers(tar, local_chain_ids(dc))
+        members = []
+        skipped = 0
+        for member in tar.getmembers():
+            if not member.name.startswith(IMAGES_DIR + '/'):
+                continue
+            if (posixpath.basename(member.name) == 'layer.tar' and
+                    member.name not in needed):
+                skipped += 1
+                continue
+            members.append(member)
+        log.info(
+            "Loading {} images of {} with {} of {} layers".format(
+                len(bundle['images']), bundle['unitcommand'],
+                bundle['layers'] - skipped, bundle['layers']))
+        import_images(dc, ContextStream(_stream_members(tar, members)))
+    return plan
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import logging
+import os
+import threading
+
+from docker_meta import __name__ as docker_meta_name
+from docker_meta.compression import CODECS
+
+
+log = logging.getLogger(docker_meta_name)
+
+
+class ChunkStore(object):
+    """
+    stores compressed chunks of backups in ``directory`` under the sha256
+    hash of their uncompressed content, such that every chunk is stored only
+    once.
+
+    A chunk is written as ``<hash[:2]>/<hash><extension of the codec>``.
+    Chunks stored with another codec are reused as they are.
+    """
+
+    def __init__(self, directory, codec):
+        self.directory = directory
+        self.codec = codec
+        self.chunks = 0
+        self.new_chunks = 0
+        self.new_size = 0
+        self._lock = threading.Lock()
+
+    def _find(self, digest):
+        base = os.path.join(self.directory, digest[:2], digest)
+        for _, codec in sorted(CODECS.items()):
+            if os.path.exists(base + codec.extension):
+                return base + codec.extension, codec
+        return None, None
+
+    def put(self, data):
+        """
+        stores ``data`` unless the store has it already, and returns its
+        hash.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        filename, _ = self._find(digest)
+        if filename is None:
+            filename = os.path.join(
+                self.directory, digest[:2], digest + self.codec.extension)
+            compressed = self.codec.compress(data)
+            tmpname = '{}.{}.tmp'.format(
+                filename, threading.current_thread().ident)
+            try:
+                os.makedirs(os.path.dirname(filename))
+            except OSError:
+                # another backup created the directory concurrently
+                if not os.path.isdir(os.path.dirname(filename)):
+                    raise
+            with open(tmpname, 'wb') as fh:
+                fh.write(compressed)
+            os.rename(tmpname, filename)
+            with self._lock:
+                self.new_chunks += 1
+                self.new_size += len(compressed)
+        with self._lock:
+            self.chunks += 1
+        return digest
+
+    def get(self, digest):
+        """
+        returns the content of the chunk with the hash ``digest``.
+        """
+        filename, codec = self._find(digest)
+        if filename is None:
+            raise RuntimeError(
+                "The chunk {} is missing in the chunk store {}".format(
+                    digest, self.directory))
+        with open(filename, 'rb') as fh:
+            data = codec().decompress(fh.read())
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise RuntimeError(
+                "The chunk {} in the chunk store {} is corrupted".format(
+                    digest, self.directory))
+        return data
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
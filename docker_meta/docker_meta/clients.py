@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import socket
+import threading
+import time
+
+import docker
+import yaml
+from docker.constants import DEFAULT_DOCKER_API_VERSION
+from docker.utils import kwargs_from_env, version_lt
+
+from docker_meta import __name__ as docker_meta_name
+
+
+log = logging.getLogger(docker_meta_name)
+
+
+def _tls_config(daemon):
+    """
+    returns the TLS configuration for ``tcp://`` and ``https://`` daemons
+    from the ``DOCKER_CERT_PATH`` and ``DOCKER_TLS_VERIFY`` environment
+    variables, or False.
+    """
+    if not daemon or not daemon.startswith(('tcp://', 'https://')):
+        return False
+    if not os.environ.get('DOCKER_CERT_PATH'):
+        return False
+    return kwargs_from_env(assert_hostname=False).get('tls', False)
+
+
+class ClientFactory(object):
+    """
+    creates one docker client per daemon and keeps it for the lifetime of the
+    process.
+
+    The clients keep their connections to the daemon alive, so that HTTP and
+    TLS connections are reused by all orders and hosts.  The API version of
+    every daemon is negotiated once and cached in the file
+    ``version_cache`` for ``max_age`` seconds.
+    """
+
+    max_age = 24 * 60 * 60
+    num_pools = 10
+
+    def __init__(self, version_cache=None):
+        self.version_cache = version_cache
+        self._lock = threading.Lock()
+        self._clients = {}
+
+    def get(self, daemon):
+        with self._lock:
+            if daemon not in self._clients:
+                self._clients[daemon] = self._create(daemon)
+            return self._clients[daemon]
+
+    def clear(self):
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients = {}
+
+    def _create(self, daemon):
+        tls = _tls_config(daemon)
+        version = self._cached_version(daemon)
+        client = docker.Client(
+            daemon, version=version or DEFAULT_DOCKER_API_VERSION, tls=tls,
+            num_pools=self.num_pools)
+        if version is None:
+            version = self._negotiate(client)
+            if version is not None:
+                client._version = version
+                self._store_version(daemon, version)
+        return client
+
+    def _negotiate(self, client):
+        """
+        returns the newest API version supported by the daemon and by
+        docker-py, or None if the daemon cannot be reached.
+        """
+        try:
+            server_version = client.version(api_version=False)['ApiVersion']
+        except Exception as e:
+            log.debug(
+                "Could not negotiate the API version with {}: {}"
+                .format(client.base_url, e))
+            return None
+        if version_lt(server_version, DEFAULT_DOCKER_API_VERSION):
+            return server_version
+        return DEFAULT_DOCKER_API_VERSION
+
+    def _read_cache(self):
+        if self.version_cache and os.path.exists(self.version_cache):
+            with open(self.version_cache, 'r') as fh:
+                return yaml.safe_load(fh) or {}
+        return {}
+
+    def _cached_version(self, daemon):
+        entry = self._read_cache().get(daemon)
+        if entry and time.time() - entry['timestamp'] < self.max_age:
+            return entry['version']
+        return None
+
+    def _store_version(self, daemon, version):
+        if not self.version_cache:
+            return
+        cache = self._read_cache()
+        cache[daemon] = {'version': version, 'timestamp': int(time.time())}
+        try:
+            with open(self.version_cache, 'w') as fh:
+                yaml.safe_dump(cache, fh, default_flow_style=False)
+        except IOError as e:
+            log.debug(
+                "Could not cache the API version in {}: {}"
+                .format(self.version_cache, e))
+
+
+default_factory = ClientFactory()
+
+
+def close_stream(dc, response):
+    """
+    closes the streamed ``response`` of the docker client ``dc``.  The socket
+    is shut down first, so that a thread blocked reading the stream returns.
+    """
+    try:
+        dc._get_raw_response_socket(response).shutdown(socket.SHUT_RDWR)
+    except Exception as e:
+        log.debug("Could not shut down the stream: {}".format(e))
+    response.close()
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+import collections
+import gzip
+import logging
+import multiprocessing
+import Queue
+import threading
+import zlib
+
+from docker_meta import __name__ as docker_meta_name
+
+try:
+    import zstandard
+    has_zstd = True
+except ImportError:
+    has_zstd = False
+
+
+log = logging.getLogger(docker_meta_name)
+
+
+class _Block(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class BlockWriter(object):
+    """
+    a write-only file object, that splits the data written to it into blocks
+    of ``block_size`` bytes, compresses them independently with ``compress``
+    in a pool of ``threads`` threads, and writes the compressed blocks to
+    ``fileobj`` in their original order.
+
+    At most two blocks per thread are held in memory, such that a slow
+    ``fileobj`` throttles the writer.
+    """
+
+    def __init__(self, fileobj, compress, threads, block_size):
+        self.fileobj = fileobj
+        self.compress = compress
+        self.block_size = block_size
+        self.blocks = 0
+        self._buffer = []
+        self._buffered = 0
+        self._pending = collections.deque()
+        self._max_pending = 2 * threads
+        self._tasks = Queue.Queue()
+        self._workers = []
+        for i in range(threads):
+            worker = threading.Thread(
+                target=self._work, name='compress {}'.format(i))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self):
+        while True:
+            block = self._tasks.get()
+            if block is None:
+                return
+            try:
+                block.result = self.compress(block.data)
+            except Exception as e:
+                block.error = e
+            block.data = None
+            block.done.set()
+
+    def _submit(self, data):
+        block = _Block(data)
+        self._pending.append(block)
+        self._tasks.put(block)
+        while len(self._pending) > self._max_pending:
+            self._write_next()
+
+    def _write_next(self):
+        block = self._pending.popleft()
+        block.done.wait()
+        if block.error is not None:
+            raise block.error
+        self.fileobj.write(block.result)
+        self.blocks += 1
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.block_size:
+            data = ''.join(self._buffer)
+            cut = len(data) - len(data) % self.block_size
+            for start in range(0, cut, self.block_size):
+                self._submit(data[start:start + self.block_size])
+            self._buffer = [data[cut:]]
+            self._buffered = len(data) - cut
+
+    def cut(self):
+        """
+        compresses the buffered data as a block, such that the next write
+        starts a new block.
+        """
+        if self._buffered:
+            self._submit(''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+    def _stop(self):
+        for worker in self._workers:
+            self._tasks.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def close(self):
+        """
+        compresses the remaining data and waits for all blocks to be
+        written.  An empty stream is written as one empty block.
+        """
+        try:
+            if self._buffered or not (self.blocks or self._pending):
+                self._submit(''.join(self._buffer))
+                self._buffer = []
+                self._buffered = 0
+            while self._pending:
+                self._write_next()
+        finally:
+            self._stop()
+
+    def abort(self):
+        """
+        stops the compression threads without writing pending blocks.
+        """
+        self._pending.clear()
+        self._stop()
+
+
+class GzipCodec(object):
+    """
+    compresses blocks into separate gzip members.  A concatenation of gzip
+    members is a valid gzip file, that ``gunzip`` and ``tar`` read.
+    """
+
+    name = 'gzip'
+    extension = '.gz'
+    levels = range(1, 10)
+    default_level = 6
+    block_size = 1024 * 1024
+
+    def __init__(self, level=None, threads=None):
+        self.level = level or self.default_level
+        self.threads = threads or multiprocessing.cpu_count()
+        if self.level not in self.levels:
+            raise ValueError(
+                "Invalid compression level {} for {}".format(
+                    self.level, self.name))
+
+    def compress(self, data):
+        # the window bits 16 + 15 select a gzip header and trailer
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+
+    def writer(self, fileobj):
+        return BlockWriter(
+            fileobj, self.compress, self.threads, self.block_size)
+
+    def decompress(self, data):
+        return zlib.decompress(data, 31)
+
+    def reader(self, fileobj):
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+
+
+class ZstdCodec(GzipCodec):
+    """
+    compresses blocks into separate zstd frames with the ``zstandard``
+    package.
+    """
+
+    name = 'zstd'
+    extension = '.zst'
+    levels = range(1, 23)
+    default_level = 3
+    block_size = 4 * 1024 * 1024
+
+    def __init__(self, level=None, threads=None):
+        if not has_zstd:
+            raise ValueError(
+                "The compression codec zstd requires the python package "
+                "zstandard")
+        super(ZstdCodec, self).__init__(level, threads)
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def decompress(self, data):
+        return zstandard.ZstdDecompressor().decompress(data)
+
+    def reader(self, fileobj):
+        return zstandard.ZstdDecompressor().stream_reader(
+            fileobj, read_across_frames=True)
+
+
+CODECS = {
+    GzipCodec.name: GzipCodec,
+    ZstdCodec.name: ZstdCodec,
+}
+
+
+def get_codec(compression=None):
+    """
+    returns the codec for the ``compression`` of an order, which is either
+    the name of a codec or a mapping with the keys ``codec``, ``level`` and
+    ``threads``.  The default is gzip.
+    """
+    if not isinstance(compression, dict):
+        compression = {'codec': compression}
+    name = compression.get('codec') or GzipCodec.name
+    if name not in CODECS:
+        raise ValueError(
+            "Unknown compression codec {}.  Choose one of {}".format(
+                name, ', '.join(sorted(CODECS))))
+    return CODECS[name](compression.get('level'), compression.get('threads'))
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
@@ -14,6 +14,7 @@ from pkg_resources import get_provider, resource_stream
 
 from docker_meta import (
     __name__ as docker_meta_name, __version__ as docker_meta_version)
+from docker_meta.services import base_images, build_waves, normalize_image
 from docker_meta.utils import deepupdate
 
 
@@ -96,6 +97,12 @@ def create_parser():
     parser.add_argument(
         '-c', '--configdir', default=None,
         help='path to the configuration files (default is $HOME/.dockerstra)')
+    parser.add_argument(
+        '--image-cache', metavar='SIZE', default=None,
+        help='Load pulled and built images from the image cache in the '
+        'configuration directory and save them there.  The least recently '
+        'used images are removed, if the cache gets larger than SIZE '
+        '(e.g. 10G)')
     subparsers = parser.add_subparsers(dest='subparser')
     # initialization subparser (currently empty)
     subparsers.add_parser(
@@ -105,11 +112,70 @@ def create_parser():
         '-e', '--environment', type=str, default='',
         help='Filename of YAML file with environment variables')
     run_group.add_argument(
-        '-H', '--daemon', metavar="DAEMON",
-        default='unix://var/run/docker.sock',
-        help='socket for daemon connection')
+        '-H', '--daemon', metavar="DAEMON", action='append', default=None,
+        help='socket for daemon connection.  Repeat the option in order to '
+        'run the unit command on several daemons.  '
+        '(default: unix://var/run/docker.sock)')
     run_group.add_argument(
-        'unitcommand', metavar="UNIT/COMMAND",
+        '--hosts', metavar='FILE', default=None,
+        help='YAML file with a list of daemons or a dictionary mapping host '
+        'names to daemons, that the unit command is run on')
+    run_group.add_argument(
+        '--place', action='store_true',
+        help='Spread the containers of the unit command across the daemons '
+        'instead of running all of them on every daemon')
+    run_group.add_argument(
+        '--host-jobs', metavar='N', type=int, default=4,
+        help='maximum number of daemons the unit command is run on '
+        'concurrently.  (default: 4)')
+    run_group.add_argument(
+        '-j', '--jobs', metavar='N', type=int, default=4,
+        help='maximum number of orders executed concurrently.  Use 1 to '
+        'execute the orders sequentially.  (default: 4)')
+    run_group.add_argument(
+        '--build-jobs', metavar='N', type=int, default=2,
+        help='maximum number of images built concurrently on a daemon.  '
+        '(default: 2)')
+    run_group.add_argument(
+        '--pull-jobs', metavar='N', type=int, default=4,
+        help='maximum number of images pulled concurrently on a daemon.  '
+        '(default: 4)')
+    run_group.add_argument(
+        '--backup-jobs', metavar='N', type=int, default=4,
+        help='maximum number of volumes backed up or restored concurrently.  '
+        '(default: 4)')
+    run_group.add_argument(
+        '--backup-bandwidth', metavar='SIZE', default=None,
+        help='maximum number of bytes per second read from and written to '
+        'the volumes by all backups and restores together (e.g. 50M).  '
+        '(default: unlimited)')
+    run_group.add_argument(
+        '--package-caches', action='store_true',
+        help='Pass the addresses of running apt-cacher-ng and pypicloud '
+        'containers of the unit to image builds as http_proxy and '
+        'PIP_INDEX_URL build arguments')
+    run_group.add_argument(
+        '--backend', choices=['threads', 'twisted'], default='threads',
+        help='Execute the orders on worker threads, or with non-blocking '
+        'requests in the twisted event loop.  With the twisted backend, -j '
+        'limits the number of orders in flight.  (default: threads)')
+    run_group.add_argument(
+        '--plan', metavar='FILE', default=None,
+        help='Run a plan file written by the plan command instead of a unit '
+        'command')
+    run_group.add_argument(
+        '--resume', action='store_true',
+        help='Resume a failed run and skip the orders it completed')
+    run_group.add_argument(
+        '--no-preflight', action='store_true',
+        help='Do not check the bind paths, images, links and ports of all '
+        'containers before the first order is executed')
+    run_group.add_argument(
+        '--no-prefetch', action='store_true',
+        help='Do not pull missing images in the background at the start of '
+        'the run, but only when an order needs them')
+    run_group.add_argument(
+        'unitcommand', metavar="UNIT/COMMAND", nargs='?',
         help='The unit command to run'
     ).completer = UnitListCompleter().complete
     run_group.add_argument(
@@ -121,6 +187,76 @@ def create_parser():
     run_group.add_argument(
         'args', nargs=argparse.REMAINDER,
         help='arguments send as command to the docker containers')
+    plan_group = subparsers.add_parser(
+        'plan', help='Show the actions a unit command would execute')
+    plan_group.add_argument(
+        '-e', '--environment', type=str, default='',
+        help='Filename of YAML file with environment variables')
+    plan_group.add_argument(
+        '-H', '--daemon', metavar="DAEMON",
+        default='unix://var/run/docker.sock',
+        help='socket for daemon connection')
+    plan_group.add_argument(
+        '-o', '--output', metavar='FILE', default=None,
+        help='Write the plan to a file, that can be executed with '
+        "'run --plan FILE'")
+    plan_group.add_argument(
+        'unitcommand', metavar="UNIT/COMMAND",
+        help='The unit command to plan'
+    ).completer = UnitListCompleter().complete
+    plan_group.add_argument(
+        'args', nargs=argparse.REMAINDER,
+        help='arguments send as command to the docker containers')
+    services_group = subparsers.add_parser(
+        'build-services',
+        help='Build the images of all services in the order of their FROM '
+        'lines')
+    services_group.add_argument(
+        '-H', '--daemon', metavar="DAEMON",
+        default='unix://var/run/docker.sock',
+        help='socket for daemon connection')
+    services_group.add_argument(
+        '-j', '--jobs', metavar='N', type=int, default=4,
+        help='maximum number of images waiting for or being built '
+        'concurrently.  (default: 4)')
+    services_group.add_argument(
+        '--build-jobs', metavar='N', type=int, default=2,
+        help='maximum number of images built concurrently on the daemon.  '
+        '(default: 2)')
+    services_group.add_argument(
+        '--dry-run', action='store_true',
+        help='Only print the images, that would be built')
+    cache_group = subparsers.add_parser(
+        'cache', help='Manage the image cache')
+    cache_group.add_argument(
+        'action', choices=['list', 'gc'],
+        help='list the cached images or remove the least recently used ones')
+    cache_group.add_argument(
+        '--max-size', metavar='SIZE', default=None,
+        help='size the image cache is reduced to by gc (e.g. 10G).  '
+        '(default: the size given with --image-cache)')
+    bundle_group = subparsers.add_parser(
+        'bundle',
+        help='Export the images and configuration of a unit command into one '
+        'archive, or import such an archive')
+    bundle_group.add_argument(
+        '-e', '--environment', type=str, default='',
+        help='Filename of YAML file with environment variables')
+    bundle_group.add_argument(
+        '-H', '--daemon', metavar="DAEMON",
+        default='unix://var/run/docker.sock',
+        help='socket for daemon connection')
+    bundle_group.add_argument(
+        '-o', '--output', metavar='FILE', default=None,
+        help='save: the bundle file (default: UNIT_COMMAND.bundle.tar).  '
+        "load: write the plan of the unit command, that can be executed "
+        "with 'run --plan FILE'")
+    bundle_group.add_argument(
+        'action', choices=['save', 'load'],
+        help='save the bundle of a unit command, or load a bundle file')
+    bundle_group.add_argument(
+        'target', metavar='UNIT/COMMAND|FILE',
+        help='the unit command to save, or the bundle file to load')
     list_group = subparsers.add_parser('list', help='list certain things')
     list_group.add_argument(
         '--units', action='store_true',
@@ -281,7 +417,8 @@ class Configuration(object):
         new_configurations = configurations
 
         def _parse(configurations, order_list):
-            builds, creations, starts = set([]), set([]), set([])
+            builds, pulls, creations, starts = (
+                set([]), set([]), set([]), set([]))
             for item in order_list:
                 name, order = item.items()[0]
                 cmd = order['command']
@@ -291,11 +428,14 @@ class Configuration(object):
                     creations.add(name)
                 if cmd in ['start', 'build', 'create']:
                     build_config = configurations[name].get('build', {})
+                    creation = configurations[name].get('creation', {})
                     if build_config.get('tag'):
                         builds.add(name)
-            return builds, creations, starts
+                    elif creation.get('image'):
+                        pulls.add(name)
+            return builds, pulls, creations, starts
 
-        builds, creations, starts = _parse(configurations, order_list)
+        builds, pulls, creations, starts = _parse(configurations, order_list)
         new_order_list = []
 
         stop_command = {'command': 'stop', 'timeout': 0}
@@ -305,10 +445,32 @@ class Configuration(object):
             remove_order = {'command': 'remove', 'v': True}
 
         if command == 'build':
-            for build in builds:
-                new_order_list.append({
-                    build:
-                        {'command': 'build'}})
+            built = dict(
+                (normalize_image(configurations[build]['build']['tag']),
+                 build) for build in builds)
+            # images are built after the images of the unit they build on
+            graph = dict(
+                (build, set(
+                    built[image] for image in base_images(
+                        self, configurations[build]['build'])
+                    if image in built) - set([build]))
+                for build in builds)
+            for wave in build_waves(graph):
+                for build in wave:
+                    new_order_list.append({
+                        build:
+                            {'command': 'build'}})
+            # pull every image only once, and none, that the unit builds
+            pulled = set(built)
+            for pull in sorted(pulls):
+                creation = configurations[pull]['creation']
+                image = creation['image']
+                if creation.get('tag'):
+                    image = '{}:{}'.format(image, creation['tag'])
+                image = normalize_image(image)
+                if image not in pulled:
+                    pulled.add(image)
+                    new_order_list.append({pull: {'command': 'build'}})
         elif command == 'create':
             for created in creations:
                 new_order_list.append({
@@ -326,7 +488,8 @@ class Configuration(object):
                     {created:
                         {'command': 'backup',
                          'backup_dir': self.environment.get('BACKUPDIR'),
-                         'backup_name': created}})
+                         'backup_name': created,
+                         'per_volume': True}})
         if command == 'restore':
             for created in creations:
                 new_order_list.append(
@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import copy
+import io
 import json
 import logging
 import os
@@ -8,15 +10,50 @@ import time
 import docker
 import yaml
 
+import docker_meta.twisted_backend
 import docker_meta.utils_spawn
+from docker_meta.backup import (
+    backup_files, default_backup_limits, find_archive, find_manifest,
+    find_snapshot, read_backup, read_snapshot, read_volume_backups,
+    write_backup, write_snapshot, write_volume_backups)
+from docker_meta.build_context import (
+    context_digest, default_digest_cache, label_dockerfile, labelled_context,
+    resolve_context)
+from docker_meta.bundle import export_images, load_bundle, write_bundle
+from docker_meta.clients import default_factory
+from docker_meta.compression import get_codec
 from docker_meta.configurations import (Configuration)
+from docker_meta.events import EventMonitor
+from docker_meta.fanout import (
+    resolve_hosts, run_on_hosts, summarize, HostLogCollector)
+from docker_meta.image_cache import default_image_cache, parse_size
+from docker_meta.images import default_limits, Prefetcher
+from docker_meta.journal import order_fingerprint, Journal
+from docker_meta.package_caches import default_package_caches, dockerfile_args
+from docker_meta.placement import (
+    host_resources, place_containers, split_orders)
+from docker_meta.plan import (
+    critical_path, format_plan, load_plan, predict_order, save_plan, Timings)
+from docker_meta.preflight import check_jobs, PreflightError
+from docker_meta.probes import wait_until_ready
+from docker_meta.scheduler import OrderScheduler
+from docker_meta.services import (
+    base_images, build_parents, build_waves, collect_services,
+    normalize_image, service_graph)
+from docker_meta.state import DockerState
+from docker_meta.utils import fingerprint, FINGERPRINT_LABEL
 
 
 log = logging.getLogger(docker_meta.__name__)
 
+# build options, that do not influence the resulting image
+_BUILD_RUNTIME_OPTIONS = [
+    'fileobj', 'rm', 'forcerm', 'stream', 'decode', 'timeout', 'quiet',
+    'nocache', 'pull']
+
 
 def get_docker_client(daemon):
-    return docker.Client(daemon)
+    return default_factory.get(daemon)
 
 
 def _check_for_and_print_readme(root, directory):
@@ -54,20 +91,143 @@ def main_help(config, args):
 
 def main_run(config, args):
 
-    dc = get_docker_client(args.daemon)
+    plan_file = getattr(args, 'plan', None)
+    if plan_file:
+        plan = load_plan(plan_file)
+        configurations, order_list, unitcommand = (
+            plan['configurations'], plan['order_list'], plan['unitcommand'])
+    else:
+        if not args.unitcommand:
+            raise ValueError(
+                "Specify a UNIT/COMMAND or a plan file to run.")
 
-    if args.print_substitutions:
-        print config.read_unit_configuration(args.unitcommand, True)
-        return
+        if args.print_substitutions:
+            print config.read_unit_configuration(args.unitcommand, True)
+            return
+
+        configurations, order_list = config.read_unit_configuration(
+            args.unitcommand)
+
+        if args.print_only:
+            print yaml.safe_dump_all([configurations, order_list])
+            return
+        unitcommand = args.unitcommand
+
+    hosts = resolve_hosts(args.daemon, getattr(args, 'hosts', None))
+    jobs = getattr(args, 'jobs', 1)
+    resume = getattr(args, 'resume', False)
+    timings = Timings.for_config(config)
+    check = not getattr(args, 'no_preflight', False)
+    prefetch = not getattr(args, 'no_prefetch', False)
+    default_limits.configure(
+        getattr(args, 'build_jobs', None), getattr(args, 'pull_jobs', None))
+    default_package_caches.configure(
+        getattr(args, 'package_caches', False), configurations)
+    backup_bandwidth = getattr(args, 'backup_bandwidth', None)
+    default_backup_limits.configure(
+        getattr(args, 'backup_jobs', None),
+        backup_bandwidth and parse_size(backup_bandwidth))
+    if getattr(args, 'place', False):
+        if resume:
+            raise ValueError("Placed runs cannot be resumed.")
+        run_configuration_placed(
+            config, configurations, order_list, hosts, unitcommand, jobs,
+            timings, getattr(args, 'host_jobs', 4))
+    elif getattr(args, 'backend', 'threads') == 'twisted':
+        if len(hosts) > 1 or resume:
+            raise ValueError(
+                "The twisted backend runs on a single daemon without a "
+                "journal.")
+        docker_meta.twisted_backend.run_configuration_twisted(
+            config, configurations, order_list, hosts[0][1], jobs)
+    elif len(hosts) == 1:
+        dc = get_docker_client(hosts[0][1])
+        run_configuration(
+            config, configurations, order_list, dc, unitcommand, jobs,
+            timings, Journal.for_config(config, unitcommand, resume), check,
+            prefetch)
+    else:
+        run_configuration_on_hosts(
+            config, configurations, order_list, hosts, unitcommand, jobs,
+            timings, resume, getattr(args, 'host_jobs', 4), check, prefetch)
+
+
+def main_plan(config, args):
+
+    dc = get_docker_client(args.daemon)
 
     configurations, order_list = config.read_unit_configuration(
         args.unitcommand)
+    plan = make_plan(
+        config, configurations, order_list, dc, args.unitcommand,
+        Timings.for_config(config))
 
-    if args.print_only:
-        print yaml.safe_dump_all([configurations, order_list])
-    else:
-        run_configuration(
-            config, configurations, order_list, dc, args.unitcommand)
+    print format_plan(plan)
+    if args.output:
+        save_plan(plan, args.output)
+        log.info("Wrote the plan to {}".format(args.output))
+
+
+def main_build_services(config, args):
+    services = collect_services(config)
+    graph = service_graph(services)
+    dc = get_docker_client(args.daemon)
+    default_limits.configure(getattr(args, 'build_jobs', None))
+    if getattr(args, 'dry_run', False):
+        changed = plan_services(config, services, graph, dc)
+        for n, wave in enumerate(build_waves(graph)):
+            print 'Wave {}:'.format(n + 1)
+            for tag in wave:
+                print '  {} ({})'.format(
+                    tag, 'build' if tag in changed else 'skip')
+        return
+    build_services(config, services, graph, dc, getattr(args, 'jobs', 1))
+
+
+def main_bundle(config, args):
+    dc = get_docker_client(args.daemon)
+    if args.action == 'save':
+        configurations, order_list = config.read_unit_configuration(
+            args.target)
+        images = bundle_images(config, configurations, order_list, dc)
+        filename = args.output or '{}.bundle.tar'.format(
+            args.target.replace('/', '_'))
+        plan = {
+            'unitcommand': args.target,
+            'configurations': configurations,
+            'order_list': order_list,
+        }
+        write_bundle(filename, plan, images, export_images(dc, images))
+    elif args.action == 'load':
+        plan = load_bundle(dc, args.target)
+        if args.output:
+            save_plan(plan, args.output)
+            log.info(
+                "Wrote the plan of {} to {}.  Execute it with 'run --plan "
+                "{}'".format(plan['unitcommand'], args.output, args.output))
+
+
+def main_cache(config, args):
+    if args.action == 'list':
+        entries = default_image_cache.entries()
+        for image_id, entry in sorted(
+                entries.items(), key=lambda e: -e[1]['used']):
+            print '{:>10.1f} MB  {}  {}'.format(
+                entry['size'] / 1024. ** 2, image_id[:19],
+                ', '.join(entry['tags']))
+        print '{:>10.1f} MB  total'.format(
+            sum(e['size'] for e in entries.values()) / 1024. ** 2)
+    elif args.action == 'gc':
+        max_size = default_image_cache.max_size
+        if getattr(args, 'max_size', None):
+            max_size = parse_size(args.max_size)
+        if max_size is None:
+            raise ValueError(
+                "Specify the maximal size of the image cache with "
+                "--max-size.")
+        removed = default_image_cache.gc(max_size)
+        log.info(
+            "Removed {} images from the image cache".format(len(removed)))
 
 
 def _list_out(print_titles, title, list):
@@ -101,6 +261,15 @@ def main(args):
         environment = getattr(args, 'environment', None)
         config.update_environment(environment)
 
+        default_factory.version_cache = os.path.join(
+            config.basedir, 'api_versions.yaml')
+        default_digest_cache.filename = os.path.join(
+            config.basedir, 'context_digests.json')
+        default_image_cache.directory = os.path.join(
+            config.basedir, 'image_cache')
+        if getattr(args, 'image_cache', None):
+            default_image_cache.max_size = parse_size(args.image_cache)
+
         if args.subparser == 'init':
             config.initialize()
         else:
@@ -111,6 +280,14 @@ def main(args):
                 )
         if args.subparser == 'run':
             main_run(config, args)
+        elif args.subparser == 'plan':
+            main_plan(config, args)
+        elif args.subparser == 'build-services':
+            main_build_services(config, args)
+        elif args.subparser == 'cache':
+            main_cache(config, args)
+        elif args.subparser == 'bundle':
+            main_bundle(config, args)
         elif args.subparser == 'help':
             main_help(config, args)
         elif args.subparser == 'list':
@@ -129,14 +306,17 @@ class DockerContainer(object):
 
     def __init__(
             self, dc, name, creation={}, startup={}, build={},
-            global_config=Configuration(),
+            global_config=Configuration(), state=None,
             **kwargs):
 
         self.dc = dc
         self.name = name
-        self.creation = creation
-        self.startup = startup
-        self.build = build
+        self.state = state
+        self._image_fingerprint = None
+        # the configurations are shared by the orders of a run
+        self.creation = copy.copy(creation)
+        self.startup = copy.copy(startup)
+        self.build = copy.copy(build)
         self.global_config = global_config
         self._update_start_config()
         self._update_creation_config()
@@ -150,6 +330,13 @@ class DockerContainer(object):
         else:
             return os.getcwd()
 
+    def context_path(self):
+        """
+        returns the local build context resolved against the configuration
+        directory, or None for remote build contexts.
+        """
+        return resolve_context(self.global_config, self.build)
+
     def _path_substitutions(self, fro):
         """
         substitutes container-specific environment variables.
@@ -176,22 +363,32 @@ class DockerContainer(object):
         if 'binds' in self.startup:
             binds = self.startup['binds']
             nbinds = {}
+            missing = []
             for fro, to in binds.iteritems():
                 nfro = self._path_substitutions(fro)
                 nbinds[nfro] = to
                 if not os.path.exists(nfro):
-                    raise ValueError(
-                        "The path {} to bind to, does not exist, maybe you "
-                        "started in the wrong directory?".format(nfro))
+                    missing.append(nfro)
+            if len(missing) == 1:
+                raise ValueError(
+                    "The path {} to bind to, does not exist, maybe you "
+                    "started in the wrong directory?".format(missing[0]))
+            elif missing:
+                raise ValueError(
+                    "The paths {} to bind to, do not exist, maybe you "
+                    "started in the wrong directory?".format(
+                        ', '.join(sorted(missing))))
             self.startup['binds'] = nbinds
 
     def _update_creation_config(self):
         if 'port_bindings' in self.startup:
             ports = self.startup['port_bindings'].keys()
             cports = set(self.creation.pop('ports', []) + ports)
-            self.creation['ports'] = list(cports)
+            self.creation['ports'] = sorted(cports)
 
     def is_started(self):
+        if self.state is not None:
+            return self.state.is_running(self.name)
         res = self.dc.inspect_container(self.get_container())
         return res['State']['Running']
 
@@ -200,6 +397,8 @@ class DockerContainer(object):
             name = self.creation.get('image', self.build.get('tag', None))
         if name is None:
             return {}
+        if self.state is not None:
+            return self.state.get_image(name)
         name_split = name.rsplit(':', 1)
         images = self.dc.images(name_split[0])
         if len(images) == 1:
@@ -210,7 +409,114 @@ class DockerContainer(object):
         else:  # len(images) == 0:
             return {}
 
+    def image_fingerprint(self):
+        """
+        computes the fingerprint of the ``build`` configuration including the
+        digest of the build context.
+
+        Without a build context, e.g. on hosts, that got their images from a
+        bundle, the fingerprint of an existing image is taken over.
+        """
+        build = dict(
+            (k, v) for k, v in self.build.items()
+            if k not in _BUILD_RUNTIME_OPTIONS)
+        if self._image_fingerprint is not None:
+            return self._image_fingerprint
+        fileobj = self.build.get('fileobj')
+        path = self.context_path()
+        if fileobj is not None:
+            content = fileobj.read()
+            fileobj.seek(0)
+            build['context'] = fingerprint(content)
+        elif path:
+            try:
+                build['context'] = context_digest(
+                    path, self.build.get('dockerfile'), default_digest_cache)
+            except ValueError as e:
+                image = self.get_image()
+                if not image:
+                    raise
+                log.debug("Using the image of {}: {}".format(self.name, e))
+                label = self._fingerprint_label(image)
+                if label is not None:
+                    self._image_fingerprint = label
+                    return label
+        self._image_fingerprint = fingerprint(build)
+        return self._image_fingerprint
+
+    def container_fingerprint(self):
+        """
+        computes the fingerprint of the ``creation`` and ``startup``
+        configurations and of the image built for the container.
+        """
+        creation = dict(
+            (k, v) for k, v in self.creation.items() if k != 'labels')
+        creation['name'] = self.name
+        creation['image'] = self.build.get('tag', creation.get('image'))
+        image = self.build and self.image_fingerprint() or None
+        return fingerprint(creation, self.startup, image)
+
+    @staticmethod
+    def _fingerprint_label(obj):
+        return (obj.get('Labels') or {}).get(FINGERPRINT_LABEL)
+
+    def plan_create(self):
+        """
+        decides, whether the container needs to be created (``create``),
+        re-created because its configuration changed (``recreate``) or can be
+        left alone (``skip``).
+
+        Containers without a fingerprint label were not created by us, or by
+        an older version, and are left alone.
+        """
+        container = self.get_container()
+        if not container:
+            return 'create'
+        label = self._fingerprint_label(container)
+        if label is None or label == self.container_fingerprint():
+            return 'skip'
+        return 'recreate'
+
+    def plan_build(self):
+        """
+        decides, whether the image needs to be built or pulled (``build`` or
+        ``pull``), re-built because the build configuration or the build
+        context changed (``rebuild``) or can be left alone (``skip``).
+
+        Built images are only left alone, if their fingerprint label matches
+        the build configuration and the digest of the build context.  Images
+        without a label, e.g. pulled ones, are re-built.
+        """
+        image = self.get_image()
+        if not image:
+            return self.build and 'build' or 'pull'
+        if (not self.build or self._fingerprint_label(image) ==
+                self.image_fingerprint()):
+            return 'skip'
+        return 'rebuild'
+
+    def _recreate(self):
+        """
+        removes a container, whose configuration changed.  Containers with
+        volumes attached to them are kept, because their data would be lost.
+
+        Returns ``True`` if the container has been removed.
+        """
+        if self._has_own_volumes():
+            log.warn(
+                "Container {} is out of date, but has volumes attached to it. "
+                "Remove it manually in order to update it."
+                .format(self.name))
+            return False
+        log.info(
+            "The configuration of container {} changed.  Re-creating it."
+            .format(self.name))
+        self.remove(v=False)
+        return True
+
     def get_container(self):
+        if self.state is not None:
+            return self.state.get_container(self.name)
         containers = self.dc.containers(
             filters={'name': "^/{}$".format(self.name)}, all=True)
         if len(containers) == 1:
@@ -223,9 +529,14 @@ class DockerContainer(object):
 
     def start(self, restart=False, attach=False, timeout=10):
         container = self.get_container()
+        if container and self.plan_create() == 'recreate':
+            if self._recreate():
+                container = {}
         if container:
             if restart or not self.is_started():
+                self._reset_events(container)
                 self.dc.restart(container, timeout)
+                self._update_state('container_started', self.name)
                 log.info("Started container {}".format(self.name))
             else:
                 log.debug(
@@ -241,7 +552,9 @@ class DockerContainer(object):
                 self.create()
                 # ... and then start it.
                 container = self.get_container()
+                self._reset_events(container)
                 self.dc.start(container, **self.startup)
+                self._update_state('container_started', self.name)
                 log.info("Started container {}".format(self.name))
             except Exception as e:
                 raise RuntimeError(
@@ -254,18 +567,115 @@ class DockerContainer(object):
                     tail='all'):
 
                 self._log_output(line, 'attach')
-            exitcode = self.dc.wait(container)
+            exitcode = self._wait(container)
+            self._update_state('container_stopped', self.name)
             if exitcode != 0:
                 raise RuntimeError(
                     "Container {} stopped with exit code {}!"
                     .format(self.name, exitcode))
 
-    def build_image(self):
-        imjson = self.get_image()
-        if imjson:
+    def _monitor(self):
+        monitor = self.state is not None and self.state.monitor
+        if monitor and monitor.available:
+            return monitor
+        return None
+
+    def _reset_events(self, container):
+        monitor = self._monitor()
+        if monitor:
+            monitor.reset(container['Id'])
+
+    def _wait(self, container, timeout=10):
+        """
+        returns the exit code of a container, preferably from the event
+        stream.  ``timeout`` is the time in seconds to wait for the event
+        stream, before the daemon is asked directly.
+        """
+        monitor = self._monitor()
+        if monitor:
+            exitcode = monitor.wait_for_exit(container['Id'], timeout)
+            if exitcode is not None:
+                return exitcode
+        return self.dc.wait(container)
+
+    def _build_arguments(self, buildargs=None):
+        """
+        returns the arguments for the build command.  The fingerprint of the
+        build configuration is added as a label to the Dockerfile.
+
+        The ``buildargs`` are added to the build arguments of the build
+        configuration, that take precedence.
+        """
+        build = dict(self.build)
+        if buildargs:
+            build['buildargs'] = dict(
+                buildargs, **(build.get('buildargs') or {}))
+        labels = {FINGERPRINT_LABEL: self.image_fingerprint()}
+        fileobj = build.get('fileobj')
+        path = self.context_path()
+        if fileobj is not None and not build.get('custom_context'):
+            build['fileobj'] = io.BytesIO(
+                label_dockerfile(fileobj.read(), labels))
+            fileobj.seek(0)
+        elif path:
+            build.pop('path')
+            build['fileobj'] = labelled_context(
+                path, build.get('dockerfile'), labels)
+            build['custom_context'] = True
+        return build
+
+    def _image_name(self):
+        return self.build.get('tag', self.creation.get('image'))
+
+    def _pull_image(self):
+        """
+        returns the repository and the tag of the image to pull.  A tag in
+        the ``image`` takes the place of the default tag ``latest``.
+        """
+        image = self.creation.get('image')
+        tag = self.creation.get('tag')
+        if image and not tag and '@' not in image:
+            image, _, tag = normalize_image(image).rpartition(':')
+        return image, tag
+
+    def _transfer_image(self):
+        """
+        returns the image with its tag, that :meth:`build_image` transfers.
+        Orders and prefetched pulls (cf. :func:`prefetch_images`) of the same
+        image use the same name, so that they wait for each other.
+        """
+        image = self._image_name()
+        if not self.build:
+            image, tag = self._pull_image()
+            if image and tag:
+                image = '{}:{}'.format(image, tag)
+        return image and normalize_image(image)
+
+    def build_image(self, force=False):
+        """
+        builds or pulls the image of the container.  The number of concurrent
+        builds and pulls on a daemon is limited separately (cf.
+        :class:`docker_meta.images.TransferLimits`).
+
+        With ``force``, existing images are re-built, e.g. because the image
+        they build on changed.
+        """
+        kind = self.build and 'build' or 'pull'
+        daemon = getattr(self.dc, 'base_url', None)
+        with default_limits.transfer(kind, daemon, self._transfer_image()):
+            return self._build_image(force)
+
+    def _build_image(self, force=False):
+        plan = self.plan_build()
+        if plan == 'skip' and force and self.build:
+            log.info(
+                "The base image of image {} changed.  Re-building it."
+                .format(self.build.get('tag')))
+            plan = 'build'
+        if plan == 'skip':
             log.debug(
                 "Image {} already exists. (skipped)"
-                .format(imjson['RepoTags'][0]))
+                .format(self.creation.get('image', self.build.get('tag'))))
             return None
         if self.build:
             # set the default to rm==True
@@ -275,35 +685,116 @@ class DockerContainer(object):
                     .format(self.name))
                 self.build['rm'] = True
 
-            for line in self.dc.build(**self.build):
-                log.info(line, extra={'type': 'output', 'cmd': 'build'})
+            if plan == 'rebuild':
+                log.info(
+                    "The build context or configuration of image {} changed.  "
+                    "Re-building it.".format(self.build.get('tag')))
+            # images built on an outdated base image are not loaded
+            if not force and self._load_cached(
+                    self.build.get('tag'), self.image_fingerprint()):
+                return None
+            buildargs = self._cache_build_args()
+            if self._run_build(buildargs) and buildargs:
+                log.warn(
+                    "Building the image {} with the package caches failed.  "
+                    "Re-building it without them.".format(
+                        self.build.get('tag', 'for container {}'.format(
+                            self.name))))
+                self._run_build()
+            self._update_state('images_changed')
             log.info(
                 "Successfully built the image {}"
                 .format(self.build.get(
                     'tag', 'for container {}'.format(self.name))))
+            self._save_cached(self.build.get('tag'))
         else:
-            image = self.creation.get('image')
-            tag = self.creation.get('tag', 'latest')
+            image, tag = self._pull_image()
+            name = tag and '{}:{}'.format(image, tag) or image
+            if image and self._load_cached(name):
+                return None
             if image:
                 try:
                     for line in self.dc.pull(
                             repository=image, tag=tag, stream=True):
-                        log.info(line, extra={'type': 'output', 'cmd': 'pull'})
-                        # print(response.get('progressDetail'))
+                        self._log_output(line, 'pull')
                     last_line = json.loads(line)
                     if 'error' in last_line:
                         raise RuntimeError(last_line['error'])
+                    self._update_state('images_changed')
                     log.info(
                         "Successfully pulled the image {}".format(image))
                 except Exception as e:
                     raise RuntimeError(
                         "No build instructions for image {}:\n{}"
                         .format(image, e))
+                self._save_cached(name)
             else:
                 raise RuntimeError("No image to pull or build given.")
 
+    def _cache_build_args(self):
+        """
+        returns the build arguments for the running package caches (cf.
+        :class:`docker_meta.package_caches.PackageCaches`).
+        """
+        if not default_package_caches.enabled:
+            return {}
+        path = self.context_path()
+        declared = set([])
+        if path:
+            declared = dockerfile_args(path, self.build.get('dockerfile'))
+        return default_package_caches.build_args(self.dc, declared)
+
+    def _run_build(self, buildargs=None):
+        """
+        builds the image and returns the error reported by the build.
+        """
+        error = None
+        for line in self.dc.build(**self._build_arguments(buildargs)):
+            self._log_output(line, 'build')
+            try:
+                error = json.loads(line).get('error') or error
+            except (TypeError, ValueError, AttributeError):
+                pass
+        return error
+
+    def _load_cached(self, image, fingerprint=None):
+        """
+        loads the ``image`` from the image cache (cf.
+        :class:`docker_meta.image_cache.ImageCache`).  Built images are only
+        loaded, if their ``fingerprint`` matches.
+        """
+        if not (image and default_image_cache.enabled):
+            return False
+        try:
+            loaded = default_image_cache.load(self.dc, image, fingerprint)
+        except Exception as e:
+            log.warn(
+                "Could not load the image {} from the image cache: {}"
+                .format(image, e))
+            return False
+        if loaded:
+            self._update_state('images_changed')
+        return loaded
+
+    def _save_cached(self, image):
+        if not (image and default_image_cache.enabled):
+            return
+        try:
+            default_image_cache.save(self.dc, image)
+        except Exception as e:
+            log.warn(
+                "Could not save the image {} in the image cache: {}"
+                .format(image, e))
+
+    def _update_state(self, method, *args):
+        if self.state is not None:
+            getattr(self.state, method)(*args)
+
     def _log_output(self, line, command):
-        log.info(line, extra={'type': 'output', 'cmd': command, 'dc': self})
+        extra = {'type': 'output', 'cmd': command, 'dc': self}
+        if command in ['build', 'pull']:
+            extra['image'] = self._image_name()
+        log.info(line, extra=extra)
 
     def inspect(self):
         return self.dc.inspect_container(self.name)
@@ -368,13 +859,26 @@ class DockerContainer(object):
         log.debug(
             "set creation fields for 'name' and 'image' to {name} and "
             "{image}".format(**(self.creation)))
-        if self.get_container():
+        plan = self.plan_create()
+        if plan == 'skip':
             log.debug(
                 "The container {} seems to exist already (skipped)."
                 .format(self.name))
             return None
+        elif plan == 'recreate' and not self._recreate():
+            return None
+        labels = self.creation.get('labels') or {}
+        if isinstance(labels, list):
+            labels = dict((label, '') for label in labels)
+        else:
+            labels = dict(labels)
+        labels[FINGERPRINT_LABEL] = self.container_fingerprint()
+        self.creation['labels'] = labels
         try:
             res = self.dc.create_container(**self.creation)
+            self._update_state(
+                'container_created', self.name, res['Id'],
+                self.creation['image'], labels)
             self._log_output(res, 'create_container')
             log.info("Successfully created the container {}".format(self.name))
         except docker.errors.APIError as e:
@@ -384,7 +888,10 @@ class DockerContainer(object):
                     "Trying to build it..."
                     .format(self.creation["image"], self.name))
                 self.build_image()
-                self.dc.create_container(**self.creation)
+                res = self.dc.create_container(**self.creation)
+                self._update_state(
+                    'container_created', self.name, res['Id'],
+                    self.creation['image'], labels)
                 log.info(
                     "Successfully created the container {}."
                     .format(self.name))
@@ -430,7 +937,9 @@ class DockerContainer(object):
             "Successfully executed command {} in container {}."
             .format(command, self.name))
 
-    def backup(self, sources, target_dir, target_name, overwrite=False):
+    def backup(self, sources, target_dir, target_name, overwrite=False,
+               compression=None, per_volume=False, incremental=False):
+        codec = get_codec(compression)
         if not sources:
             inspect = self.dc.inspect_container(self.name)
             volumes = inspect['Config']['Volumes']
@@ -438,15 +947,19 @@ class DockerContainer(object):
                 raise RuntimeError(
                     "No volumes to backup found in container {}"
                     .format(self.name))
-            sources = volumes.keys()
+            sources = sorted(volumes.keys())
         if isinstance(sources, basestring):
             sources = [sources]
         target_dir = self._path_substitutions(target_dir)
-        targetfile = os.path.join(target_dir, '{}.tar'.format(target_name))
-        gzipped_target_file = '{}.gz'.format(targetfile)
-        if not overwrite and (
-                os.path.exists(targetfile)
-                or os.path.exists(gzipped_target_file)):
+        if incremental:
+            log.info(
+                "Incremental backup of container {}: {} -> {}/{}"
+                .format(self.name, repr(sources), target_dir, target_name))
+            write_snapshot(
+                self.dc, self.name, sources, target_dir, target_name, codec)
+            return
+        existing = backup_files(target_dir, target_name)
+        if not overwrite and existing:
             raise RuntimeError(
                 "Backup failed: The target {} exists already in directory {}. "
                 "Add 'overwrite=True' to orders to overwrite"
@@ -455,36 +968,37 @@ class DockerContainer(object):
         log.info(
             "Backup of container {}: {} -> {}/{}"
             .format(self.name, repr(sources), target_dir, target_name))
-        res = self.manipulate_volumes(
-            command=[
-                'tar', 'cvf', '/backup/{}.tar'.format(target_name)] + sources,
-            binds={target_dir: {'bind': '/backup', 'ro': False}})
-        os.system('gzip {}.tar'.format(os.path.join(target_dir, target_name)))
-        return res
-
-    def restore(self, restore_dir, restore_name):
+        if per_volume:
+            written = write_volume_backups(
+                self.dc, self.name, sources, target_dir, target_name, codec)
+        else:
+            written = [os.path.join(
+                target_dir, '{}.tar{}'.format(target_name, codec.extension))]
+            write_backup(self.dc, self.name, sources, written[0], codec)
+        # restore must not find parts of an older backup
+        for filename in existing:
+            if filename not in written and os.path.exists(filename):
+                os.remove(filename)
+
+    def restore(self, restore_dir, restore_name, snapshot=None):
         restore_dir = self._path_substitutions(restore_dir)
         log.info(
             "Restoring container {} from {}/{}"
             .format(self.name, restore_dir, restore_name))
-
-        archive = '{}.tar'.format(
-            os.path.join(restore_dir, restore_name))
-        gzipped_archive = '{}.gz'.format(archive)
-        gzip = False
-        if os.path.exists(gzipped_archive):
-            log.debug(
-                'unzipping the tar archive {} first'.format(gzipped_archive))
-            os.system('gunzip {}'.format(gzipped_archive))
-            gzip = True
-        res = self.manipulate_volumes(
-            command=[
-                'tar', 'xf', '/backup/{}.tar'.format(restore_name)],
-            binds={restore_dir: {'bind': '/backup', 'ro': True}})
-        if gzip:
-            os.system('gzip {}'.format(archive))
-
-        return res
+        chosen = snapshot is not None
+        snapshot = find_snapshot(restore_dir, restore_name, snapshot)
+        # without a chosen snapshot, the newest backup is restored
+        others = backup_files(restore_dir, restore_name)
+        if snapshot and (chosen or not others or max(
+                map(os.path.getmtime, others)) <= os.path.getmtime(snapshot)):
+            read_snapshot(self.dc, self.name, restore_dir, snapshot)
+            return
+        manifest = find_manifest(restore_dir, restore_name)
+        if manifest:
+            read_volume_backups(self.dc, self.name, restore_dir, manifest)
+        else:
+            archive, codec = find_archive(restore_dir, restore_name)
+            read_backup(self.dc, self.name, archive, codec)
 
     def stop(self, timeout=10):
         container = self.get_container()
@@ -496,6 +1010,7 @@ class DockerContainer(object):
             return
         if self.is_started():
             self.dc.stop(container, timeout)
+            self._update_state('container_stopped', self.name)
             log.info("Successfully stopped container {}".format(self.name))
         else:
             log.debug(
@@ -506,28 +1021,36 @@ class DockerContainer(object):
         image = self.get_image()
         if image:
             self.dc.remove_image(image, force, noprune)
+            self._update_state('images_changed')
             log.info("Successfully removed the image {}".format(image))
         else:
             log.debug(
                 "Trying to remove image {}. But it does not exist. (Skipping)"
                 .format(image))
 
+    def _has_own_volumes(self):
+        """
+        checks, whether the container has volumes, that are neither bound
+        from the host nor taken from another container.
+        """
+        inspect = self.inspect()
+        binds = set([
+            n.split(':')[1] for n in (
+                inspect['HostConfig']['Binds'] or [])])
+        volumes_from = inspect['HostConfig']['VolumesFrom'] or []
+        fvolumes = []
+        for vf in volumes_from:
+            finspect = self.dc.inspect_container(vf)
+            fvolumes += finspect['Volumes'].keys()
+        volumes = set(inspect['Volumes'].keys())
+        return bool(volumes.difference(binds.union(set(fvolumes))))
+
     def remove(self, v=True, timeout=10):
         self.stop(timeout)
         container = self.get_container()
         if container:
             if not v:
-                inspect = self.inspect()
-                binds = set([
-                    n.split(':')[1] for n in (
-                        inspect['HostConfig']['Binds'] or [])])
-                volumes_from = inspect['HostConfig']['VolumesFrom'] or []
-                fvolumes = []
-                for vf in volumes_from:
-                    finspect = self.dc.inspect_container(vf)
-                    fvolumes += finspect['Volumes'].keys()
-                volumes = set(inspect['Volumes'].keys())
-                if volumes.difference(binds.union(set(fvolumes))):
+                if self._has_own_volumes():
                     log.info(
                         "Not removing container {} as it has volumes attached "
                         "to it."
@@ -535,6 +1058,7 @@ class DockerContainer(object):
                     return
 
             self.dc.remove_container(container, v)
+            self._update_state('container_removed', self.name)
             log.info("Successfully removed container {}".format(self.name))
         else:
             log.debug(
@@ -542,20 +1066,423 @@ class DockerContainer(object):
                 .format(self.name))
 
 
-def run_configuration(
+def make_plan(
         global_config, configurations, order_list, dc,
-        unitcommand='unknown/unknown'):
-
+        unitcommand='unknown/unknown', timings=None, state=None):
+    """
+    resolves the orders against the current state of the docker daemon.
+
+    Returns a serializable dictionary with the resolved configuration and a
+    list of ``actions`` with the predicted actions, API calls and durations
+    of each order (cf. :func:`docker_meta.plan.predict_order`).
+
+    Orders, whose containers cannot be set up before the earlier orders
+    ran, e.g. because an ``execute`` order creates their bind paths, are
+    predicted with the action ``unknown``.
+    """
+    if state is None:
+        state = DockerState(dc)
+    simulated = state.copy()
+    actions = []
+    for item in order_list:
+        name, orders = item.items()[0]
+        try:
+            cmd, container = prepare_job(
+                name, dc, global_config, orders, configurations, simulated)
+            action, api_calls = predict_order(container, cmd, orders)
+        except ValueError as e:
+            if name != 'host' and name not in configurations:
+                raise
+            log.debug('Cannot predict the order on {}: {}'.format(name, e))
+            cmd, action, api_calls = orders.get('command'), 'unknown', 0
+        estimate = orders.get('wait', 0)
+        if timings is not None:
+            estimate += timings.estimate(name, action)
+        actions.append({
+            'container': name,
+            'command': cmd,
+            'action': action,
+            'api_calls': api_calls,
+            'estimate': estimate,
+        })
+
+    estimates = [a['estimate'] for a in actions]
+    return {
+        'unitcommand': unitcommand,
+        'configurations': configurations,
+        'order_list': order_list,
+        'actions': actions,
+        # the two snapshot requests are shared by all orders
+        'api_calls': sum(a['api_calls'] for a in actions) + 2,
+        'estimate': sum(estimates),
+        'critical_path': critical_path(
+            order_list, configurations, estimates,
+            build_parents(global_config, configurations)),
+    }
+
+
+def preflight(global_config, configurations, order_list, dc, state=None):
+    """
+    checks the orders of the ``order_list`` before any of them is executed.
+
+    The containers of all orders are set up front, such that missing bind
+    paths of all containers are found.  Bind paths are not required after
+    an ``execute`` order, because it may create them.  Afterwards, the links,
+    images and ports of the containers are checked against the state of the
+    docker daemon (cf. :func:`docker_meta.preflight.check_jobs`).  All
+    problems are reported at once with a
+    :class:`docker_meta.preflight.PreflightError`.
+    """
+    if state is None:
+        state = DockerState(dc)
+    # setting up the containers substitutes their bind paths in place
+    configurations = copy.deepcopy(configurations)
+    problems = []
+    jobs = []
+    executed = False
+    for item in order_list:
+        name, orders = item.items()[0]
+        try:
+            cmd, container = prepare_job(
+                name, dc, global_config, orders, configurations, state)
+        except ValueError as e:
+            c = configurations.get(name)
+            if not (executed and isinstance(c, dict) and
+                    c.get('startup', {}).get('binds')):
+                if str(e) not in problems:
+                    problems.append(str(e))
+                continue
+            log.debug(
+                "Not checking the bind paths of {}, an earlier order may "
+                "create them: {}".format(name, e))
+            c = dict(c, startup=dict(c['startup'], binds={}))
+            cmd, container = prepare_job(
+                name, dc, global_config, orders, {name: c}, state)
+        if cmd == 'execute':
+            executed = True
+        jobs.append((name, cmd, container))
+    problems.extend(check_jobs(jobs, state, dc))
+    if problems:
+        raise PreflightError(problems)
+    log.debug("Checked {} orders before the run".format(len(order_list)))
+
+
+def _pull_container(global_config, dc, state, image, tag):
+    return DockerContainer(
+        dc, image, creation={'image': image, 'tag': tag},
+        startup={}, build={}, global_config=global_config, state=state)
+
+
+def prefetch_images(global_config, configurations, order_list, dc, state):
+    """
+    starts pulling the missing images of the ``order_list`` in the
+    background.
+
+    The images of containers, that are going to be created, are pulled, and
+    for images, that are going to be built, the images they build on.
+    Images built by the run itself are left out.  Returns the
+    :class:`docker_meta.images.Prefetcher`.
+    """
+    built = set(
+        normalize_image(c['build']['tag'])
+        for c in configurations.values()
+        if isinstance(c, dict) and isinstance(c.get('build'), dict) and
+        c['build'].get('tag'))
+    pulls = []
     for item in order_list:
+        name, orders = item.items()[0]
+        c = configurations.get(name)
+        if name == 'host' or not isinstance(c, dict) or (
+                orders.get('command') not in ['build', 'create', 'start']):
+            continue
+        if orders['command'] != 'build' and state.get_container(name):
+            continue
+        build = c.get('build') or {}
+        creation = c.get('creation') or {}
+        if build.get('tag'):
+            if not state.get_image(build['tag']):
+                for image in base_images(global_config, build):
+                    repository, _, tag = image.rpartition(':')
+                    pulls.append((repository, tag))
+        elif creation.get('image') and '@' not in creation['image']:
+            image, tag = creation['image'], creation.get('tag')
+            if not tag:
+                image, _, tag = normalize_image(image).rpartition(':')
+            pulls.append((image, tag))
+
+    prefetcher = Prefetcher()
+    for repository, tag in pulls:
+        image = '{}:{}'.format(repository, tag)
+        if (image in built or image in prefetcher.images or
+                state.get_image(image)):
+            continue
+        prefetcher.start(image, _pull_container(
+            global_config, dc, state, repository, tag).build_image)
+    return prefetcher
+
+
+def bundle_images(global_config, configurations, order_list, dc):
+    """
+    returns the images of the containers in the ``order_list``.  Missing
+    images are built or pulled.
+    """
+    state = DockerState(dc)
+    images = []
+    for item in order_list:
+        name = item.keys()[0]
+        c = configurations.get(name)
+        if name == 'host' or not isinstance(c, dict):
+            continue
+        container = DockerContainer(
+            dc, name, global_config=global_config, state=state,
+            **copy.deepcopy(c))
+        image = container._image_name()
+        if not image:
+            continue
+        if not container.build and container.creation.get('tag'):
+            image = '{}:{}'.format(image, container.creation['tag'])
+        image = normalize_image(image)
+        if image in images:
+            continue
+        if not container.get_image(image):
+            container.build_image()
+        images.append(image)
+    return images
+
 
+def run_configuration(
+        global_config, configurations, order_list, dc,
+        unitcommand='unknown/unknown', jobs=1, timings=None, journal=None,
+        check=False, prefetch=False):
+    """
+    executes the orders of the ``order_list``.
+
+    With ``jobs > 1`` independent orders are executed concurrently on up to
+    ``jobs`` worker threads (cf.
+    :class:`docker_meta.scheduler.OrderScheduler`).  Otherwise, the orders
+    are executed one after the other.
+
+    If ``timings`` is given, the duration of every order is recorded for the
+    action predicted by :func:`make_plan`.
+
+    If a ``journal`` is given, completed orders are recorded in it.  When the
+    journal is resumed, orders completed by the failed run are skipped, if
+    their inputs did not change and their effect is still visible (cf.
+    :mod:`docker_meta.journal`).
+
+    With ``check``, the orders are checked by :func:`preflight` first, and
+    nothing is executed, if any of them would fail.
+
+    With ``prefetch``, missing images are pulled in the background right from
+    the start (cf. :func:`prefetch_images`).
+    """
+
+    # the orders are fingerprinted before anything executes, because
+    # run_job consumes the orders
+    ofingerprints = dict(
+        (id(item), order_fingerprint(
+            index, item.keys()[0], item.values()[0], configurations))
+        for index, item in enumerate(order_list))
+    state = DockerState(dc)
+    if check:
+        preflight(global_config, configurations, order_list, dc, state)
+    actions = {}
+    if timings is not None:
+        plan = make_plan(
+            global_config, configurations, order_list, dc, unitcommand,
+            timings, state)
+        actions = dict(
+            (id(item), a['action'])
+            for item, a in zip(order_list, plan['actions'])
+            if a['action'] != 'unknown')
+
+    indices = dict((id(item), i) for i, item in enumerate(order_list))
+    if journal is not None:
+        journal.open()
+
+    monitor = EventMonitor(dc, state)
+    monitor.start()
+    prefetcher = Prefetcher()
+    if prefetch:
+        prefetcher = prefetch_images(
+            global_config, configurations, order_list, dc, state)
+
+    def _run_item(item):
         name, orders = item.items()[0]
+        index = indices[id(item)]
+        ofingerprint = ofingerprints[id(item)]
         cmd, container = prepare_job(
-            name, dc, global_config, orders, configurations)
-
-        run_job(cmd, container, orders)
+            name, dc, global_config, orders, configurations, state)
 
+        if (journal is not None and
+                journal.can_skip(index, ofingerprint, container, cmd)):
+            log.info('Skipping completed step {} on {}'.format(
+                cmd, container.name))
+        else:
+            if journal is not None:
+                journal.invalidate(index)
+            start = time.time()
+            run_job(cmd, container, orders)
+            if id(item) in actions:
+                timings.record(name, actions[id(item)], time.time() - start)
+        if journal is not None:
+            journal.record(index, name, cmd, ofingerprint)
+
+    scheduler = OrderScheduler(
+        order_list, configurations, jobs,
+        parents=build_parents(global_config, configurations))
+    success = False
+    try:
+        scheduler.run(_run_item)
+        prefetcher.join()
+        success = True
+    finally:
+        monitor.stop()
+        if timings is not None:
+            timings.save()
+        if journal is not None:
+            journal.close(success)
+
+
+def run_configuration_on_hosts(
+        global_config, configurations, order_list, hosts,
+        unitcommand='unknown/unknown', jobs=1, timings=None, resume=False,
+        parallelism=4, check=False, prefetch=False):
+    """
+    executes the orders of the ``order_list`` on several docker daemons.
+
+    ``hosts`` is a list of ``(name, daemon)`` tuples (cf.
+    :func:`docker_meta.fanout.resolve_hosts`).  The configuration is only
+    resolved once, and executed on up to ``parallelism`` hosts concurrently.
+    Every host has its own journal.  After all hosts finished, the result of
+    every host is logged and a RuntimeError is raised, if any of them failed.
+    """
+    def _run_host(name, daemon):
+        journal = Journal.for_config(
+            global_config, '{}@{}'.format(unitcommand, name), resume)
+        # the orders are consumed by run_job
+        run_configuration(
+            global_config, copy.deepcopy(configurations),
+            copy.deepcopy(order_list), get_docker_client(daemon),
+            unitcommand, jobs, timings, journal, check, prefetch)
 
-def prepare_job(name, dc, global_config, orders, configurations):
+    collector = HostLogCollector()
+    log.addHandler(collector)
+    try:
+        results = run_on_hosts(hosts, _run_host, parallelism)
+    finally:
+        log.removeHandler(collector)
+    summarize(results, collector)
+
+
+def run_configuration_placed(
+        global_config, configurations, order_list, hosts,
+        unitcommand='unknown/unknown', jobs=1, timings=None, parallelism=4):
+    """
+    spreads the containers of the ``order_list`` across several docker
+    daemons.
+
+    Every group of linked containers is placed on the daemon with the most
+    free resources (cf. :func:`docker_meta.placement.place_containers`).  The
+    sub-lists of orders for every daemon are executed concurrently, whereas
+    orders on the ``host`` separate them into consecutive phases (cf.
+    :func:`docker_meta.placement.split_orders`).
+    """
+    daemons = dict(hosts)
+    clients = dict(
+        (name, get_docker_client(daemon)) for name, daemon in hosts)
+    resources = dict(
+        (name, host_resources(dc)) for name, dc in clients.items())
+    placement = place_containers(configurations, order_list, resources)
+    for name, daemon in hosts:
+        log.info("Placing {} on {}".format(
+            ', '.join(sorted(
+                c for c, h in placement.items() if h == name)) or 'nothing',
+            daemon))
+
+    for phase in split_orders(order_list, placement):
+        if isinstance(phase, list):
+            run_configuration(
+                global_config, configurations, copy.deepcopy(phase),
+                clients[hosts[0][0]], unitcommand, 1, timings)
+            continue
+
+        def _run_host(name, daemon):
+            run_configuration(
+                global_config, configurations, copy.deepcopy(phase[name]),
+                clients[name], unitcommand, jobs, timings)
+
+        collector = HostLogCollector()
+        log.addHandler(collector)
+        try:
+            results = run_on_hosts(
+                [(name, daemons[name]) for name, _ in hosts
+                 if name in phase], _run_host, parallelism)
+        finally:
+            log.removeHandler(collector)
+        summarize(results, collector)
+
+
+def _service_container(global_config, services, tag, dc, state):
+    return DockerContainer(
+        dc, tag, creation={}, startup={}, build=dict(services[tag]),
+        global_config=global_config, state=state)
+
+
+def plan_services(global_config, services, graph, dc, state=None):
+    """
+    returns the tags of the images in ``services``, that need to be built,
+    because they do not exist, their build context changed or an image they
+    build on is built.
+    """
+    if state is None:
+        state = DockerState(dc)
+    changed = set([])
+    for wave in build_waves(graph):
+        for tag in wave:
+            container = _service_container(
+                global_config, services, tag, dc, state)
+            if graph[tag] & changed or container.plan_build() != 'skip':
+                changed.add(tag)
+    return changed
+
+
+def build_services(global_config, services, graph, dc, jobs=1):
+    """
+    builds the images of ``services`` in the topological order of the
+    ``graph`` (cf. :func:`docker_meta.services.service_graph`).
+
+    Every image is built as soon as the images it builds on are finished, on
+    up to ``jobs`` worker threads.  Only images, that changed, and the images
+    building on them are built.  Returns the tags of the built images.
+    """
+    order_list = [
+        {tag: {'command': 'build'}}
+        for wave in build_waves(graph) for tag in wave]
+    indices = dict(
+        (item.keys()[0], i) for i, item in enumerate(order_list))
+    order_graph = [
+        set(indices[parent] for parent in graph[item.keys()[0]])
+        for item in order_list]
+    state = DockerState(dc)
+    changed = set([])
+
+    def _build(item):
+        tag = item.keys()[0]
+        container = _service_container(
+            global_config, services, tag, dc, state)
+        force = bool(graph[tag] & changed)
+        if force or container.plan_build() != 'skip':
+            changed.add(tag)
+        container.build_image(force)
+
+    OrderScheduler(order_list, {}, jobs, order_graph).run(_build)
+    log.info("Built {} of {} images".format(len(changed), len(order_list)))
+    return changed
+
+
+def prepare_job(
+        name, dc, global_config, orders, configurations, state=None):
     c = configurations.get(name, {})
     if not c and name != 'host':
         raise ValueError(
@@ -563,13 +1490,14 @@ def prepare_job(name, dc, global_config, orders, configurations):
     cmd = orders['command']
 
     container = DockerContainer(
-        dc, name, global_config=global_config, **c)
+        dc, name, global_config=global_config, state=state, **c)
     return cmd, container
 
 
 def run_job(cmd, container, orders):
     timeout = orders.pop('timeout', 10)
     wait_time = orders.pop('wait', 0)
+    ready = orders.pop('ready', None)
 
     log.info('Executing step {} on {}'.format(cmd, container.name))
     if cmd == 'build':
@@ -583,13 +1511,19 @@ def run_job(cmd, container, orders):
     elif cmd == 'restore':
         restore_dir = os.path.abspath(orders.get('restore_dir', '.'))
         restore_name = orders.get('restore_name', 'backup')
-        container.restore(restore_dir, restore_name)
+        snapshot = orders.get('snapshot', None)
+        container.restore(restore_dir, restore_name, snapshot)
     elif cmd == 'backup':
         backup_dir = os.path.abspath(orders.get('backup_dir', '.'))
         source_dir = orders.get('source', None)
         backup_name = orders.get('backup_name', 'backup')
         overwrite = orders.get('overwrite', False)
-        container.backup(source_dir, backup_dir, backup_name, overwrite)
+        compression = orders.get('compression', None)
+        per_volume = orders.get('per_volume', False)
+        incremental = orders.get('incremental', False)
+        container.backup(
+            source_dir, backup_dir, backup_name, overwrite, compression,
+            per_volume, incremental)
     elif cmd == 'stop':
         container.stop(timeout)
     elif cmd == 'remove_image':
@@ -607,6 +1541,8 @@ def run_job(cmd, container, orders):
         raise ValueError(
             "Invalid command {} for container {}".format(cmd, container.name))
 
+    if ready:
+        wait_until_ready(container, ready)
     time.sleep(wait_time)
 
 
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+
+from docker_meta import __name__ as docker_meta_name
+from docker_meta.clients import close_stream
+from docker_meta.fanout import make_thread
+
+
+log = logging.getLogger(docker_meta_name)
+
+
+# maps the actions of the event stream to container states
+EVENT_STATES = {
+    'create': 'created',
+    'start': 'running',
+    'restart': 'running',
+    'unpause': 'running',
+    'pause': 'paused',
+    'die': 'exited',
+    'destroy': 'removed',
+}
+
+
+def parse_event(event):
+    """
+    normalizes container events of old and new docker API versions.
+
+    Returns a tuple ``(id, name, action, exit_code)`` or ``None`` for events,
+    that do not concern containers.
+    """
+    if event.get('Type', 'container') != 'container':
+        return None
+    actor = event.get('Actor', {})
+    attributes = actor.get('Attributes') or {}
+    container_id = actor.get('ID', event.get('id'))
+    action = event.get('Action', event.get('status'))
+    if not container_id or not action:
+        return None
+    exit_code = attributes.get('exitCode')
+    if exit_code is not None:
+        exit_code = int(exit_code)
+    return container_id, attributes.get('name'), action, exit_code
+
+
+class EventMonitor(object):
+    """
+    keeps track of container states by following the daemon's event stream.
+
+    The monitor subscribes once to the ``/events`` endpoint in a background
+    thread and maintains a map from container ids to their state (``created``,
+    ``running``, ``exited``, ...) and their exit code.  If a
+    :class:`docker_meta.state.DockerState` is given, it is updated with every
+    event, and the monitor registers itself as ``state.monitor``.
+
+    If the event stream cannot be read, :attr:`available` is set to ``False``
+    and callers should fall back to regular API calls.  :meth:`stop` closes
+    the event stream and waits for the thread.
+    """
+
+    # seconds to wait for the thread, when the monitor is stopped
+    join_timeout = 5
+
+    def __init__(self, dc, state=None):
+        self.dc = dc
+        self.state = state
+        self.available = False
+        self._containers = {}
+        self._condition = threading.Condition()
+        self._thread = None
+        self._response = None
+        self._stopped = False
+        if state is not None:
+            state.monitor = self
+
+    def start(self):
+        self.available = True
+        since = int(time.time())
+        self._thread = make_thread(
+            self._follow, 'docker-events', args=(since,))
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self.available = False
+            response, self._response = self._response, None
+            self._condition.notify_all()
+        if response is not None:
+            close_stream(self.dc, response)
+        if self._thread is not None:
+            self._thread.join(self.join_timeout)
+
+    def _events(self, since):
+        """
+        returns the streamed response and the decoded events.
+        """
+        if not hasattr(self.dc, '_get'):
+            # clients without the low-level API do not expose the response
+            return None, self.dc.events(since=since, decode=True)
+        response = self.dc._get(
+            self.dc._url('/events'), params={'since': since}, stream=True)
+        return response, self.dc._stream_helper(response, decode=True)
+
+    def _follow(self, since):
+        response = None
+        try:
+            response, events = self._events(since)
+            with self._condition:
+                if self._stopped:
+                    events = []
+                else:
+                    self._response = response
+            for event in events:
+                if self._stopped:
+                    break
+                self.handle(event)
+        except Exception as e:
+            log.debug(
+                "Stopped following the docker event stream: {}".format(e))
+        finally:
+            if response is not None:
+                response.close()
+        with self._condition:
+            self.available = False
+            self._condition.notify_all()
+
+    def handle(self, event):
+        parsed = parse_event(event)
+        if parsed is None:
+            return
+        container_id, name, action, exit_code = parsed
+        status = EVENT_STATES.get(action)
+        if status is None:
+            return
+
+        with self._condition:
+            info = self._containers.setdefault(
+                container_id, {'started': False})
+            info['status'] = status
+            if name:
+                info['name'] = name
+            if status == 'running':
+                info['started'] = True
+                info['exit_code'] = None
+            elif status == 'exited':
+                info['exit_code'] = exit_code
+            self._condition.notify_all()
+
+        if self.state is not None:
+            self.state.container_event(
+                container_id, info.get('name'), status)
+
+    def get(self, container_id):
+        with self._condition:
+            return dict(self._containers.get(container_id, {}))
+
+    def reset(self, container_id):
+        """
+        forgets the state of a container, before it is (re-)started.
+        """
+        with self._condition:
+            self._containers[container_id] = {'started': False}
+
+    def wait_for_exit(self, container_id, timeout=None):
+        """
+        waits until the container exits after its last start.
+
+        Returns the exit code, or ``None`` if it cannot be determined from the
+        event stream within ``timeout`` seconds.
+        """
+        end = timeout is not None and time.time() + timeout or None
+        with self._condition:
+            while True:
+                info = self._containers.get(container_id, {})
+                if info.get('started') and info.get('status') == 'exited':
+                    return info.get('exit_code')
+                if not self.available:
+                    break
+                remaining = end and end - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                # wake up regularly, so that a KeyboardInterrupt gets through
+                self._condition.wait(min(remaining or 1, 1))
+        return None
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
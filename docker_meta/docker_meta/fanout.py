@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import collections
+import logging
+import sys
+import threading
+
+import yaml
+
+from docker_meta import __name__ as docker_meta_name
+
+
+log = logging.getLogger(docker_meta_name)
+
+
+DEFAULT_DAEMON = 'unix://var/run/docker.sock'
+
+
+def read_inventory(filename):
+    """
+    reads a hosts inventory file.
+
+    The file is a YAML list of daemon URLs or a dictionary mapping host names
+    to daemon URLs.  Returns a list of ``(name, daemon)`` tuples.
+    """
+    with open(filename, 'r') as fh:
+        inventory = yaml.safe_load(fh) or []
+    if isinstance(inventory, dict):
+        return sorted(inventory.items())
+    elif isinstance(inventory, list):
+        return [(daemon, daemon) for daemon in inventory]
+    raise ValueError(
+        "The hosts inventory {} needs to be a list or a dictionary."
+        .format(filename))
+
+
+def resolve_hosts(daemons=None, inventory=None):
+    """
+    returns the ``(name, daemon)`` tuples of the daemons given with ``-H``
+    and in the inventory file.
+    """
+    if isinstance(daemons, basestring):
+        daemons = [daemons]
+    hosts = [(daemon, daemon) for daemon in daemons or []]
+    if inventory:
+        hosts += read_inventory(inventory)
+    if not hosts:
+        hosts = [(DEFAULT_DAEMON, DEFAULT_DAEMON)]
+    names = [name for name, _ in hosts]
+    duplicates = sorted(
+        name for name, count in collections.Counter(names).items()
+        if count > 1)
+    if duplicates:
+        raise ValueError(
+            "The hosts {} are given more than once."
+            .format(', '.join(duplicates)))
+    return hosts
+
+
+def current_host():
+    """
+    returns the name of the host, whose unit command is executed in the
+    current thread, or None.
+
+    Threads created with :func:`make_thread` inherit the host of the thread
+    creating them.
+    """
+    return getattr(threading.current_thread(), 'host', None)
+
+
+def make_thread(target, name=None, args=()):
+    """
+    creates a daemon thread, that inherits the host of the current thread.
+    """
+    thread = threading.Thread(target=target, name=name, args=args)
+    thread.daemon = True
+    thread.host = current_host()
+    return thread
+
+
+class HostFilter(logging.Filter):
+    """
+    prefixes the log messages emitted for a host with its name.
+    """
+
+    def filter(self, record):
+        host = current_host()
+        # the record is shared by all handlers, so it is prefixed only once
+        if (host is not None and not getattr(record, 'host', None) and
+                isinstance(record.msg, basestring)):
+            record.host = host
+            record.msg = '[{}] '.format(host) + record.msg
+        return True
+
+
+class HostLogCollector(logging.Handler):
+    """
+    aggregates the warnings and errors logged for every host.
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self, logging.WARNING)
+        self.records = collections.defaultdict(list)
+
+    def emit(self, record):
+        host = current_host()
+        if host is not None:
+            self.records[host].append(record)
+
+
+def run_on_hosts(hosts, job, parallelism=4):
+    """
+    calls ``job(name, daemon)`` for every host on up to ``parallelism``
+    concurrent threads.
+
+    Returns a list of ``(name, exc_info)`` tuples in the order of ``hosts``,
+    where ``exc_info`` is None for successful hosts.
+    """
+    results = dict((name, None) for name, _ in hosts)
+    pending = list(reversed(hosts))
+    lock = threading.Lock()
+
+    def _worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                name, daemon = pending.pop()
+            threading.current_thread().host = name
+            try:
+                job(name, daemon)
+            except BaseException:
+                results[name] = sys.exc_info()
+                log.error(
+                    "Failed to run on {}".format(daemon), exc_info=1)
+
+    nworkers = max(1, min(parallelism, len(hosts)))
+    threads = [
+        make_thread(_worker, 'host-worker-{}'.format(n))
+        for n in range(nworkers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        # join with a timeout, so that a KeyboardInterrupt gets through
+        while thread.is_alive():
+            thread.join(0.5)
+
+    return [(name, results[name]) for name, _ in hosts]
+
+
+def summarize(results, collector=None):
+    """
+    logs the result of every host and raises a RuntimeError, if any of the
+    hosts failed.
+    """
+    failed = []
+    for name, exc_info in results:
+        records = collector.records.get(name, []) if collector else []
+        warnings = len([r for r in records if r.levelno == logging.WARNING])
+        if exc_info is None:
+            log.info("{}: succeeded ({} warnings)".format(name, warnings))
+        else:
+            failed.append(name)
+            log.info("{}: failed with {}: {} ({} warnings)".format(
+                name, exc_info[0].__name__, exc_info[1], warnings))
+    if failed:
+        raise RuntimeError(
+            "The unit command failed on {} of {} hosts: {}".format(
+                len(failed), len(results), ', '.join(failed)))
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
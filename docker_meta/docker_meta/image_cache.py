@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from docker_meta import __name__ as docker_meta_name
+from docker_meta.preflight import inspect_distribution
+from docker_meta.services import normalize_image
+from docker_meta.utils import FINGERPRINT_LABEL
+
+
+log = logging.getLogger(docker_meta_name)
+
+INDEX_FILE = 'index.json'
+
+_size = re.compile(r'^\s*(\d+(?:\.\d*)?)\s*([kmgt]?)i?b?\s*$', re.I)
+
+
+def parse_size(size):
+    """
+    converts sizes like ``10G`` or ``500M`` to bytes.
+    """
+    match = _size.match(str(size))
+    if not match:
+        raise ValueError("Invalid size {}".format(size))
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** ' kmgt'.index(unit.lower() or ' '))
+
+
+def registry_digest(dc, image):
+    """
+    returns the digest of the manifest of ``image`` in its registry, or
+    ``None`` if the registry cannot be asked.
+    """
+    try:
+        return inspect_distribution(dc, image)['Descriptor']['digest']
+    except Exception as e:
+        log.debug(
+            "Could not ask the registry for the digest of {}: {}"
+            .format(image, e))
+        return None
+
+
+class ImageCache(object):
+    """
+    keeps tarballs of images in the ``directory``, such that they can be
+    loaded instead of pulled or built again, e.g. on freshly set up CI
+    runners.
+
+    The tarballs are named after the image ids.  An index maps them to the
+    tags and repository digests of the images and to the fingerprint labels
+    of built images.  If the tarballs get larger than ``max_size`` bytes,
+    the least recently used ones are removed.  The cache is only used, if
+    ``max_size`` is set.
+    """
+
+    def __init__(self, directory=None, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.directory and self.max_size)
+
+    def _filename(self, image_id):
+        return os.path.join(
+            self.directory, '{}.tar'.format(image_id.replace(':', '-')))
+
+    def _load(self):
+        filename = os.path.join(self.directory, INDEX_FILE)
+        if os.path.exists(filename):
+            try:
+                with open(filename, 'r') as fh:
+                    return json.load(fh)
+            except (IOError, ValueError) as e:
+                log.debug(
+                    "Ignoring the invalid image cache index {}: {}"
+                    .format(filename, e))
+        return {}
+
+    def _save(self, entries):
+        filename = os.path.join(self.directory, INDEX_FILE)
+        tmpname = filename + '.tmp'
+        with open(tmpname, 'w') as fh:
+            json.dump(entries, fh, indent=1, sort_keys=True)
+        os.rename(tmpname, filename)
+
+    def entries(self):
+        """
+        returns the index of the cache mapping image ids to their ``tags``,
+        ``digests``, ``fingerprint``, ``size`` and last ``used`` time.
+        """
+        if not self.directory:
+            return {}
+        with self._lock:
+            return self._load()
+
+    def lookup(self, image, digest=None, fingerprint=None):
+        """
+        returns the id of the cached image tagged with ``image``.
+
+        With the registry ``digest``, the image has to be the one in the
+        registry.  With a ``fingerprint``, the fingerprint label of the image
+        has to match it.
+        """
+        image = normalize_image(image)
+        repository = image.rpartition(':')[0]
+        for image_id, entry in sorted(
+                self.entries().items(), key=lambda e: -e[1]['used']):
+            if not os.path.exists(self._filename(image_id)):
+                continue
+            if digest is not None:
+                if '{}@{}'.format(repository, digest) in entry['digests']:
+                    return image_id
+            elif image in entry['tags'] and (
+                    fingerprint is None or
+                    entry.get('fingerprint') == fingerprint):
+                return image_id
+        return None
+
+    def load(self, dc, image, fingerprint=None):
+        """
+        loads the cached image tagged with ``image`` into the docker daemon.
+
+        If the registry of the image can be asked, only the image with its
+        current digest is loaded.  Returns ``True``, if the image has been
+        loaded.
+        """
+        if not self.enabled:
+            return False
+        image = normalize_image(image)
+        digest = None
+        if fingerprint is None:
+            digest = registry_digest(dc, image)
+        image_id = self.lookup(image, digest, fingerprint)
+        if image_id is None:
+            return False
+        log.info("Loading the image {} from the image cache".format(image))
+        with open(self._filename(image_id), 'rb') as fh:
+            dc.load_image(fh)
+        repository, _, tag = image.rpartition(':')
+        dc.tag(image_id, repository, tag, force=True)
+        with self._lock:
+            entries = self._load()
+            if image_id in entries:
+                entries[image_id]['used'] = time.time()
+                self._save(entries)
+        return True
+
+    def save(self, dc, image):
+        """
+        stores the image tagged with ``image`` in the cache, unless its id is
+        cached already.
+        """
+        if not self.enabled:
+            return
+        image = normalize_image(image)
+        info = dc.inspect_image(image)
+        image_id = info['Id']
+        filename = self._filename(image_id)
+        tmpname = None
+        if not os.path.exists(filename):
+            log.info("Saving the image {} in the image cache".format(image))
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            tmpname = '{}.{}.tmp'.format(
+                filename, threading.current_thread().ident)
+            with open(tmpname, 'wb') as fh:
+                stream = dc.get_image(image)
+                for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+                    fh.write(chunk)
+        labels = (info.get('Config') or {}).get('Labels') or {}
+        with self._lock:
+            if tmpname and os.path.exists(filename):
+                # saved by another thread in the meantime
+                os.remove(tmpname)
+            elif tmpname:
+                os.rename(tmpname, filename)
+            entries = self._load()
+            entry = entries.setdefault(image_id, {'tags': [], 'digests': []})
+            entry['tags'] = sorted(set(
+                entry['tags'] + [image] + (info.get('RepoTags') or [])))
+            entry['digests'] = sorted(set(
+                entry['digests'] + (info.get('RepoDigests') or [])))
+            entry['fingerprint'] = labels.get(FINGERPRINT_LABEL)
+            entry['size'] = os.path.getsize(filename)
+            entry['used'] = time.time()
+            # a tag only refers to the latest image
+            for other_id, other in entries.items():
+                if other_id != image_id:
+                    other['tags'] = [
+                        t for t in other['tags'] if t not in entry['tags']]
+            self._save(entries)
+        self.gc()
+
+    def gc(self, max_size=None):
+        """
+        removes the least recently used images, until the cache is smaller
+        than ``max_size`` bytes, as well as files not in the index.  Returns
+        the ids of the removed images.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        if not self.directory or not os.path.exists(self.directory):
+            return []
+        removed = []
+        with self._lock:
+            entries = self._load()
+            for image_id, entry in entries.items():
+                if not os.path.exists(self._filename(image_id)):
+                    del entries[image_id]
+            total = sum(entry['size'] for entry in entries.values())
+            for image_id, entry in sorted(
+                    entries.items(), key=lambda e: e[1]['used']):
+                if max_size is None or total <= max_size:
+                    break
+                os.remove(self._filename(image_id))
+                total -= entry['size']
+                del entries[image_id]
+                removed.append(image_id)
+                log.info(
+                    "Removed the image {} from the image cache"
+                    .format(', '.join(entry['tags']) or image_id))
+            known = set(
+                os.path.basename(self._filename(i)) for i in entries)
+            for name in os.listdir(self.directory):
+                if name.endswith('.tar') and name not in known:
+                    os.remove(os.path.join(self.directory, name))
+            self._save(entries)
+        return removed
+
+
+default_image_cache = ImageCache()
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
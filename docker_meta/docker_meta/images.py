@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import logging
+import threading
+
+from docker_meta import __name__ as docker_meta_name
+from docker_meta.fanout import make_thread
+
+
+log = logging.getLogger(docker_meta_name)
+
+
+class TransferLimits(object):
+    """
+    bounds the number of images built and pulled concurrently on every docker
+    daemon.
+
+    Builds are limited by the CPUs of the daemon and pulls by its network
+    connection, so that both have separate limits.  Transfers of the same
+    image on the same daemon are serialized, such that the image is only built
+    or pulled once, if several containers need it.
+    """
+
+    def __init__(self, builds=2, pulls=4):
+        self._lock = threading.Lock()
+        self._semaphores = {}
+        self._images = {}
+        self.configure(builds, pulls)
+
+    def configure(self, builds=None, pulls=None):
+        """
+        changes the limits for transfers started afterwards.
+        """
+        with self._lock:
+            if builds is not None:
+                self.builds = max(builds, 1)
+            if pulls is not None:
+                self.pulls = max(pulls, 1)
+            self._semaphores = {}
+
+    def _get(self, kind, daemon, image):
+        with self._lock:
+            key = (kind, daemon)
+            if key not in self._semaphores:
+                limit = self.builds if kind == 'build' else self.pulls
+                self._semaphores[key] = threading.BoundedSemaphore(limit)
+            lock = self._images.setdefault((daemon, image), threading.Lock())
+            return self._semaphores[key], lock
+
+    @contextlib.contextmanager
+    def transfer(self, kind, daemon, image):
+        """
+        waits until the image may be built (``kind == 'build'``) or pulled on
+        the daemon.
+        """
+        semaphore, lock = self._get(kind, daemon, image)
+        with lock:
+            if not semaphore.acquire(False):
+                log.debug(
+                    "Waiting for a free {} slot for image {}"
+                    .format(kind, image))
+                semaphore.acquire()
+            try:
+                yield
+            finally:
+                semaphore.release()
+
+
+default_limits = TransferLimits()
+
+
+class Prefetcher(object):
+    """
+    transfers images in the background, while the orders of a run are
+    executed.
+
+    Every transfer runs in its own daemon thread (cf.
+    :func:`docker_meta.fanout.make_thread`), such that a failed run does not
+    wait for them, and its log messages carry the host of the run.  The
+    transfers should be limited by :data:`default_limits` like the transfers
+    of the orders, such that an order needing an image, that is still being
+    transferred, waits for the transfer to finish.  Errors are only logged,
+    because the order needing the image tries again and reports the error.
+    """
+
+    def __init__(self):
+        self.images = []
+        self._threads = []
+
+    def _run(self, image, transfer):
+        try:
+            transfer()
+        except Exception as e:
+            log.warn("Could not prefetch the image {}: {}".format(image, e))
+
+    def start(self, image, transfer):
+        """
+        calls ``transfer`` to fetch the ``image`` in a new thread.
+        """
+        log.debug("Prefetching the image {}".format(image))
+        thread = make_thread(
+            self._run, 'prefetch {}'.format(image), (image, transfer))
+        thread.start()
+        self.images.append(image)
+        self._threads.append(thread)
+
+    def join(self):
+        """
+        waits until all transfers are finished.
+        """
+        for thread in self._threads:
+            thread.join()
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import re
+import threading
+
+from docker_meta import __name__ as docker_meta_name
+from docker_meta.utils import fingerprint
+
+
+log = logging.getLogger(docker_meta_name)
+
+
+def order_fingerprint(index, name, orders, configurations):
+    """
+    computes the fingerprint of the inputs of an order, i.e. its position in
+    the order list, its arguments and the configuration of its container.
+    """
+    return fingerprint(index, name, orders, configurations.get(name, {}))
+
+
+def verify_order(container, cmd):
+    """
+    checks that the effect of a completed order is still visible on the
+    docker daemon.
+
+    Orders without a verifiable effect (``execute``, ``backup`` and
+    ``restore``) are trusted.
+    """
+    if cmd == 'build':
+        return bool(container.get_image())
+    elif cmd == 'create':
+        return bool(container.get_container())
+    elif cmd == 'start':
+        return container.is_started()
+    elif cmd == 'stop':
+        return not container.get_container() or not container.is_started()
+    elif cmd == 'remove':
+        return not container.get_container()
+    elif cmd == 'remove_image':
+        return not container.get_image()
+    return True
+
+
+class Journal(object):
+    """
+    records the completed orders of a run in a file, so that a failed run can
+    be resumed at the failure point.
+
+    An order is skipped, if it is completed with the same fingerprint and
+    either a later order on the same container was completed, too, or its
+    effect is still visible (cf. :func:`verify_order`).
+
+    Every line of the journal file is a JSON object with the index, the
+    container name, the command and the fingerprint of a completed order
+    (cf. :func:`order_fingerprint`).  The journal is removed after a
+    successful run.
+
+    A resumed run keeps the entries of the failed run, until they are
+    superseded by a new entry for the same order.  The entry of an order,
+    that is executed again, is invalidated before the order starts.
+    """
+
+    def __init__(self, filename, resume=False):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._fh = None
+        self._resumable = {}
+        if resume and os.path.exists(filename):
+            with open(filename, 'r') as fh:
+                for line in fh:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line might be cut off by a crash
+                        continue
+                    if entry.get('fingerprint') is None:
+                        self._resumable.pop(entry['index'], None)
+                    else:
+                        self._resumable[entry['index']] = entry
+        if resume and not self._resumable:
+            log.info('There is no failed run of {} to resume.'.format(
+                filename))
+
+    @classmethod
+    def for_config(cls, global_config, unitcommand, resume=False):
+        name = re.sub(r'[^\w.-]', '_', unitcommand)
+        return cls(
+            os.path.join(
+                global_config.basedir, 'journal', '{}.jsonl'.format(name)),
+            resume)
+
+    def open(self):
+        dirname = os.path.dirname(self.filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmpname = self.filename + '.tmp'
+        with open(tmpname, 'w') as fh:
+            for _, entry in sorted(self._resumable.items()):
+                fh.write(json.dumps(entry) + '\n')
+        os.rename(tmpname, self.filename)
+        self._fh = open(self.filename, 'a')
+
+    def close(self, success):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        if success and os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def is_completed(self, index, order_fingerprint):
+        entry = self._resumable.get(index, {})
+        return entry.get('fingerprint') == order_fingerprint
+
+    def is_last(self, index, name):
+        """
+        checks if ``index`` is the last completed order on the container
+        ``name``.  Only the effects of the last orders can be verified.
+        """
+        return index == max(
+            i for i, entry in self._resumable.items()
+            if entry['container'] == name)
+
+    def can_skip(self, index, order_fingerprint, container, cmd):
+        return self.is_completed(index, order_fingerprint) and (
+            not self.is_last(index, container.name) or
+            verify_order(container, cmd))
+
+    def record(self, index, name, cmd, order_fingerprint):
+        self._write({
+            'index': index,
+            'container': name,
+            'command': cmd,
+            'fingerprint': order_fingerprint})
+
+    def invalidate(self, index):
+        """
+        drops the entry of the failed run for the order ``index``, which is
+        executed again.
+        """
+        if index in self._resumable:
+            self._write({'index': index, 'fingerprint': None})
+
+    def _write(self, entry):
+        entry = json.dumps(entry)
+        with self._lock:
+            self._fh.write(entry + '\n')
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
@@ -3,19 +3,103 @@ import logging.config
 import sys
 from StringIO import StringIO
 
+from docker_meta.fanout import HostFilter
+
 test_streams = {}
 default_config = {}
 
 
+class PullProgress(object):
+    """
+    the progress of pulling one image, which consists of several layers.
+    """
+
+    def __init__(self):
+        self.last_status = ''
+        self.skipped_messages = 0
+        self.layers = {}
+        self.reported = {}
+
+    def update(self, status, layer, detail):
+        """
+        records the progress of a layer and returns the percentage of the
+        bytes of all layers, that have the same status.
+        """
+        self.layers[(status, layer)] = (detail['current'], detail['total'])
+        current = total = 0
+        for (s, _), (c, t) in self.layers.items():
+            if s == status:
+                current += c
+                total += t
+        return 100 * current // total, total
+
+    def report(self, status, percent, step):
+        """
+        returns True, if the ``percent`` reached the next ``step``.
+        """
+        last = self.reported.get(status)
+        if last is not None and percent // step == last // step:
+            return False
+        self.reported[status] = percent
+        return True
+
+
+def _format_bytes(size):
+    size = float(size)
+    for unit in ['B', 'KB', 'MB']:
+        if size < 1024:
+            return '{:.1f} {}'.format(size, unit)
+        size /= 1024
+    return '{:.1f} GB'.format(size)
+
+
 class OutputFilter(logging.Filter):
     """
     filters and prettifies the output generated by several docker commands
+
+    The output of builds and pulls, that are executed concurrently, is
+    prefixed with the name of the image.  The progress of the layers of a
+    pulled image is aggregated into one percentage per image.
     """
 
     def __init__(self, verbosity):
         self.verbosity = verbosity
-        self.last_pull_status = ''
-        self.skipped_pull_messages = 0
+        self.pulls = {}
+
+    def _filter_pull(self, record, md):
+        image = getattr(record, 'image', None)
+        progress = self.pulls.setdefault(image, PullProgress())
+        status = md.get('status', None)
+        if status is None:
+            return False
+
+        detail = md.get('progressDetail')
+        if (image and md.get('id') and isinstance(detail, dict)
+                and detail.get('total')):
+            percent, total = progress.update(status, md['id'], detail)
+            if self.verbosity < 3:
+                step = 10 if self.verbosity == 1 else 2
+                if not progress.report(status, percent, step):
+                    return False
+            record.msg = '{}: {}% of {}'.format(
+                status, percent, _format_bytes(total))
+            return True
+
+        if progress.last_status == status:
+            if self.verbosity == 1:
+                return False
+            elif self.verbosity == 2:
+                progress.skipped_messages += 1
+                if progress.skipped_messages % 20 != 0:
+                    return False
+
+            record.msg = repr(md.get('progressDetail', {}))
+
+        progress.last_status = status
+        out = {'id': '', 'status': '', 'progressDetail': ''}
+        out.update(md)
+        record.msg = '({id}) {status}: {progressDetail}'.format(**out)
+        return True
 
     def filter(self, record):
         if hasattr(record, 'type') and record.type == 'output':
@@ -46,24 +130,15 @@ class OutputFilter(logging.Filter):
                     md = json.loads(msg)
                 except:
                     return False
-                status = md.get('status', None)
-                if status is None:
+                if not self._filter_pull(record, md):
                     return False
 
-                if self.last_pull_status == status:
-                    if self.verbosity == 1:
-                        return False
-                    elif self.verbosity == 2:
-                        self.skipped_pull_messages += 1
-                        if self.skipped_pull_messages % 20 != 0:
-                            return False
-
-                    record.msg = repr(md.get('progressDetail', {}))
-
-                self.last_pull_status = status
-                out = {'id': '', 'status': '', 'progressDetail': ''}
-                out.update(md)
-                record.msg = '({id}) {status}: {progressDetail}'.format(**out)
+            image = getattr(record, 'image', None)
+            if image and record.cmd in ['build', 'pull']:
+                record.msg = record.msg.strip()
+                if not record.msg:
+                    return False
+                record.msg = '[{}] {}'.format(image, record.msg)
 
         record.msg = record.msg.strip()
         return True
@@ -105,7 +180,10 @@ def _get_logger_configuration(
             'output_filter': {
                 '()': OutputFilter,
                 'verbosity': verbosity,
-            }
+            },
+            'host_filter': {
+                '()': HostFilter,
+            },
         },
         'handlers': {
             'null': {
@@ -143,7 +221,7 @@ def _update_handlers(config, stream_configs, handlers):
                 name: {
                     'level': 'DEBUG',
                     'formatter': 'default',
-                    'filters': ['info_only', 'output_filter'],
+                    'filters': ['info_only', 'output_filter', 'host_filter'],
                     }
             }
         elif typ == 'error':
@@ -151,6 +229,7 @@ def _update_handlers(config, stream_configs, handlers):
                 name: {
                     'level': 'WARNING',
                     'formatter': 'errors',
+                    'filters': ['host_filter'],
                     }
             }
         tc[name].update(sc)
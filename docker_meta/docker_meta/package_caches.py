@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import re
+import socket
+import threading
+import time
+
+from docker_meta import __name__ as docker_meta_name
+from docker_meta.probes import daemon_host
+
+
+log = logging.getLogger(docker_meta_name)
+
+# package caches, that are recognized by the name, image or build tag of a
+# container, with the port they listen on inside the container
+CACHES = {
+    'apt': {'marker': 'apt-cacher-ng', 'port': 3142},
+    'pypi': {'marker': 'pypicloud', 'port': 3031},
+}
+
+# build arguments, that docker accepts without an ARG instruction
+PREDEFINED_ARGS = [
+    'http_proxy', 'HTTP_PROXY', 'https_proxy', 'HTTPS_PROXY', 'ftp_proxy',
+    'FTP_PROXY', 'no_proxy', 'NO_PROXY']
+
+_arg_line = re.compile(r'^\s*ARG\s+([A-Za-z_][A-Za-z0-9_]*)', re.I)
+
+
+def dockerfile_args(path, dockerfile=None):
+    """
+    returns the names of the build arguments declared in the Dockerfile in
+    ``path``.
+    """
+    filename = os.path.join(path, dockerfile or 'Dockerfile')
+    if not os.path.exists(filename):
+        return set([])
+    with open(filename, 'r') as fh:
+        return set(
+            match.group(1) for match in map(_arg_line.match, fh) if match)
+
+
+def find_caches(configurations):
+    """
+    returns the names of the containers in ``configurations`` running
+    package caches mapped to the kind of cache and its port.
+    """
+    res = {}
+    for name, c in sorted(configurations.items()):
+        if not isinstance(c, dict):
+            continue
+        names = [
+            name, (c.get('creation') or {}).get('image') or '',
+            (c.get('build') or {}).get('tag') or '']
+        for kind, cache in sorted(CACHES.items()):
+            if any(cache['marker'] in n for n in names):
+                res[name] = (kind, cache['port'])
+    return res
+
+
+# host names of docker daemons, whose containers can be connected to
+LOCAL_HOSTS = ['localhost', '127.0.0.1', '::1']
+
+
+def _reachable(address, port, timeout):
+    try:
+        socket.create_connection((address, port), timeout).close()
+        return True
+    except (socket.error, socket.timeout):
+        return False
+
+
+class PackageCaches(object):
+    """
+    injects the addresses of running apt and pypi caches into the build
+    arguments of images, such that packages are not downloaded again for
+    every build.
+
+    The caches are looked up among the containers of the unit configuration
+    for every docker daemon, and only used, if their containers are running
+    and, for local daemons, accept connections.  The containers of remote
+    daemons cannot be connected to from here, so that their caches are used,
+    as soon as they are running.  Available caches are remembered, while
+    missing ones are probed again after ``retry`` seconds, such that caches
+    started by the run are used by later builds.  The apt cache is passed as
+    the predefined build argument ``http_proxy``.  The pypi cache is passed
+    as ``PIP_INDEX_URL`` and ``PIP_TRUSTED_HOST``, if the Dockerfile declares
+    them with ``ARG`` instructions.
+    """
+
+    timeout = 1
+    retry = 10
+
+    def __init__(self):
+        self.enabled = False
+        self.configurations = {}
+        self._lock = threading.Lock()
+        self._found = {}
+        self._probed = {}
+
+    def configure(self, enabled, configurations=None):
+        with self._lock:
+            self.enabled = enabled
+            self.configurations = configurations or {}
+            self._found = {}
+            self._probed = {}
+
+    def _address(self, dc, name):
+        try:
+            info = dc.inspect_container(name)
+        except Exception as e:
+            log.debug("Could not inspect the cache {}: {}".format(name, e))
+            return None
+        if not (info.get('State') or {}).get('Running'):
+            return None
+        settings = info.get('NetworkSettings') or {}
+        if settings.get('IPAddress'):
+            return settings['IPAddress']
+        for network in (settings.get('Networks') or {}).values():
+            if network.get('IPAddress'):
+                return network['IPAddress']
+        return None
+
+    def _detect(self, dc, daemon):
+        """
+        probes the caches of the ``daemon``, that are not known to be
+        available and were not probed within the last ``retry`` seconds.
+        """
+        now = time.time()
+        with self._lock:
+            found = self._found.setdefault(daemon, {})
+            probes = []
+            for name, (kind, port) in sorted(
+                    find_caches(self.configurations).items()):
+                probed = self._probed.get((daemon, name))
+                if name in found or (
+                        probed is not None and now < probed + self.retry):
+                    continue
+                # concurrent builds do not probe the same cache again
+                self._probed[(daemon, name)] = now
+                probes.append((name, kind, port, probed is None))
+
+        # the probes wait for timeouts, so that they run without the lock
+        local = daemon_host(dc) in LOCAL_HOSTS
+        for name, kind, port, first in probes:
+            address = self._address(dc, name)
+            if not address or (
+                    local and not _reachable(address, port, self.timeout)):
+                if first:
+                    log.info(
+                        "The package cache {} is not available.  Building "
+                        "without it.".format(name))
+                continue
+            log.info(
+                "Using the package cache {} at {}:{} for builds".format(
+                    name, address, port))
+            with self._lock:
+                found[name] = (kind, address, port)
+        with self._lock:
+            return found.values()
+
+    def build_args(self, dc, declared=()):
+        """
+        returns the build arguments for the running caches, that are
+        predefined or ``declared`` by the Dockerfile.
+        """
+        if not self.enabled:
+            return {}
+        args = {}
+        for kind, address, port in sorted(
+                self._detect(dc, getattr(dc, 'base_url', None))):
+            if kind == 'apt':
+                args['http_proxy'] = 'http://{}:{}'.format(address, port)
+            elif kind == 'pypi':
+                args['PIP_INDEX_URL'] = 'http://{}:{}/simple/'.format(
+                    address, port)
+                args['PIP_TRUSTED_HOST'] = address
+        return dict(
+            (k, v) for k, v in args.items()
+            if k in PREDEFINED_ARGS or k in declared)
+
+
+default_package_caches = PackageCaches()
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from docker.utils import parse_bytes
+
+from docker_meta import __name__ as docker_meta_name
+from docker_meta.scheduler import container_dependencies
+
+
+log = logging.getLogger(docker_meta_name)
+
+
+# assumed demands of containers without a ``mem_limit`` or ``cpu_shares``
+# and of the containers already running on a daemon
+DEFAULT_MEMORY = 256 * 1024 * 1024
+DEFAULT_CPUS = 0.5
+
+
+def host_resources(dc):
+    """
+    returns the free memory in bytes and the free number of CPUs of a docker
+    daemon, as reported by its ``info`` endpoint.
+
+    The containers already running on the daemon are assumed to use the
+    default demands.
+    """
+    info = dc.info()
+    running = info.get('ContainersRunning', info.get('Containers', 0))
+    return {
+        'memory': info.get('MemTotal', 0) - running * DEFAULT_MEMORY,
+        'cpus': info.get('NCPU', 0) - running * DEFAULT_CPUS,
+    }
+
+
+def container_demand(config):
+    """
+    returns the memory and CPU demand of a container configuration, as
+    specified with ``mem_limit`` and ``cpu_shares`` (1024 shares count as one
+    CPU).
+    """
+    creation = config.get('creation', {})
+    memory = creation.get('mem_limit')
+    if isinstance(memory, basestring):
+        memory = parse_bytes(memory)
+    cpu_shares = creation.get('cpu_shares')
+    return {
+        'memory': memory or DEFAULT_MEMORY,
+        'cpus': cpu_shares and cpu_shares / 1024. or DEFAULT_CPUS,
+    }
+
+
+def container_groups(configurations, order_list):
+    """
+    returns the groups of the containers in the ``order_list``, that are
+    connected via ``links`` or ``volumes_from`` and need to run on the same
+    daemon.
+
+    The groups are sorted by the first order on one of their containers.
+    """
+    names = []
+    for item in order_list:
+        name = item.keys()[0]
+        if name in configurations and name not in names:
+            names.append(name)
+
+    group_of = dict((name, set([name])) for name in names)
+    for name in names:
+        for other in container_dependencies(configurations[name]):
+            if other not in group_of or group_of[other] is group_of[name]:
+                continue
+            merged = group_of[name] | group_of[other]
+            for member in merged:
+                group_of[member] = merged
+
+    groups = []
+    for name in names:
+        if group_of[name] not in groups:
+            groups.append(group_of[name])
+    return [sorted(group, key=names.index) for group in groups]
+
+
+def place_containers(configurations, order_list, resources):
+    """
+    assigns every container of the ``order_list`` to a host.
+
+    ``resources`` maps host names to their free resources (cf.
+    :func:`host_resources`).  The groups of linked containers (cf.
+    :func:`container_groups`) are placed one after the other, the group with
+    the largest memory demand first, on the host with the most free memory.
+    Ties are broken by the number of free CPUs and the host name.
+
+    Returns a dictionary mapping container names to host names.
+    """
+    if not resources:
+        raise ValueError("Cannot place containers without any hosts.")
+
+    free = dict((host, dict(r)) for host, r in resources.items())
+    groups = []
+    for group in container_groups(configurations, order_list):
+        demands = [container_demand(configurations[n]) for n in group]
+        groups.append((
+            sum(d['memory'] for d in demands),
+            sum(d['cpus'] for d in demands),
+            group))
+    groups.sort(key=lambda g: (-g[0], -g[1]))
+
+    placement = {}
+    for memory, cpus, group in groups:
+        host = max(
+            sorted(free), key=lambda h: (free[h]['memory'], free[h]['cpus']))
+        if free[host]['memory'] < memory:
+            log.warn(
+                "Host {} does not have enough free memory for the "
+                "containers {}".format(host, ', '.join(group)))
+        free[host]['memory'] -= memory
+        free[host]['cpus'] -= cpus
+        for name in group:
+            placement[name] = host
+    return placement
+
+
+def split_orders(order_list, placement):
+    """
+    splits the ``order_list`` into phases, that are executed one after the
+    other.
+
+    A phase is either a dictionary mapping host names to their sub-lists of
+    orders, or a list with a single order, that is not placed on any host,
+    like an ``execute`` order on the ``host``.  The relative order of the
+    orders is kept within every sub-list.
+    """
+    phases = []
+    current = {}
+    for item in order_list:
+        name = item.keys()[0]
+        if name in placement:
+            current.setdefault(placement[name], []).append(item)
+        else:
+            if current:
+                phases.append(current)
+                current = {}
+            phases.append([item])
+    if current:
+        phases.append(current)
+    return phases
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
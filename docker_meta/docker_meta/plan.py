@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import threading
+
+import yaml
+
+from docker_meta import __name__ as docker_meta_name
+from docker_meta.scheduler import build_order_graph
+from docker_meta.utils import FINGERPRINT_LABEL
+
+
+log = logging.getLogger(docker_meta_name)
+
+
+# estimated durations in seconds for actions without recorded timings
+DEFAULT_DURATIONS = {
+    'no-op': 0.,
+    'pull': 30.,
+    'build': 60.,
+    'rebuild': 60.,
+    'create': 1.,
+    'recreate': 3.,
+    'start': 2.,
+    'restart': 5.,
+    'attach': 10.,
+    'stop': 5.,
+    'remove': 1.,
+    'remove_image': 1.,
+    'backup': 30.,
+    'restore': 30.,
+    'execute': 5.,
+}
+
+
+class Timings(object):
+    """
+    records the durations of the executed actions in a YAML file.
+
+    The estimate for an action on a container is the mean of its last
+    ``keep`` recorded durations.
+    """
+
+    keep = 5
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._timings = {}
+        if os.path.exists(filename):
+            with open(filename, 'r') as fh:
+                self._timings = yaml.safe_load(fh) or {}
+
+    @classmethod
+    def for_config(cls, global_config):
+        return cls(os.path.join(global_config.basedir, 'timings.yaml'))
+
+    def record(self, name, action, seconds):
+        with self._lock:
+            samples = self._timings.setdefault(name, {}).setdefault(
+                action, [])
+            samples.append(round(seconds, 3))
+            del samples[:-self.keep]
+
+    def estimate(self, name, action):
+        with self._lock:
+            samples = self._timings.get(name, {}).get(action)
+        if samples:
+            return sum(samples) / len(samples)
+        return sum(
+            DEFAULT_DURATIONS.get(part, 0.) for part in action.split('+'))
+
+    def save(self):
+        with self._lock:
+            with open(self.filename, 'w') as fh:
+                yaml.safe_dump(self._timings, fh, default_flow_style=False)
+
+
+def _predict_image(container):
+    """
+    predicts the build or pull of a missing image, which is triggered by the
+    creation of a container.
+    """
+    if container.get_image():
+        return [], 0
+    action = container.plan_build()
+    image = container.build.get('tag', container.creation.get('image'))
+    if image:
+        container.state.image_added(image)
+    return [action], 1
+
+
+def _predict_create(container):
+    plan = container.plan_create()
+    if plan == 'skip':
+        return [], 0
+    if plan == 'recreate':
+        actions, calls = ['recreate'], 3 + int(container.is_started())
+    else:
+        actions, calls = ['create'], 1
+    image_actions, image_calls = _predict_image(container)
+    if image_actions:
+        # the first creation attempt fails with 'No such image'
+        calls += image_calls + 1
+    image = container.build.get('tag', container.creation.get('image'))
+    container.state.container_created(
+        container.name, 'planned', image,
+        {FINGERPRINT_LABEL: container.container_fingerprint()})
+    return image_actions + actions, calls
+
+
+def predict_order(container, cmd, orders):
+    """
+    predicts the actions, that an order is going to execute and the number
+    of docker API calls they need.
+
+    The predicted effects of the order are applied to ``container.state``, so
+    that the following orders are predicted correctly.  Therefore, the state
+    should be a copy of the real snapshot (cf.
+    :meth:`docker_meta.state.DockerState.copy`).
+
+    Returns a tuple ``(action, api_calls)``, where ``action`` consists of the
+    predicted actions joined with ``+`` or is ``no-op``.
+    """
+    state = container.state
+    actions, calls = [], 0
+    if cmd == 'build':
+        action = container.plan_build()
+        if action != 'skip':
+            actions, calls = [action], 1
+            image = container.build.get(
+                'tag', container.creation.get('image'))
+            state.image_added(image, {
+                FINGERPRINT_LABEL: container.image_fingerprint()})
+    elif cmd == 'create':
+        actions, calls = _predict_create(container)
+    elif cmd == 'start':
+        actions, calls = _predict_create(container)
+        if 'create' in actions or 'recreate' in actions:
+            actions.append('start')
+            calls += 1
+        elif orders.get('restart', False):
+            actions, calls = ['restart'], 1
+        elif not container.is_started():
+            actions, calls = ['start'], 1
+        if orders.get('attach', False):
+            actions.append('attach')
+            calls += 2
+        if actions:
+            state.container_started(container.name)
+    elif cmd == 'stop':
+        if container.is_started():
+            actions, calls = ['stop'], 1
+            state.container_stopped(container.name)
+    elif cmd == 'remove':
+        if container.get_container():
+            if container.is_started():
+                actions, calls = ['stop'], 1
+            actions.append('remove')
+            calls += orders.get('v', False) and 1 or 2
+            state.container_removed(container.name)
+    elif cmd == 'remove_image':
+        if container.get_image():
+            actions, calls = ['remove_image'], 1
+            state.images_changed()
+    elif cmd == 'backup':
+        # one download from the archive endpoint for every volume
+        actions, calls = [cmd], 1
+        source = orders.get('source')
+        if not source:
+            calls += 1
+        elif not isinstance(source, basestring):
+            calls = len(source)
+    elif cmd == 'restore':
+        # one upload to the archive endpoint
+        actions, calls = [cmd], 1
+    elif cmd == 'execute':
+        actions = ['execute']
+        calls = container.name != 'host' and 5 or 0
+    else:
+        raise ValueError(
+            "Invalid command {} for container {}".format(cmd, container.name))
+
+    return '+'.join(actions) or 'no-op', calls
+
+
+def critical_path(order_list, configurations, estimates, parents=None):
+    """
+    returns the estimated wall time of an order list, if all independent
+    orders are executed concurrently.
+    """
+    graph = build_order_graph(order_list, configurations, parents)
+    finished = []
+    for estimate, preds in zip(estimates, graph):
+        finished.append(
+            estimate + max([finished[p] for p in preds] or [0.]))
+    return max(finished or [0.])
+
+
+def format_plan(plan):
+    """
+    formats the actions of a plan as a table.
+    """
+    header = ('#', 'container', 'command', 'action', 'api calls', 'estimate')
+    rows = [header] + [
+        (str(n + 1), a['container'], a['command'], a['action'],
+         str(a['api_calls']), '{:.1f}s'.format(a['estimate']))
+        for n, a in enumerate(plan['actions'])]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    lines = [
+        '  '.join(
+            (c.rjust(w) if i in [0, 4, 5] else c.ljust(w))
+            for i, (c, w) in enumerate(zip(row, widths))).rstrip()
+        for row in rows]
+    lines.append('')
+    lines.append(
+        "{} orders, {} API calls, estimated time: {:.1f}s sequential, "
+        "{:.1f}s critical path".format(
+            len(plan['actions']), plan['api_calls'],
+            plan['estimate'], plan['critical_path']))
+    return '\n'.join(lines)
+
+
+def save_plan(plan, filename):
+    with open(filename, 'w') as fh:
+        yaml.safe_dump(plan, fh, default_flow_style=False)
+
+
+def load_plan(filename):
+    with open(filename, 'r') as fh:
+        plan = yaml.safe_load(fh)
+    for key in ['unitcommand', 'configurations', 'order_list']:
+        if key not in plan:
+            raise ValueError(
+                "The plan file {} does not contain a {} entry."
+                .format(filename, key))
+    return plan
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
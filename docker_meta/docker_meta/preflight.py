@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+
+import docker
+
+from docker_meta import __name__ as docker_meta_name
+from docker_meta.scheduler import container_dependencies
+
+
+log = logging.getLogger(docker_meta_name)
+
+# commands, that create the container, if it does not exist
+CREATE_COMMANDS = ['create', 'start']
+
+# commands, that free the ports published by a container
+RELEASE_COMMANDS = ['stop', 'remove']
+
+_ANY_IP = ['', '0.0.0.0', '::']
+
+
+class PreflightError(ValueError):
+    """
+    lists all problems found before a run, that would make it fail.
+    """
+
+    def __init__(self, problems):
+        self.problems = problems
+        super(PreflightError, self).__init__(
+            "The run was not started, because of {} problem(s):\n  - {}"
+            .format(len(problems), '\n  - '.join(problems)))
+
+
+def _as_list(value):
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def host_ports(port_bindings):
+    """
+    returns the ``(ip, port, protocol)`` tuples of the host ports, that the
+    ``port_bindings`` of a startup configuration publish.  Ports chosen by the
+    docker daemon are left out.
+    """
+    res = []
+    for cport, bindings in (port_bindings or {}).items():
+        protocol = str(cport).partition('/')[2] or 'tcp'
+        for binding in _as_list(bindings):
+            ip = ''
+            if isinstance(binding, (tuple, list)):
+                ip = binding[0]
+                binding = binding[1] if len(binding) > 1 else None
+            if binding in [None, '']:
+                continue
+            res.append((ip or '', int(binding), protocol))
+    return res
+
+
+def _same_address(ip1, ip2):
+    return ip1 == ip2 or ip1 in _ANY_IP or ip2 in _ANY_IP
+
+
+def _image_with_tag(image, tag=None):
+    if ':' in image.rsplit('/', 1)[-1] or '@' in image:
+        return image
+    return '{}:{}'.format(image, tag or 'latest')
+
+
+def inspect_distribution(dc, image):
+    """
+    asks the docker daemon for the manifest of ``image`` in its registry.
+    """
+    if hasattr(dc, 'inspect_distribution'):
+        return dc.inspect_distribution(image)
+    # docker-py before 2.6 has no method for the endpoint
+    return dc._result(
+        dc._get(dc._url('/distribution/{0}/json', image)), True)
+
+
+def check_pullable(dc, image):
+    """
+    returns a problem, if the registry does not know the ``image``.  If the
+    daemon cannot tell, the image is assumed to be pullable.
+
+    The request is sent without the credentials of the registry, so that
+    only a missing manifest counts as a problem.  Registries deny access to
+    private images (401 or 403) and other errors leave the question open.
+    """
+    try:
+        inspect_distribution(dc, image)
+    except docker.errors.APIError as e:
+        explanation = str(e.explanation or e)
+        status = getattr(e.response, 'status_code', None)
+        if status != 404 or 'page not found' in explanation:
+            log.debug(
+                "The docker daemon cannot check, if {} can be pulled: {}"
+                .format(image, explanation))
+            return None
+        return "The image {} cannot be pulled: {}".format(image, explanation)
+    except Exception as e:
+        log.debug("Could not check, if {} can be pulled: {}".format(image, e))
+    return None
+
+
+def _check_build(container):
+    path = container.context_path()
+    if not path:
+        return None
+    dockerfile = container.build.get('dockerfile') or 'Dockerfile'
+    if not os.path.exists(os.path.join(path, dockerfile)):
+        return (
+            "The build context {} of the image {} for container {} does not "
+            "contain a {}".format(
+                path, container.build.get('tag', ''), container.name,
+                dockerfile))
+    return None
+
+
+class _Checker(object):
+
+    def __init__(self, jobs, state, dc):
+        self.jobs = jobs
+        self.state = state
+        self.dc = dc
+        self.names = set(name for name, _, _ in jobs)
+        self.released = set(
+            name for name, cmd, _ in jobs if cmd in RELEASE_COMMANDS)
+        self.created = {}
+        self.built = set([])
+        for index, (name, cmd, container) in enumerate(jobs):
+            if cmd in CREATE_COMMANDS:
+                self.created.setdefault(name, index)
+            if cmd == 'build' and container.build.get('tag'):
+                self.built.add(_image_with_tag(container.build['tag']))
+        self._pullable = {}
+
+    def _creates(self, name, cmd):
+        return cmd in CREATE_COMMANDS and not self.state.get_container(name)
+
+    def check_dependencies(self, index, name, container):
+        problems = []
+        config = {'creation': container.creation, 'startup': container.startup}
+        for target in sorted(container_dependencies(config)):
+            if target == name or self.state.get_container(target):
+                continue
+            if target not in self.created:
+                problems.append(
+                    "The container {} refers to the container {}, that "
+                    "neither exists nor is created".format(name, target))
+            elif self.created[target] > index:
+                problems.append(
+                    "The container {} refers to the container {}, that is "
+                    "only created afterwards".format(name, target))
+        return problems
+
+    def check_image(self, name, cmd, container):
+        image = container._image_name()
+        if not image:
+            if cmd in CREATE_COMMANDS:
+                return (
+                    "The container {} has neither a build tag nor an image"
+                    .format(name))
+            return None
+        if container.build:
+            if cmd == 'build' or not self.state.get_image(image):
+                return _check_build(container)
+            return None
+        if self.state.get_image(image):
+            return None
+        image = _image_with_tag(image, container.creation.get('tag'))
+        if image in self.built:
+            return None
+        if image not in self._pullable:
+            self._pullable[image] = check_pullable(self.dc, image)
+        return self._pullable[image]
+
+    def check_ports(self):
+        problems = []
+        published = [
+            (ip, port, protocol, 'the running container {}'.format(owner))
+            for owner, ip, port, protocol in self.state.published_ports()
+            if owner not in self.released]
+        for name in sorted(self.names):
+            started = [
+                c for n, cmd, c in self.jobs if n == name and cmd == 'start']
+            if not started or self.state.is_running(name):
+                continue
+            owner = 'the container {}'.format(name)
+            ports = host_ports(started[0].startup.get('port_bindings'))
+            for ip, port, protocol in sorted(set(ports)):
+                for oip, oport, oprotocol, oowner in published:
+                    if ((port, protocol) == (oport, oprotocol) and
+                            _same_address(ip, oip)):
+                        problems.append(
+                            "The port {}/{} of the container {} is already "
+                            "published by {}".format(
+                                port, protocol, name, oowner))
+                published.append((ip, port, protocol, owner))
+        return problems
+
+    def run(self):
+        problems = []
+        checked = set([])
+        for index, (name, cmd, container) in enumerate(self.jobs):
+            if name == 'host' or (name, cmd) in checked:
+                continue
+            checked.add((name, cmd))
+            if self._creates(name, cmd):
+                problems.extend(
+                    self.check_dependencies(index, name, container))
+            if cmd == 'build' or self._creates(name, cmd):
+                problem = self.check_image(name, cmd, container)
+                if problem and problem not in problems:
+                    problems.append(problem)
+        return problems + self.check_ports()
+
+
+def check_jobs(jobs, state, dc):
+    """
+    checks the ``(name, command, container)`` tuples of a run in one pass
+    against the snapshot ``state`` of the docker daemon.
+
+    The checks find links and volumes of containers, that will not exist,
+    images, that can neither be found, built nor pulled, and host ports, that
+    are published twice.  Returns the list of problems.
+    """
+    return _Checker(jobs, state, dc).run()
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
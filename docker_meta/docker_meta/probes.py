@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+import logging
+import re
+import socket
+import threading
+import time
+import urllib2
+import urlparse
+
+from docker_meta import __name__ as docker_meta_name
+from docker_meta.clients import close_stream
+from docker_meta.fanout import make_thread
+
+
+log = logging.getLogger(docker_meta_name)
+
+
+def daemon_host(dc):
+    """
+    returns the host name of the docker daemon, or ``localhost`` for local
+    unix sockets.
+    """
+    base_url = getattr(dc, 'base_url', '') or ''
+    hostname = urlparse.urlparse(base_url).hostname
+    if not hostname or base_url.startswith('http+docker://'):
+        return 'localhost'
+    return hostname
+
+
+def _port_number(port):
+    return int(str(port).split('/')[0])
+
+
+def published_address(container, port=None):
+    """
+    returns the address ``(host, port)`` under which a port of the container
+    can be reached.
+
+    The ``port_bindings`` of the ``startup`` configuration are used to find
+    the published port on the docker host.  If ``port`` is not given, the
+    lowest bound port is used.  Ports that are not published are reached via
+    the IP address of the container.
+    """
+    bindings = container.startup.get('port_bindings', {})
+    if port is None:
+        if not bindings:
+            raise ValueError(
+                "Cannot guess a port to probe for container {}.  Specify it "
+                "explicitly or add 'port_bindings' to its startup "
+                "configuration.".format(container.name))
+        port = min(bindings.keys(), key=_port_number)
+
+    for key, binding in bindings.items():
+        if _port_number(key) != _port_number(port):
+            continue
+        if isinstance(binding, list):
+            binding = binding[0]
+        if isinstance(binding, tuple):
+            host, host_port = binding[0], (binding[1:] or [None])[0]
+        else:
+            host, host_port = None, binding
+        if host_port is None:
+            inspect = container.inspect()
+            ports = inspect['NetworkSettings']['Ports']
+            host_port = ports['{}/tcp'.format(_port_number(key))][0][
+                'HostPort']
+        if not host or host == '0.0.0.0':
+            host = daemon_host(container.dc)
+        return host, int(host_port)
+
+    inspect = container.inspect()
+    return inspect['NetworkSettings']['IPAddress'], _port_number(port)
+
+
+class TCPProbe(object):
+    """
+    passes as soon as a TCP connection can be established.
+    """
+
+    def __init__(self, container, config):
+        if not isinstance(config, dict):
+            config = {'port': config}
+        port = config.get('port')
+        if port is True:
+            port = None
+        self.container = container
+        self.port = port
+        self.host = config.get('host')
+        self.address = None
+
+    def _address(self):
+        if self.address is None:
+            address = published_address(self.container, self.port)
+            if self.host:
+                address = (self.host, address[1])
+            self.address = address
+        return self.address
+
+    def __call__(self, interval):
+        try:
+            conn = socket.create_connection(self._address(), interval)
+            conn.close()
+            return True
+        except socket.error:
+            return False
+
+    def __str__(self):
+        return 'tcp port {}'.format(self.address or self.port)
+
+
+class HTTPProbe(TCPProbe):
+    """
+    passes as soon as an HTTP request returns the expected status code.
+    """
+
+    def __init__(self, container, config):
+        if not isinstance(config, dict):
+            config = {'path': config}
+        TCPProbe.__init__(self, container, config)
+        self.path = config.get('path', '/')
+        if self.path is True:
+            self.path = '/'
+        self.status = config.get('status', 200)
+        self.scheme = config.get('scheme', 'http')
+
+    def url(self):
+        host, port = self._address()
+        return '{}://{}:{}{}'.format(self.scheme, host, port, self.path)
+
+    def __call__(self, interval):
+        try:
+            status = urllib2.urlopen(self.url(), timeout=interval).getcode()
+        except urllib2.HTTPError as e:
+            status = e.code
+        except (urllib2.URLError, socket.error):
+            return False
+        return status == self.status
+
+    def __str__(self):
+        return 'http status {} of {}'.format(
+            self.status, self.address and self.url() or self.path)
+
+
+class LogProbe(object):
+    """
+    passes as soon as a line of the container output matches a regular
+    expression.
+
+    The output is followed in a background thread, so that every line is
+    read exactly once.  The thread and its connection to the docker daemon
+    end, when the probe is closed.
+    """
+
+    # seconds to wait for the thread, when the probe is closed
+    join_timeout = 5
+
+    def __init__(self, container, config):
+        if isinstance(config, dict):
+            config = config['pattern']
+        self.container = container
+        self.pattern = re.compile(config)
+        self.matched = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._response = None
+        self._closed = False
+
+    def _logs(self):
+        """
+        returns the streamed response and the lines of the container output.
+        """
+        dc = self.container.dc
+        if not hasattr(dc, '_get'):
+            # clients without the low-level API do not expose the response
+            return None, dc.logs(
+                self.container.name, stdout=True, stderr=True, stream=True,
+                tail='all')
+        response = dc._get(
+            dc._url('/containers/{0}/logs', self.container.name),
+            params={'stdout': 1, 'stderr': 1, 'timestamps': 0, 'follow': 1,
+                    'tail': 'all'},
+            stream=True)
+        return response, dc._get_result(self.container.name, True, response)
+
+    def _follow(self):
+        response = None
+        try:
+            response, lines = self._logs()
+            with self._lock:
+                if self._closed:
+                    return
+                self._response = response
+            for line in lines:
+                if self.pattern.search(line):
+                    self.matched.set()
+                    return
+        except Exception as e:
+            log.debug(
+                "Stopped following the output of container {}: {}"
+                .format(self.container.name, e))
+        finally:
+            if response is not None:
+                response.close()
+
+    def close(self):
+        """
+        stops following the output of the container.
+        """
+        with self._lock:
+            self._closed = True
+            response, self._response = self._response, None
+        if response is not None:
+            close_stream(self.container.dc, response)
+        if self._thread is not None:
+            self._thread.join(self.join_timeout)
+
+    def __call__(self, interval):
+        if self._thread is None:
+            self._thread = make_thread(self._follow, 'log-probe')
+            self._thread.start()
+        return self.matched.wait(interval)
+
+    def __str__(self):
+        return 'output matching {}'.format(self.pattern.pattern)
+
+
+class HealthProbe(object):
+    """
+    passes as soon as the docker healthcheck reports the container as
+    ``healthy``.
+    """
+
+    def __init__(self, container, config):
+        self.container = container
+
+    def __call__(self, interval):
+        state = self.container.inspect()['State']
+        if 'Health' not in state:
+            raise RuntimeError(
+                "Container {} has no healthcheck to probe."
+                .format(self.container.name))
+        return state['Health']['Status'] == 'healthy'
+
+    def __str__(self):
+        return 'docker healthcheck'
+
+
+PROBES = [
+    ('tcp', TCPProbe),
+    ('http', HTTPProbe),
+    ('log', LogProbe),
+    ('health', HealthProbe),
+]
+
+
+def make_probes(container, ready):
+    probes = [
+        cls(container, ready[key]) for key, cls in PROBES
+        if ready.get(key) not in [None, False]]
+    if not probes:
+        raise ValueError(
+            "The ready section of container {} needs at least one of the "
+            "probes {}.".format(
+                container.name, ', '.join(key for key, _ in PROBES)))
+    return probes
+
+
+def wait_until_ready(container, ready):
+    """
+    waits until all probes specified in the ``ready`` section of an order
+    pass.
+
+    Besides the probes, the section may contain a ``timeout`` (default: 60
+    seconds) after which a RuntimeError is raised and an ``interval``
+    (default: 0.5 seconds) between two probe attempts.
+    """
+    timeout = ready.get('timeout', 60)
+    interval = ready.get('interval', 0.5)
+    probes = make_probes(container, ready)
+    pending = probes
+
+    start = time.time()
+    try:
+        while True:
+            pending = [probe for probe in pending if not probe(interval)]
+            elapsed = time.time() - start
+            if not pending:
+                log.info(
+                    "Container {} is ready after {:.1f} seconds"
+                    .format(container.name, elapsed))
+                return
+            if elapsed > timeout:
+                raise RuntimeError(
+                    "Container {} did not become ready within {} seconds.  "
+                    "Waiting for: {}".format(
+                        container.name, timeout,
+                        ', '.join(str(p) for p in pending)))
+            time.sleep(interval)
+    finally:
+        for probe in probes:
+            if hasattr(probe, 'close'):
+                probe.close()
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+import heapq
+import logging
+import sys
+import threading
+
+from docker_meta import __name__ as docker_meta_name
+from docker_meta.fanout import make_thread
+from docker_meta.services import normalize_image
+
+
+log = logging.getLogger(docker_meta_name)
+
+
+# orders with these commands act as barriers: every earlier order has to be
+# finished before they run, and every later order waits for them.
+BARRIER_COMMANDS = ['execute']
+
+# orders with these commands only produce images, so that they do not depend
+# on image orders of other containers.
+IMAGE_COMMANDS = ['build']
+
+# orders with these commands may build or pull the image of their container,
+# so that they wait for earlier orders of this kind, that may build the images
+# it needs.
+IMAGE_USE_COMMANDS = ['build', 'create', 'start']
+
+# orders with these commands only read the volumes of their container, so that
+# they do not depend on backup orders of other containers.
+BACKUP_COMMANDS = ['backup']
+
+
+def _as_list(value):
+    if not value:
+        return []
+    if isinstance(value, (basestring, tuple)):
+        return [value]
+    if isinstance(value, dict):
+        return value.items()
+    return list(value)
+
+
+def container_dependencies(config):
+    """
+    returns the names of the containers, that a container configuration refers
+    to via ``links`` or ``volumes_from``.
+    """
+    res = set([])
+    if not isinstance(config, dict):
+        return res
+
+    for section in ['creation', 'startup']:
+        part = config.get(section, {})
+        if not isinstance(part, dict):
+            continue
+        for link in _as_list(part.get('links')):
+            if isinstance(link, tuple):
+                link = link[0]
+            res.add(link.split(':')[0])
+        for volumes_from in _as_list(part.get('volumes_from')):
+            res.add(volumes_from.split(':')[0])
+    return res
+
+
+def _is_barrier(orders):
+    return (orders.get('command') in BARRIER_COMMANDS
+            or orders.get('wait', 0))
+
+
+def _image_sources(configurations, parents):
+    """
+    returns the names of the containers, whose builds produce an image, that
+    the image order of a container needs, by container name.  A build needs
+    the images in ``parents`` (cf. :func:`docker_meta.services.build_parents`)
+    and a pull the image of the container.
+    """
+    built = {}
+    for name, config in configurations.items():
+        build = isinstance(config, dict) and config.get('build')
+        if isinstance(build, dict) and build.get('tag'):
+            built.setdefault(normalize_image(build['tag']), set()).add(name)
+
+    res = {}
+    for name, config in configurations.items():
+        if not isinstance(config, dict):
+            continue
+        build = config.get('build')
+        creation = config.get('creation')
+        if isinstance(build, dict) and build.get('tag'):
+            images = parents.get(name, [])
+        elif isinstance(creation, dict) and creation.get('image'):
+            image = creation['image']
+            if creation.get('tag'):
+                image = '{}:{}'.format(image, creation['tag'])
+            images = [normalize_image(image)]
+        else:
+            images = []
+        res[name] = set(
+            other for image in images for other in built.get(image, [])
+            if other != name)
+    return res
+
+
+def build_order_graph(order_list, configurations, parents=None):
+    """
+    computes the predecessors of every order in the ``order_list``.
+
+    An order depends on every earlier order
+
+      - on the same container,
+      - on a container it links to or takes its volumes from,
+      - on a container linking to it or taking its volumes from it and
+      - on barrier orders (``execute`` or orders with a ``wait`` time).
+
+    Image orders (``build``) of different containers do not depend on each
+    other, so that images are built and pulled concurrently, unless one of
+    them builds the image, that the other one pulls or builds on.  Orders,
+    that may build or pull an image (``build``, ``create`` and ``start``),
+    depend on every earlier such order, that may build the image or its
+    base.
+    The images, that the builds are based on, are given as ``parents`` by
+    container name (cf. :func:`docker_meta.services.build_parents`).
+    ``backup`` orders do not depend on each other either, so that containers
+    are backed up concurrently.
+
+    Returns a list with a set of predecessor indices for each order.
+    """
+    sources = _image_sources(configurations, parents or {})
+    related = {}
+
+    def _related(name):
+        if name not in related:
+            rel = set([name])
+            rel.update(container_dependencies(configurations.get(name, {})))
+            for other, config in configurations.items():
+                if name in container_dependencies(config):
+                    rel.add(other)
+            related[name] = rel
+        return related[name]
+
+    graph = []
+    previous = []
+    for item in order_list:
+        name, orders = item.items()[0]
+        barrier = _is_barrier(orders)
+        command = orders.get('command')
+        kind = (
+            command in IMAGE_COMMANDS and 'image' or
+            command in BACKUP_COMMANDS and 'backup' or None)
+        rel = _related(name)
+        preds = set([
+            j for j, (pname, pbarrier, pkind, pcommand)
+            in enumerate(previous)
+            if barrier or pbarrier or pname == name
+            or (pname in rel and not (kind and kind == pkind))
+            or (command in IMAGE_USE_COMMANDS and
+                pcommand in IMAGE_USE_COMMANDS and
+                pname in sources.get(name, ()))])
+        graph.append(preds)
+        previous.append((name, barrier, kind, command))
+    return graph
+
+
+class OrderScheduler(object):
+    """
+    runs the orders of an order list on a bounded pool of worker threads.
+
+    Orders are started as soon as all their predecessors (cf.
+    :func:`build_order_graph`) are finished.  If an order fails, no new orders
+    are started, and the first failure is re-raised after the running orders
+    returned.
+
+    Instead of computing the predecessors from the containers and the
+    ``parents`` of their builds, they can be given explicitly as ``graph``.
+    """
+
+    def __init__(
+            self, order_list, configurations, workers=1, graph=None,
+            parents=None):
+        self.order_list = order_list
+        self.configurations = configurations
+        self.workers = workers
+        self.graph = graph
+        self.parents = parents
+
+    def run(self, job):
+        """
+        calls ``job(item)`` for every item in the order list.
+        """
+        if self.workers <= 1:
+            for item in self.order_list:
+                job(item)
+            return
+
+        graph = self.graph
+        if graph is None:
+            graph = build_order_graph(
+                self.order_list, self.configurations, self.parents)
+        missing = [len(preds) for preds in graph]
+        dependents = [[] for _ in graph]
+        for i, preds in enumerate(graph):
+            for j in preds:
+                dependents[j].append(i)
+
+        ready = [i for i, m in enumerate(missing) if m == 0]
+        heapq.heapify(ready)
+        state = {'running': 0, 'failures': []}
+        condition = threading.Condition()
+
+        def _worker():
+            while True:
+                with condition:
+                    while (not ready and state['running']
+                           and not state['failures']):
+                        condition.wait()
+                    if state['failures'] or not ready:
+                        condition.notify_all()
+                        return
+                    i = heapq.heappop(ready)
+                    state['running'] += 1
+                try:
+                    job(self.order_list[i])
+                    failure = None
+                except BaseException:
+                    failure = (i, sys.exc_info())
+                with condition:
+                    state['running'] -= 1
+                    if failure:
+                        state['failures'].append(failure)
+                    else:
+                        for d in dependents[i]:
+                            missing[d] -= 1
+                            if missing[d] == 0:
+                                heapq.heappush(ready, d)
+                    condition.notify_all()
+
+        nworkers = min(self.workers, len(self.order_list))
+        log.debug(
+            "Running {} orders on {} worker threads"
+            .format(len(self.order_list), nworkers))
+        threads = [
+            make_thread(_worker, 'worker-{}'.format(n))
+            for n in range(nworkers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            # join with a timeout, so that a KeyboardInterrupt gets through
+            while thread.is_alive():
+                thread.join(0.5)
+
+        if state['failures']:
+            _, exc_info = min(state['failures'])
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import re
+
+import yaml
+
+from docker_meta import __name__ as docker_meta_name
+from docker_meta.build_context import is_remote, resolve_context
+
+
+log = logging.getLogger(docker_meta_name)
+
+# directories of the configuration directory, that contain Dockerfiles
+SERVICE_DIRS = ['services', 'data']
+
+# file in the ``services`` directory mapping service paths to image tags
+TAGS_FILE = 'tags.yaml'
+
+_from_line = re.compile(
+    r'^\s*FROM\s+(?:--\S+\s+)*(\S+)(?:\s+AS\s+(\S+))?\s*$', re.I)
+
+
+def normalize_image(image):
+    """
+    appends the default tag ``latest`` to image names without a tag.
+    """
+    if ':' not in image.rsplit('/', 1)[-1] and '@' not in image:
+        return image + ':latest'
+    return image
+
+
+def dockerfile_parents(path, dockerfile=None):
+    """
+    returns the images, that the Dockerfile in ``path`` builds on.
+
+    Stages of multi-stage builds, that refer to an earlier stage, are left
+    out.
+    """
+    filename = os.path.join(path, dockerfile or 'Dockerfile')
+    res = []
+    stages = set([])
+    with open(filename, 'r') as fh:
+        for line in fh:
+            match = _from_line.match(line)
+            if not match:
+                continue
+            image, stage = match.groups()
+            if image.lower() not in stages and image not in res:
+                res.append(image)
+            if stage:
+                stages.add(stage.lower())
+    return res
+
+
+def base_images(global_config, build):
+    """
+    returns the images with their tags, that the local build context of the
+    ``build`` configuration builds on.
+    """
+    path = resolve_context(global_config, build)
+    if not path or not os.path.exists(
+            os.path.join(path, build.get('dockerfile') or 'Dockerfile')):
+        return []
+    return [
+        normalize_image(parent)
+        for parent in dockerfile_parents(path, build.get('dockerfile'))
+        if parent != 'scratch' and '$' not in parent and '@' not in parent]
+
+
+def build_parents(global_config, configurations):
+    """
+    returns the images, that the builds of the ``configurations`` build on,
+    by container name (cf. :func:`base_images`).
+    """
+    return dict(
+        (name, base_images(global_config, c['build']))
+        for name, c in configurations.items()
+        if isinstance(c, dict) and isinstance(c.get('build'), dict))
+
+
+def _find_dockerfiles(config):
+    res = []
+    for service_dir in SERVICE_DIRS:
+        base = config.get_abspath(service_dir)
+        if not base:
+            continue
+        for root, dirs, files in os.walk(base):
+            dirs.sort()
+            if 'Dockerfile' in files:
+                res.append(root)
+    return res
+
+
+def _read_tags(config):
+    filename = config.get_abspath(os.path.join('services', TAGS_FILE))
+    if not filename:
+        return {}
+    with open(filename, 'r') as fh:
+        tags = yaml.safe_load(fh) or {}
+    base = config.get_abspath('services')
+    return dict(
+        (os.path.realpath(os.path.join(base, path)), tag)
+        for path, tag in tags.items())
+
+
+def _resolve_path(config, path):
+    if os.path.isabs(path):
+        return os.path.realpath(path)
+    return os.path.realpath(config.get_abspath(path) or path)
+
+
+def _unit_builds(config):
+    """
+    returns the build configurations of all units, that can be read without
+    arguments.
+    """
+    res = []
+    if not config.get_abspath('units'):
+        return res
+    for unit in sorted(config.list_units(False)):
+        try:
+            if (config.get_unit_globals(unit) or {}).get('parser'):
+                log.debug(
+                    "Skipping the builds of unit {}, that requires arguments"
+                    .format(unit))
+                continue
+            configurations, _ = config.read_unit_configuration(
+                '{}/start'.format(unit))
+        except Exception as e:
+            log.debug(
+                "Could not read the builds of unit {}: {}".format(unit, e))
+            continue
+        for name, c in sorted(configurations.items()):
+            build = (c or {}).get('build') or {}
+            if build.get('tag') and build.get('path') and not is_remote(
+                    build['path']):
+                res.append(build)
+    return res
+
+
+def collect_services(config):
+    """
+    collects the images, that can be built from the configuration directory.
+
+    Every directory below ``services`` and ``data`` with a Dockerfile is an
+    image.  Its tag is looked up in ``services/tags.yaml`` and in the build
+    configurations of the units.  Directories without a tag are tagged with
+    their path relative to the configuration directory.
+
+    Returns a dictionary mapping the tags to build configurations.
+    """
+    tags = _read_tags(config)
+    builds = {}
+    for build in _unit_builds(config):
+        path = _resolve_path(config, build['path'])
+        builds.setdefault(path, dict(build, path=path))
+
+    res = {}
+    for path in _find_dockerfiles(config):
+        path = os.path.realpath(path)
+        build = builds.pop(path, {'path': path})
+        if path in tags:
+            build['tag'] = tags[path]
+        elif 'tag' not in build:
+            build['tag'] = os.path.relpath(path, os.path.realpath(
+                config.basedir))
+        res[build['tag']] = build
+    # builds of units outside of the configuration directory
+    for path, build in builds.items():
+        if os.path.exists(os.path.join(
+                path, build.get('dockerfile', 'Dockerfile'))):
+            res.setdefault(build['tag'], build)
+    return res
+
+
+def service_graph(services):
+    """
+    returns the tags of the images in ``services``, that every image builds
+    on.
+    """
+    by_image = dict(
+        (normalize_image(tag), tag) for tag in services.keys())
+    graph = {}
+    for tag, build in services.items():
+        parents = [
+            by_image.get(normalize_image(p)) for p in dockerfile_parents(
+                build['path'], build.get('dockerfile'))]
+        graph[tag] = set(p for p in parents if p not in [None, tag])
+    return graph
+
+
+def build_waves(graph):
+    """
+    sorts the images of the ``graph`` topologically.
+
+    Returns a list of waves, where every wave only depends on images of
+    earlier waves.
+    """
+    remaining = dict((tag, set(parents)) for tag, parents in graph.items())
+    waves = []
+    while remaining:
+        wave = sorted(
+            tag for tag, parents in remaining.items() if not parents)
+        if not wave:
+            raise RuntimeError(
+                "The images {} build on each other in a cycle."
+                .format(', '.join(sorted(remaining))))
+        for tag in wave:
+            del remaining[tag]
+        for parents in remaining.values():
+            parents.difference_update(wave)
+        waves.append(wave)
+    return waves
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+import copy
+import logging
+import threading
+
+from docker.utils import parse_repository_tag
+
+from docker_meta import __name__ as docker_meta_name
+
+
+log = logging.getLogger(docker_meta_name)
+
+
+class DockerState(object):
+    """
+    run-scoped snapshot of the containers and images of a docker daemon.
+
+    The snapshot is requested with one bulk ``containers(all=True)`` and one
+    ``images()`` call the first time it is needed.  Afterwards, the
+    :class:`docker_meta.container.DockerContainer` objects update it in place,
+    whenever they create, start, stop or remove something.  Call
+    :meth:`invalidate` if the daemon has been changed behind our back.
+
+    If a :class:`docker_meta.events.EventMonitor` follows the event stream of
+    the daemon, it is available as :attr:`monitor` and keeps the snapshot up to
+    date with changes made by others.
+    """
+
+    def __init__(self, dc):
+        self.dc = dc
+        self.monitor = None
+        self._lock = threading.RLock()
+        self._containers = None
+        self._images = None
+
+    def invalidate(self):
+        with self._lock:
+            self._containers = None
+            self._images = None
+
+    def refresh(self):
+        with self._lock:
+            self.invalidate()
+            self._get_containers()
+            self._get_images()
+
+    def load(self, containers, images):
+        """
+        sets the snapshot from the results of ``containers(all=True)`` and
+        ``images()`` requested elsewhere, e.g., by an asynchronous client.
+        """
+        with self._lock:
+            self._containers = self._by_name(containers)
+            self._images = images
+
+    def load_images(self, images):
+        """
+        sets the image snapshot from the result of ``images()`` requested
+        elsewhere.
+        """
+        with self._lock:
+            self._images = images
+
+    @staticmethod
+    def _by_name(containers):
+        res = {}
+        for container in containers:
+            for name in container.get('Names') or []:
+                res[name.lstrip('/')] = container
+        return res
+
+    def copy(self):
+        """
+        returns an independent copy of the snapshot, e.g., to simulate the
+        effects of orders without executing them.
+        """
+        with self._lock:
+            res = DockerState(self.dc)
+            res._containers = copy.deepcopy(self._get_containers())
+            res._images = copy.deepcopy(self._get_images())
+            return res
+
+    def _get_containers(self):
+        with self._lock:
+            if self._containers is None:
+                self._containers = self._by_name(
+                    self.dc.containers(all=True))
+                log.debug(
+                    "Read the state of {} containers from the docker daemon"
+                    .format(len(self._containers)))
+            return self._containers
+
+    def _get_images(self):
+        with self._lock:
+            if self._images is None:
+                self._images = self.dc.images()
+                log.debug(
+                    "Read the state of {} images from the docker daemon"
+                    .format(len(self._images)))
+            return self._images
+
+    def get_container(self, name):
+        with self._lock:
+            return self._get_containers().get(name, {})
+
+    def is_running(self, name):
+        container = self.get_container(name)
+        if 'State' in container:
+            return container['State'] == 'running'
+        return container.get('Status', '').startswith('Up')
+
+    def published_ports(self):
+        """
+        returns the ``(name, ip, port, protocol)`` tuples of the host ports
+        published by running containers.
+        """
+        with self._lock:
+            containers = self._get_containers().items()
+        res = []
+        for name, container in sorted(containers):
+            if not self.is_running(name):
+                continue
+            for port in container.get('Ports') or []:
+                if port.get('PublicPort'):
+                    res.append((
+                        name, port.get('IP', ''), port['PublicPort'],
+                        port.get('Type', 'tcp')))
+        return res
+
+    def get_image(self, name):
+        """
+        returns the image tagged with ``name``.  If ``name`` has no tag, the
+        image tagged with ``latest`` is preferred.
+        """
+        # the port of a registry host is not a tag
+        repository, tag = parse_repository_tag(name)
+        with self._lock:
+            images = self._get_images()
+            if tag:
+                candidates = [
+                    i for i in images if name in (i.get('RepoTags') or [])]
+            else:
+                candidates = [
+                    i for i in images
+                    if '{}:latest'.format(name) in (i.get('RepoTags') or [])]
+                if not candidates:
+                    candidates = [
+                        i for i in images
+                        if any(t.rsplit(':', 1)[0] == repository
+                               for t in (i.get('RepoTags') or []))]
+        if len(candidates) == 1:
+            return candidates[0]
+        else:
+            return {}
+
+    def container_created(self, name, container_id, image=None, labels=None):
+        with self._lock:
+            self._get_containers()[name] = {
+                'Id': container_id,
+                'Names': ['/{}'.format(name)],
+                'Image': image,
+                'Labels': labels or {},
+                'State': 'created',
+                'Status': 'Created',
+            }
+
+    def _set_running(self, name, running):
+        with self._lock:
+            container = self._get_containers().get(name)
+            if container:
+                container['State'] = running and 'running' or 'exited'
+                container['Status'] = running and 'Up' or 'Exited'
+
+    def container_started(self, name):
+        self._set_running(name, True)
+
+    def container_stopped(self, name):
+        self._set_running(name, False)
+
+    def container_removed(self, name):
+        with self._lock:
+            self._get_containers().pop(name, None)
+
+    def container_event(self, container_id, name, status):
+        """
+        updates the snapshot with a state change reported by the event stream.
+        """
+        with self._lock:
+            if self._containers is None:
+                # the snapshot is read later on and will include the change
+                return
+            if not name:
+                name = next((
+                    n for n, c in self._containers.items()
+                    if c.get('Id') == container_id), None)
+            if not name:
+                return
+            if status == 'removed':
+                self.container_removed(name)
+            elif status == 'created':
+                if name not in self._containers:
+                    self.container_created(name, container_id)
+            elif status in ['running', 'exited']:
+                self._set_running(name, status == 'running')
+
+    def image_added(self, name, labels=None):
+        with self._lock:
+            if ':' not in name.rsplit('/', 1)[-1]:
+                name = '{}:latest'.format(name)
+            for image in self._get_images():
+                if name in (image.get('RepoTags') or []):
+                    image['RepoTags'] = [
+                        t for t in image['RepoTags'] if t != name]
+            self._get_images().append({
+                'Id': None, 'RepoTags': [name], 'Labels': labels or {}})
+
+    def images_changed(self):
+        """
+        marks the image snapshot as outdated after a build, pull or removal.
+        """
+        with self._lock:
+            self._images = None
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
@@ -0,0 +1,680 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import struct
+import urllib
+from StringIO import StringIO
+
+from docker.constants import DEFAULT_DOCKER_API_VERSION
+from docker.utils import (
+    create_container_config, create_host_config, mkbuildcontext, parse_host)
+
+import docker_meta.container
+from docker_meta import __name__ as docker_meta_name
+from docker_meta.scheduler import build_order_graph
+from docker_meta.services import build_parents
+from docker_meta.state import DockerState
+from docker_meta.utils import FINGERPRINT_LABEL
+
+try:
+    from twisted.internet import defer, protocol, reactor, task, threads
+    from twisted.internet.endpoints import UNIXClientEndpoint
+    from twisted.web.client import (
+        Agent, FileBodyProducer, HTTPConnectionPool, ResponseDone,
+        readBody)
+    from twisted.web.http import PotentialDataLoss
+    from twisted.web.http_headers import Headers
+    from twisted.web.iweb import IAgentEndpointFactory
+    from zope.interface import implementer
+    has_twisted = True
+except ImportError:
+    has_twisted = False
+
+
+log = logging.getLogger(docker_meta_name)
+
+
+# commands, that are executed by the twisted backend.  All other commands
+# run the synchronous implementation in a thread.
+ASYNC_COMMANDS = ['build', 'create', 'start', 'stop', 'remove', 'remove_image']
+
+
+class APIError(RuntimeError):
+
+    def __init__(self, method, path, code, explanation):
+        RuntimeError.__init__(
+            self, "{} {} failed with status {}: {}".format(
+                method, path, code, explanation.strip()))
+        self.code = code
+        self.explanation = explanation
+
+
+def _id(container):
+    if isinstance(container, dict):
+        return container.get('Id')
+    return container
+
+
+def _split_lines(buf, data):
+    lines = (buf + data).split('\n')
+    return lines[:-1], lines[-1]
+
+
+if has_twisted:
+
+    @implementer(IAgentEndpointFactory)
+    class UNIXEndpointFactory(object):
+
+        def __init__(self, path):
+            self.path = path
+
+        def endpointForURI(self, uri):
+            return UNIXClientEndpoint(reactor, self.path)
+
+    class LineProtocol(protocol.Protocol):
+        """
+        passes every line of a streamed response body to ``callback``.
+        """
+
+        def __init__(self, callback, finished):
+            self.callback = callback
+            self.finished = finished
+            self._buf = ''
+
+        def dataReceived(self, data):
+            lines, self._buf = _split_lines(self._buf, data)
+            for line in lines:
+                self.callback(line)
+
+        def connectionLost(self, reason):
+            if self._buf:
+                self.callback(self._buf)
+            if reason.check(ResponseDone, PotentialDataLoss):
+                self.finished.callback(None)
+            else:
+                self.finished.errback(reason)
+
+    class MultiplexedProtocol(LineProtocol):
+        """
+        demultiplexes the stdout and stderr frames of an attached container
+        without a tty and passes their lines to ``callback``.
+        """
+
+        def __init__(self, callback, finished):
+            LineProtocol.__init__(self, callback, finished)
+            self._frames = ''
+
+        def dataReceived(self, data):
+            self._frames += data
+            while len(self._frames) >= 8:
+                _, length = struct.unpack('>BxxxL', self._frames[:8])
+                if len(self._frames) < 8 + length:
+                    break
+                payload = self._frames[8:8 + length]
+                self._frames = self._frames[8 + length:]
+                LineProtocol.dataReceived(self, payload)
+
+    class TwistedDockerClient(object):
+        """
+        a non-blocking client for the docker remote API.
+
+        The method names and arguments follow the ones of ``docker.Client``,
+        but the methods return Deferreds.  Streamed responses (``build``,
+        ``pull`` and ``logs``) are passed line by line to a callback.
+        Connections are kept alive in a pool shared by all requests.
+        """
+
+        def __init__(
+                self, base_url=None, version=DEFAULT_DOCKER_API_VERSION,
+                maxPersistentPerHost=20):
+            self.base_url = base_url
+            self.api_version = version
+            pool = HTTPConnectionPool(reactor, persistent=True)
+            pool.maxPersistentPerHost = maxPersistentPerHost
+            url = parse_host(base_url)
+            if url.startswith('http+unix://'):
+                path = url[len('http+unix://'):]
+                if not path.startswith('/'):
+                    path = '/' + path
+                self._agent = Agent.usingEndpointFactory(
+                    reactor, UNIXEndpointFactory(path), pool=pool)
+                self._url = 'http://localunixsocket'
+            else:
+                self._agent = Agent(reactor, pool=pool)
+                self._url = url
+
+        def _uri(self, path, params=None):
+            uri = '{}/v{}{}'.format(self._url, self.api_version, path)
+            params = dict(
+                (k, v) for k, v in (params or {}).items() if v is not None)
+            if params:
+                uri += '?' + urllib.urlencode(sorted(params.items()))
+            return uri
+
+        @defer.inlineCallbacks
+        def request(
+                self, method, path, params=None, data=None, headers=None):
+            """
+            sends a request and returns the response, if its status is
+            successful.  Otherwise, an :class:`APIError` is raised.
+            """
+            body = None
+            if data is not None:
+                if not hasattr(data, 'read'):
+                    data = StringIO(data)
+                body = FileBodyProducer(data)
+            response = yield self._agent.request(
+                method, self._uri(path, params),
+                Headers(dict((k, [v]) for k, v in (headers or {}).items())),
+                body)
+            if response.code >= 400:
+                explanation = yield readBody(response)
+                raise APIError(method, path, response.code, explanation)
+            defer.returnValue(response)
+
+        @defer.inlineCallbacks
+        def json(self, method, path, params=None, data=None):
+            headers = None
+            if data is not None:
+                data = json.dumps(data)
+                headers = {'Content-Type': 'application/json'}
+            response = yield self.request(method, path, params, data, headers)
+            content = yield readBody(response)
+            defer.returnValue(json.loads(content) if content else None)
+
+        @defer.inlineCallbacks
+        def stream(
+                self, method, path, callback, params=None, data=None,
+                headers=None, multiplexed=False):
+            response = yield self.request(method, path, params, data, headers)
+            finished = defer.Deferred()
+            if multiplexed:
+                response.deliverBody(MultiplexedProtocol(callback, finished))
+            else:
+                response.deliverBody(LineProtocol(callback, finished))
+            yield finished
+
+        def containers(self, all=False):
+            return self.json(
+                'GET', '/containers/json', {'all': all and 1 or 0})
+
+        def images(self):
+            return self.json('GET', '/images/json')
+
+        def inspect_container(self, container):
+            return self.json(
+                'GET', '/containers/{}/json'.format(_id(container)))
+
+        def create_container(self, image, command=None, name=None, **kwargs):
+            config = create_container_config(
+                self.api_version, image, command, **kwargs)
+            return self.json(
+                'POST', '/containers/create', {'name': name}, config)
+
+        def start(self, container, **kwargs):
+            start_config = None
+            if kwargs:
+                start_config = create_host_config(
+                    version=self.api_version, **kwargs)
+            return self.json(
+                'POST', '/containers/{}/start'.format(_id(container)),
+                data=start_config)
+
+        def restart(self, container, timeout=10):
+            return self.json(
+                'POST', '/containers/{}/restart'.format(_id(container)),
+                {'t': timeout})
+
+        def stop(self, container, timeout=10):
+            return self.json(
+                'POST', '/containers/{}/stop'.format(_id(container)),
+                {'t': timeout})
+
+        @defer.inlineCallbacks
+        def wait(self, container):
+            res = yield self.json(
+                'POST', '/containers/{}/wait'.format(_id(container)))
+            defer.returnValue(res['StatusCode'])
+
+        def remove_container(self, container, v=False, force=False):
+            return self.json(
+                'DELETE', '/containers/{}'.format(_id(container)),
+                {'v': v and 1 or 0, 'force': force and 1 or 0})
+
+        def remove_image(self, image, force=False, noprune=False):
+            return self.json(
+                'DELETE', '/images/{}'.format(_id(image)),
+                {'force': force and 1 or 0, 'noprune': noprune and 1 or 0})
+
+        def logs(self, container, callback, follow=True, tty=False):
+            return self.stream(
+                'GET', '/containers/{}/logs'.format(_id(container)),
+                callback,
+                {'stdout': 1, 'stderr': 1, 'follow': follow and 1 or 0,
+                 'tail': 'all'},
+                multiplexed=not tty)
+
+        def pull(self, callback, repository, tag='latest'):
+            return self.stream(
+                'POST', '/images/create', callback,
+                {'fromImage': repository, 'tag': tag})
+
+        def build(
+                self, callback, path=None, tag=None, quiet=False,
+                fileobj=None, nocache=False, rm=False, custom_context=False,
+                pull=False, forcerm=False, dockerfile=None, buildargs=None,
+                **kwargs):
+            """
+            builds an image from a remote ``path``, a Dockerfile in
+            ``fileobj`` or a tar archive of the build context in ``fileobj``
+            with ``custom_context=True``.
+
+            Local build paths are turned into custom contexts by
+            :meth:`docker_meta.container.DockerContainer._build_arguments`.
+            """
+            if custom_context:
+                context = fileobj
+            elif fileobj is not None:
+                context = mkbuildcontext(fileobj)
+            elif path is not None:
+                context = None
+            else:
+                raise TypeError(
+                    "Either path or fileobj needs to be provided.")
+            params = {
+                't': tag,
+                'remote': context is None and path or None,
+                'q': quiet and 1 or 0,
+                'nocache': nocache and 1 or 0,
+                'rm': rm and 1 or 0,
+                'forcerm': forcerm and 1 or 0,
+                'pull': pull and 1 or 0,
+                'dockerfile': dockerfile,
+                'buildargs': buildargs and json.dumps(buildargs) or None,
+            }
+            headers = context is not None and {
+                'Content-Type': 'application/tar'} or None
+            return self.stream(
+                'POST', '/build', callback, params, context, headers)
+
+    class AsyncDockerContainer(object):
+        """
+        executes the orders of a
+        :class:`docker_meta.container.DockerContainer` with a
+        :class:`TwistedDockerClient`.
+
+        The methods return Deferreds and follow the synchronous ones of the
+        wrapped container, whose configuration and state are used.
+        """
+
+        def __init__(self, container, client):
+            self.container = container
+            self.client = client
+            self.name = container.name
+
+        def _update_state(self, method, *args):
+            self.container._update_state(method, *args)
+
+        def _output(self, command):
+            return lambda line: self.container._log_output(line, command)
+
+        @defer.inlineCallbacks
+        def _reload_images(self):
+            """
+            reloads the image snapshot with the asynchronous client, so that
+            the reactor does not block on a refresh by the synchronous one.
+            """
+            images = yield self.client.images()
+            if self.container.state is not None:
+                self.container.state.load_images(images)
+
+        @defer.inlineCallbacks
+        def build_image(self):
+            c = self.container
+            # the plans hash build contexts and may query the daemon, so
+            # they run in a thread instead of on the reactor
+            plan = yield threads.deferToThread(c.plan_build)
+            if plan == 'skip':
+                log.debug(
+                    "Image {} already exists. (skipped)"
+                    .format(c.creation.get('image', c.build.get('tag'))))
+                return
+            if c.build:
+                c.build.setdefault('rm', True)
+                arguments = yield threads.deferToThread(c._build_arguments)
+                yield self.client.build(self._output('build'), **arguments)
+                fingerprint = yield threads.deferToThread(c.image_fingerprint)
+                self._update_state('image_added', c.build.get('tag'), {
+                    FINGERPRINT_LABEL: fingerprint})
+                log.info("Successfully built the image {}".format(
+                    c.build.get('tag', 'for container {}'.format(self.name))))
+            else:
+                image, tag = c._pull_image()
+                if not image:
+                    raise RuntimeError("No image to pull or build given.")
+                errors = []
+
+                def _line(line):
+                    c._log_output(line, 'pull')
+                    try:
+                        error = json.loads(line).get('error')
+                    except ValueError:
+                        error = None
+                    if error:
+                        errors.append(error)
+
+                yield self.client.pull(_line, image, tag)
+                if errors:
+                    raise RuntimeError(
+                        "No build instructions for image {}:\n{}"
+                        .format(image, errors[-1]))
+                name = tag and '{}:{}'.format(image, tag) or image
+                self._update_state('image_added', name)
+                log.info("Successfully pulled the image {}".format(name))
+
+        @defer.inlineCallbacks
+        def _has_own_volumes(self):
+            inspect = yield self.client.inspect_container(self.name)
+            binds = set([
+                n.split(':')[1] for n in (
+                    inspect['HostConfig']['Binds'] or [])])
+            fvolumes = []
+            for vf in inspect['HostConfig']['VolumesFrom'] or []:
+                finspect = yield self.client.inspect_container(vf)
+                fvolumes += (finspect.get('Volumes') or {}).keys()
+            volumes = set((inspect.get('Volumes') or {}).keys())
+            defer.returnValue(
+                bool(volumes.difference(binds.union(set(fvolumes)))))
+
+        @defer.inlineCallbacks
+        def _recreate(self):
+            own_volumes = yield self._has_own_volumes()
+            if own_volumes:
+                log.warn(
+                    "Container {} is out of date, but has volumes attached "
+                    "to it. Remove it manually in order to update it."
+                    .format(self.name))
+                defer.returnValue(False)
+            log.info(
+                "The configuration of container {} changed.  Re-creating it."
+                .format(self.name))
+            yield self.remove(v=False)
+            defer.returnValue(True)
+
+        @defer.inlineCallbacks
+        def create(self):
+            c = self.container
+            if (not c.creation) and (not c.build):
+                raise RuntimeError(
+                    "No configuration to create the container given.")
+            c.creation['name'] = self.name
+            c.creation['image'] = c.build.get(
+                'tag', c.creation.get('image'))
+            if not c.creation['image']:
+                raise RuntimeError(
+                    "Creation requires a build tag or an image id.")
+            plan = yield threads.deferToThread(c.plan_create)
+            if plan == 'skip':
+                log.debug(
+                    "The container {} seems to exist already (skipped)."
+                    .format(self.name))
+                return
+            elif plan == 'recreate':
+                recreated = yield self._recreate()
+                if not recreated:
+                    return
+            labels = c.creation.get('labels') or {}
+            if isinstance(labels, list):
+                labels = dict((label, '') for label in labels)
+            else:
+                labels = dict(labels)
+            labels[FINGERPRINT_LABEL] = yield threads.deferToThread(
+                c.container_fingerprint)
+            c.creation['labels'] = labels
+            if not c.get_image():
+                yield self.build_image()
+            res = yield self.client.create_container(**c.creation)
+            self._update_state(
+                'container_created', self.name, res['Id'],
+                c.creation['image'], labels)
+            log.info(
+                "Successfully created the container {}".format(self.name))
+
+        @defer.inlineCallbacks
+        def start(self, restart=False, attach=False, timeout=10):
+            c = self.container
+            container = c.get_container()
+            plan = None
+            if container:
+                plan = yield threads.deferToThread(c.plan_create)
+            if plan == 'recreate':
+                recreated = yield self._recreate()
+                if recreated:
+                    container = {}
+            if container:
+                if restart or not c.is_started():
+                    yield self.client.restart(container, timeout)
+                    self._update_state('container_started', self.name)
+                    log.info("Started container {}".format(self.name))
+                else:
+                    log.debug(
+                        "Container {} is already started. (skipped)"
+                        .format(self.name))
+            else:
+                yield self.create()
+                container = c.get_container()
+                yield self.client.start(container, **c.startup)
+                self._update_state('container_started', self.name)
+                log.info("Started container {}".format(self.name))
+            if attach:
+                yield self.attach(container)
+
+        @defer.inlineCallbacks
+        def attach(self, container):
+            yield self.client.logs(
+                container, self._output('attach'),
+                tty=self.container.creation.get('tty', False))
+            exitcode = yield self.client.wait(container)
+            self._update_state('container_stopped', self.name)
+            if exitcode != 0:
+                raise RuntimeError(
+                    "Container {} stopped with exit code {}!"
+                    .format(self.name, exitcode))
+
+        @defer.inlineCallbacks
+        def stop(self, timeout=10):
+            c = self.container
+            container = c.get_container()
+            if container and c.is_started():
+                yield self.client.stop(container, timeout)
+                self._update_state('container_stopped', self.name)
+                log.info(
+                    "Successfully stopped container {}".format(self.name))
+            else:
+                log.debug(
+                    "Not stopping container {} as it was not running"
+                    .format(self.name))
+
+        @defer.inlineCallbacks
+        def remove(self, v=True, timeout=10):
+            yield self.stop(timeout)
+            container = self.container.get_container()
+            if not container:
+                log.debug(
+                    "Not removing container {} as it did not exist."
+                    .format(self.name))
+                return
+            if not v:
+                own_volumes = yield self._has_own_volumes()
+                if own_volumes:
+                    log.info(
+                        "Not removing container {} as it has volumes "
+                        "attached to it.".format(self.name))
+                    return
+            yield self.client.remove_container(container, v)
+            self._update_state('container_removed', self.name)
+            log.info("Successfully removed container {}".format(self.name))
+
+        @defer.inlineCallbacks
+        def remove_image(self, force=False, noprune=False):
+            image = self.container.get_image()
+            if image:
+                yield self.client.remove_image(image, force, noprune)
+                self._update_state('images_changed')
+                yield self._reload_images()
+                log.info("Successfully removed the image {}".format(
+                    image.get('Id')))
+
+        @defer.inlineCallbacks
+        def run(self, cmd, orders):
+            """
+            executes an order like :func:`docker_meta.container.run_job`.
+            """
+            if cmd not in ASYNC_COMMANDS:
+                yield threads.deferToThread(
+                    docker_meta.container.run_job, cmd, self.container,
+                    orders)
+                return
+            timeout = orders.pop('timeout', 10)
+            wait_time = orders.pop('wait', 0)
+            ready = orders.pop('ready', None)
+
+            log.info('Executing step {} on {}'.format(cmd, self.name))
+            if cmd == 'build':
+                yield self.build_image()
+            elif cmd == 'create':
+                yield self.create()
+            elif cmd == 'start':
+                yield self.start(
+                    orders.pop('restart', False), orders.pop('attach', False),
+                    timeout)
+            elif cmd == 'stop':
+                yield self.stop(timeout)
+            elif cmd == 'remove':
+                yield self.remove(orders.pop('v', False), timeout)
+            elif cmd == 'remove_image':
+                yield self.remove_image(
+                    orders.pop('force', False), orders.pop('noprune', False))
+
+            if ready:
+                yield threads.deferToThread(
+                    docker_meta.container.wait_until_ready, self.container,
+                    ready)
+            if wait_time:
+                yield task.deferLater(reactor, wait_time, lambda: None)
+
+    def run_orders(
+            order_list, configurations, job, concurrency=100, parents=None):
+        """
+        calls ``job(item)``, which returns a Deferred, for every item in the
+        order list.
+
+        An order is started as soon as the orders it depends on (cf.
+        :func:`docker_meta.scheduler.build_order_graph` with the ``parents``
+        of the builds) are finished, but at most ``concurrency`` orders are
+        in flight.  After a failure, no new orders are started and the
+        Deferred fails with the failure of the earliest order.
+        """
+        graph = build_order_graph(order_list, configurations, parents)
+        missing = [len(preds) for preds in graph]
+        dependents = [[] for _ in graph]
+        for i, preds in enumerate(graph):
+            for j in preds:
+                dependents[j].append(i)
+
+        result = defer.Deferred()
+        semaphore = defer.DeferredSemaphore(max(1, concurrency))
+        status = {'running': 0, 'failures': []}
+
+        def _start(i):
+            status['running'] += 1
+            d = semaphore.run(job, order_list[i])
+            d.addCallbacks(
+                _finished, _failed, callbackArgs=(i,), errbackArgs=(i,))
+
+        def _finished(_, i):
+            status['running'] -= 1
+            if not status['failures']:
+                for d in dependents[i]:
+                    missing[d] -= 1
+                    if missing[d] == 0:
+                        _start(d)
+            _check()
+
+        def _failed(failure, i):
+            status['running'] -= 1
+            status['failures'].append((i, failure))
+            _check()
+
+        def _check():
+            if status['running'] == 0 and not result.called:
+                if status['failures']:
+                    result.errback(min(status['failures'])[1])
+                else:
+                    result.callback(None)
+
+        for i, m in enumerate(missing):
+            if m == 0:
+                _start(i)
+        _check()
+        return result
+
+    @defer.inlineCallbacks
+    def run_configuration_async(
+            global_config, configurations, order_list, client, dc=None,
+            concurrency=100):
+        """
+        executes the orders of the ``order_list`` with the
+        :class:`TwistedDockerClient` ``client`` and returns a Deferred.
+
+        ``dc`` is a synchronous client for the orders, that are not implemented
+        by :class:`AsyncDockerContainer`.
+        """
+        containers, images = yield defer.gatherResults(
+            [client.containers(all=True), client.images()],
+            consumeErrors=True)
+        state = DockerState(dc)
+        state.load(containers, images)
+
+        def _job(item):
+            name, orders = item.items()[0]
+            cmd, container = docker_meta.container.prepare_job(
+                name, dc, global_config, orders, configurations, state)
+            return AsyncDockerContainer(container, client).run(cmd, orders)
+
+        yield run_orders(
+            order_list, configurations, _job, concurrency,
+            build_parents(global_config, configurations))
+
+
+def run_configuration_twisted(
+        global_config, configurations, order_list, daemon, concurrency=100):
+    """
+    runs the twisted reactor until the orders of the ``order_list`` are
+    executed (cf. :func:`run_configuration_async`).
+
+    The reactor cannot be restarted, so this can only be called once per
+    process.
+    """
+    if not has_twisted:
+        raise RuntimeError(
+            "Twisted is not installed.  Please install it or use the threads "
+            "backend.")
+    dc = docker_meta.container.get_docker_client(daemon)
+    client = TwistedDockerClient(daemon, dc.api_version)
+    result = []
+
+    def _run():
+        d = run_configuration_async(
+            global_config, configurations, order_list, client, dc,
+            concurrency)
+        d.addBoth(result.append)
+        d.addBoth(lambda _: reactor.stop())
+
+    reactor.callWhenRunning(_run)
+    reactor.run()
+    if result and hasattr(result[0], 'raiseException'):
+        result[0].raiseException()
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
@@ -1,7 +1,12 @@
 import collections
 import datetime
+import hashlib
+import json
 import os
 
+# label storing the fingerprint of the configuration of containers and images
+FINGERPRINT_LABEL = 'dockerstra.fingerprint'
+
 
 def get_timestamp():
     return datetime.now().strftime('%Y%m%d-%H%M')
@@ -17,6 +22,14 @@ def deepupdate(d, u):
     return d
 
 
+def fingerprint(*parts):
+    """
+    computes a stable digest of json serializable configuration parts.
+    """
+    serialized = json.dumps(parts, sort_keys=True, default=repr)
+    return hashlib.sha256(serialized).hexdigest()
+
+
 def recursive_walk(path):
     res = []
     for root, dirs, files in os.walk(path):
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+import io
+import posixpath
+import tarfile
+import threading
+import time
+
+import pytest
+import yaml
+
+import docker_meta.backup
+from docker_meta.backup import (
+    archive_prefix, list_snapshots, volume_archives, BackupLimits)
+from docker_meta.compression import GzipCodec
+from docker_meta.container import DockerContainer
+
+
+def volume_archive(files):
+    """
+    returns an archive like the archive endpoint of the docker daemon with
+    the ``files`` mapping paths relative to the requested directory to their
+    contents.
+    """
+    fh = io.BytesIO()
+    with tarfile.open(fileobj=fh, mode='w') as tar:
+        for name, data in sorted(files.items()):
+            info = tarfile.TarInfo(name)
+            if data is None:
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
+            else:
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+    fh.seek(0)
+    return fh
+
+
+class ArchiveDocker(object):
+    """
+    a docker client stand-in with the ``volumes`` of a container mapping
+    their paths to the files in them.
+    """
+
+    def __init__(self, volumes):
+        self.volumes = volumes
+        self.archived = []
+        self.restored = []
+        self.files = {}
+
+    def inspect_container(self, name):
+        return {'Config': {'Volumes': dict((v, {}) for v in self.volumes)}}
+
+    def get_archive(self, container, path):
+        self.archived.append((container, path))
+        if path not in self.volumes:
+            raise RuntimeError('Could not find the file {}'.format(path))
+        base = posixpath.basename(path)
+        files = dict(
+            (posixpath.join(base, name), data)
+            for name, data in self.volumes[path].items())
+        files[base] = None
+        return volume_archive(files), {'name': base}
+
+    def put_archive(self, container, path, data):
+        self.restored.append((container, path))
+        with tarfile.open(fileobj=data, mode='r|') as tar:
+            for member in tar:
+                fh = tar.extractfile(member) if member.isreg() else None
+                self.files[member.name] = fh and fh.read()
+        return True
+
+
+def _members(filename):
+    with tarfile.open(filename, 'r:gz') as tar:
+        return dict(
+            (m.name, tar.extractfile(m).read() if m.isreg() else None)
+            for m in tar.getmembers())
+
+
+@pytest.mark.parametrize('source,expected', [
+    ('/data', ''),
+    ('/var/lib/mysql/', 'var/lib'),
+    ('srv/data', 'srv'),
+])
+def test_archive_prefix(source, expected):
+    assert archive_prefix(source) == expected
+
+
+def test_backup(tmpdir):
+    dc = ArchiveDocker({
+        '/data': {'file': 'data', 'sub/file': 'sub'},
+        '/var/lib/mysql': {'ibdata': 'mysql'},
+    })
+    container = DockerContainer(dc, 'test', creation={}, startup={})
+    container.backup(None, str(tmpdir), 'backup')
+    assert sorted(dc.archived) == [
+        ('test', '/data'), ('test', '/var/lib/mysql')]
+    # the layout matches ``tar`` in the root directory of the container
+    assert _members(str(tmpdir.join('backup.tar.gz'))) == {
+        'data': None, 'data/file': 'data', 'data/sub/file': 'sub',
+        'var/lib/mysql': None, 'var/lib/mysql/ibdata': 'mysql'}
+
+    container.backup('/data', str(tmpdir), 'backup', overwrite=True)
+    assert sorted(_members(str(tmpdir.join('backup.tar.gz')))) == [
+        'data', 'data/file', 'data/sub/file']
+
+
+def test_backup_compression(tmpdir):
+    dc = ArchiveDocker({'/data': {'file': 'data' * 1000}})
+    container = DockerContainer(dc, 'test', creation={}, startup={})
+    container.backup(None, str(tmpdir), 'backup')
+    tmpdir.join('backup.tar').write('')
+    compression = {'codec': 'gzip', 'level': 1, 'threads': 2}
+    with pytest.raises(RuntimeError) as e:
+        container.backup(None, str(tmpdir), 'backup', False, compression)
+    assert 'exists already' in str(e.value)
+
+    container.backup(None, str(tmpdir), 'backup', True, compression)
+    # the archives of other codecs are replaced
+    assert [f.basename for f in tmpdir.listdir()] == ['backup.tar.gz']
+    assert _members(str(tmpdir.join('backup.tar.gz')))['data/file'] == (
+        'data' * 1000)
+
+
+def test_restore(tmpdir):
+    dc = ArchiveDocker({'/srv/data': {'file': 'data' * 1000}})
+    container = DockerContainer(dc, 'test', creation={}, startup={})
+    container.backup(None, str(tmpdir), 'backup')
+    archive = tmpdir.join('backup.tar.gz').read()
+
+    container.restore(str(tmpdir), 'backup')
+    assert dc.restored == [('test', '/')]
+    assert dc.files == {'srv/data': None, 'srv/data/file': 'data' * 1000}
+    # the archive is left untouched
+    assert [f.basename for f in tmpdir.listdir()] == ['backup.tar.gz']
+    assert tmpdir.join('backup.tar.gz').read() == archive
+
+    # uncompressed archives are restored as well
+    dc.files = {}
+    tmpdir.join('plain.tar').write(
+        volume_archive({'data/plain': 'plain'}).getvalue())
+    container.restore(str(tmpdir), 'plain')
+    assert dc.files == {'data/plain': 'plain'}
+
+    with pytest.raises(RuntimeError) as e:
+        container.restore(str(tmpdir), 'missing')
+    assert 'missing.tar.gz, missing.tar.zst, missing.tar' in str(e.value)
+
+
+def test_volume_archives():
+    assert volume_archives(
+        ['/data', '/var/lib/mysql', '/var/lib_mysql', '/'], 'db',
+        GzipCodec()) == [
+            'db/data.tar.gz', 'db/var_lib_mysql.tar.gz',
+            'db/var_lib_mysql_2.tar.gz', 'db/root.tar.gz']
+
+
+def test_backup_per_volume(tmpdir):
+    dc = ArchiveDocker({
+        '/data': {'file': 'data'},
+        '/var/lib/mysql': {'ibdata': 'mysql'},
+    })
+    container = DockerContainer(dc, 'test', creation={}, startup={})
+    container.backup(None, str(tmpdir), 'backup')
+    container.backup(None, str(tmpdir), 'backup', True, None, True)
+    # the single archive is replaced by the archives of the volumes
+    assert sorted(f.basename for f in tmpdir.listdir()) == [
+        'backup', 'backup.manifest.yaml']
+    assert sorted(f.basename for f in tmpdir.join('backup').listdir()) == [
+        'data.tar.gz', 'var_lib_mysql.tar.gz']
+    manifest = yaml.safe_load(tmpdir.join('backup.manifest.yaml').read())
+    assert manifest['codec'] == 'gzip'
+    assert [(v['source'], v['archive'], v['files'])
+            for v in manifest['volumes']] == [
+        ('/data', 'backup/data.tar.gz', 2),
+        ('/var/lib/mysql', 'backup/var_lib_mysql.tar.gz', 2)]
+    assert _members(str(tmpdir.join('backup/var_lib_mysql.tar.gz'))) == {
+        'var/lib/mysql': None, 'var/lib/mysql/ibdata': 'mysql'}
+
+    # the restore uses the manifest
+    container.restore(str(tmpdir), 'backup')
+    assert len(dc.restored) == 2
+    assert dc.files == {
+        'data': None, 'data/file': 'data', 'var/lib/mysql': None,
+        'var/lib/mysql/ibdata': 'mysql'}
+
+    tmpdir.join('backup/data.tar.gz').remove()
+    with pytest.raises(RuntimeError) as e:
+        container.restore(str(tmpdir), 'backup')
+    assert 'data.tar.gz of the manifest are missing' in str(e.value)
+
+
+def test_backup_per_volume_failure(tmpdir):
+    dc = ArchiveDocker({'/data': {'file': 'old'}, '/logs': {'log': 'old'}})
+    container = DockerContainer(dc, 'test', creation={}, startup={})
+    container.backup(None, str(tmpdir), 'backup', per_volume=True)
+    manifest = tmpdir.join('backup.manifest.yaml').read()
+
+    # a backup failing on the second volume leaves the earlier one intact
+    dc.volumes = {'/data': {'file': 'new'}}
+    with pytest.raises(RuntimeError):
+        container.backup(
+            ['/data', '/logs'], str(tmpdir), 'backup', True, None, True)
+    assert sorted(f.basename for f in tmpdir.listdir()) == [
+        'backup', 'backup.manifest.yaml']
+    assert tmpdir.join('backup.manifest.yaml').read() == manifest
+    assert _members(str(tmpdir.join('backup/data.tar.gz')))['data/file'] == (
+        'old')
+
+    container.restore(str(tmpdir), 'backup')
+    assert dc.files == {
+        'data': None, 'data/file': 'old', 'logs': None, 'logs/log': 'old'}
+
+
+@pytest.mark.parametrize('renames,expected', [
+    (0, 'old'), (1, 'old'), (2, 'new'), (3, 'new')])
+def test_backup_per_volume_crash(tmpdir, monkeypatch, renames, expected):
+    dc = ArchiveDocker({'/data': {'file': 'old'}})
+    container = DockerContainer(dc, 'test', creation={}, startup={})
+    container.backup(None, str(tmpdir), 'backup', per_volume=True)
+
+    # the backup crashes after the first ``renames`` steps of the swap
+    rename = docker_meta.backup.os.rename
+    calls = []
+
+    def crashing_rename(src, dst):
+        if '.tar' not in src:
+            if len(calls) == renames:
+                raise OSError('crash')
+            calls.append(src)
+        rename(src, dst)
+
+    monkeypatch.setattr(docker_meta.backup.os, 'rename', crashing_rename)
+    dc.volumes = {'/data': {'file': 'new'}}
+    if renames < 3:
+        with pytest.raises(OSError):
+            container.backup(None, str(tmpdir), 'backup', True, None, True)
+    else:
+        container.backup(None, str(tmpdir), 'backup', True, None, True)
+    monkeypatch.setattr(docker_meta.backup.os, 'rename', rename)
+
+    # either backup is found, and the leftovers are cleaned up
+    container.restore(str(tmpdir), 'backup')
+    assert dc.files['data/file'] == expected
+    assert sorted(f.basename for f in tmpdir.listdir()) in [
+        ['backup', 'backup.manifest.yaml'],
+        ['backup', 'backup.manifest.yaml', 'backup.partial']]
+
+
+def test_backup_limits(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(time, 'time', lambda: 100.)
+    monkeypatch.setattr(time, 'sleep', sleeps.append)
+    limits = BackupLimits(streams=2, bandwidth=1000)
+    # a second worth of data passes without waiting
+    limits.throttle(1000)
+    limits.throttle(1500)
+    limits.throttle(500)
+    assert sleeps == [1.5, 2.]
+
+    limits.configure(1, None)
+    limits.throttle(10 ** 6)
+    assert sleeps == [1.5, 2.]
+    with limits.stream('a'):
+        assert not limits._semaphore.acquire(False)
+
+
+def test_backup_streams(tmpdir, monkeypatch):
+    limits = BackupLimits(streams=1)
+    monkeypatch.setattr(docker_meta.backup, 'default_backup_limits', limits)
+    active = []
+    streams = []
+
+    class SlowDocker(ArchiveDocker):
+
+        def get_archive(self, container, path):
+            active.append(path)
+            streams.append(len(active))
+            time.sleep(0.01)
+            res = super(SlowDocker, self).get_archive(container, path)
+            active.remove(path)
+            return res
+
+    dc = SlowDocker(dict(
+        ('/volume{}'.format(i), {'file': str(i)}) for i in range(4)))
+    container = DockerContainer(dc, 'test', creation={}, startup={})
+    container.backup(None, str(tmpdir), 'backup', per_volume=True)
+    assert len(dc.archived) == 4
+    assert max(streams) == 1
+    assert threading.active_count() < 10
+
+
+def test_backup_incremental(tmpdir, monkeypatch):
+    monkeypatch.setattr(docker_meta.backup, 'CHUNK_SIZE', 4096)
+    times = iter(['20260101T000000', '20260101T000000', '20260102T000000'])
+    monkeypatch.setattr(
+        docker_meta.backup.time, 'strftime', lambda f: next(times))
+    small = dict(('small{}'.format(i), str(i) * 100) for i in range(100))
+    files = dict(small, large=''.join(str(i) for i in range(3000)))
+    dc = ArchiveDocker({'/data': files})
+    container = DockerContainer(dc, 'test', creation={}, startup={})
+    container.backup(None, str(tmpdir), 'test', incremental=True)
+    chunks = tmpdir.join('chunks').visit('*.gz')
+    first = len(list(chunks))
+    assert first > 5
+
+    # an added file and a changed large file only store a few new chunks
+    dc.volumes['/data'] = dict(
+        files, added='new', large='x' + files['large'][1:])
+    container.backup(None, str(tmpdir), 'test', incremental=True)
+    assert len(list(tmpdir.join('chunks').visit('*.gz'))) - first <= 4
+    assert list_snapshots(str(tmpdir), 'test') == [
+        '20260101T000000', '20260101T000000-2']
+
+    container.restore(str(tmpdir), 'test')
+    assert dc.files['data/added'] == 'new'
+    assert dc.files['data/large'][0] == 'x'
+    assert len(dc.files) == 103
+
+    dc.files = {}
+    container.restore(str(tmpdir), 'test', '20260101T000000')
+    assert dc.files == dict(
+        [('data', None)] +
+        [('data/' + name, data) for name, data in files.items()])
+
+    with pytest.raises(RuntimeError) as e:
+        container.restore(str(tmpdir), 'test', 'unknown')
+    assert 'Choose one of 20260101T000000, 20260101T000000-2' in str(
+        e.value)
+
+    # a newer full backup is restored instead of the snapshot
+    for snapshot in tmpdir.join('test.snapshots').listdir():
+        snapshot.setmtime(0)
+    dc.volumes['/data'] = {'full': 'full'}
+    container.backup(None, str(tmpdir), 'test')
+    dc.files = {}
+    container.restore(str(tmpdir), 'test')
+    assert dc.files == {'data': None, 'data/full': 'full'}
+
+
+def test_backup_failure(tmpdir):
+    dc = ArchiveDocker({'/data': {'file': 'data'}})
+    container = DockerContainer(dc, 'test', creation={}, startup={})
+    with pytest.raises(RuntimeError):
+        container.backup(['/data', '/missing'], str(tmpdir), 'backup')
+    assert tmpdir.listdir() == []
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+import os
+import tarfile
+import time
+
+import docker_meta.build_context
+from docker_meta.build_context import (
+    context_digest, context_files, is_remote, label_dockerfile,
+    labelled_context, stream_context, ContextStream, DigestCache)
+
+
+def make_context(tmpdir):
+    tmpdir.join('Dockerfile').write('FROM busybox\nCMD ["true"]\n')
+    tmpdir.join('.dockerignore').write('*.log\nbuild\n')
+    tmpdir.join('app.py').write('print "hello"\n')
+    tmpdir.join('debug.log').write('ignored')
+    tmpdir.join('build').ensure_dir().join('out').write('ignored')
+    tmpdir.join('src').ensure_dir().join('module.py').write('x = 1\n')
+    return str(tmpdir)
+
+
+def test_context_files(tmpdir):
+    path = make_context(tmpdir)
+    assert context_files(path) == [
+        '.dockerignore', 'Dockerfile', 'app.py', 'src', 'src/module.py']
+
+
+def test_context_digest(tmpdir):
+    path = make_context(tmpdir)
+    digest = context_digest(path)
+    assert context_digest(path) == digest
+
+    # ignored files do not change the digest
+    tmpdir.join('other.log').write('ignored')
+    assert context_digest(path) == digest
+
+    tmpdir.join('src').join('module.py').write('x = 2\n')
+    assert context_digest(path) != digest
+
+
+def test_digest_cache(tmpdir, monkeypatch):
+    path = make_context(tmpdir.join('context').ensure_dir())
+    # files modified in the last seconds are never cached
+    recent = tmpdir.join('context', 'recent.py')
+    recent.write('y = 1\n')
+    old = time.time() - 60
+    for name in context_files(path):
+        if name != 'recent.py':
+            os.utime(os.path.join(path, name), (old, old))
+    filename = str(tmpdir.join('digests.json'))
+    digest = context_digest(path, cache=DigestCache(filename))
+    assert digest == context_digest(path)
+    with open(filename, 'r') as fh:
+        assert sorted(json.load(fh)) == [
+            os.path.join(path, name) for name in [
+                '.dockerignore', 'Dockerfile', 'app.py', 'src/module.py']]
+
+    read = []
+    file_digest = docker_meta.build_context._file_digest
+
+    def _file_digest(filename):
+        read.append(os.path.relpath(filename, path))
+        return file_digest(filename)
+
+    monkeypatch.setattr(
+        docker_meta.build_context, '_file_digest', _file_digest)
+    cache = DigestCache(filename)
+    assert context_digest(path, cache=cache) == digest
+    assert read == ['recent.py']
+
+    del read[:]
+    tmpdir.join('context', 'src', 'module.py').write('x = 2\n')
+    tmpdir.join('context', 'app.py').remove()
+    assert context_digest(path, cache=cache) != digest
+    assert read == ['recent.py', 'src/module.py']
+    assert os.path.join(path, 'app.py') not in DigestCache(filename)._load()
+
+
+def test_is_remote():
+    assert is_remote('git://github.com/docker/docker')
+    assert not is_remote('services/gitolite')
+
+
+def test_label_dockerfile():
+    assert label_dockerfile('FROM busybox\n', {}) == 'FROM busybox\n'
+    assert label_dockerfile('FROM busybox\n\n', {'b': '2', 'a': '1'}) == (
+        'FROM busybox\nLABEL "a"="1" "b"="2"\n')
+
+
+def test_labelled_context(tmpdir):
+    path = make_context(tmpdir)
+    tmpdir.join('link').mksymlinkto('app.py')
+    t = tarfile.open(
+        fileobj=labelled_context(path, labels={'a': '1'}), mode='r|')
+    contents = {}
+    for info in t:
+        contents[info.name] = (
+            info.issym() and info.linkname or
+            info.isfile() and t.extractfile(info).read() or info.type)
+    assert sorted(contents) == context_files(path)
+    assert contents['Dockerfile'] == (
+        'FROM busybox\nCMD ["true"]\nLABEL "a"="1"\n')
+    assert contents['app.py'] == 'print "hello"\n'
+    assert contents['src'] == tarfile.DIRTYPE
+    assert contents['link'] == 'app.py'
+
+
+def test_stream_context(tmpdir):
+    path = make_context(tmpdir)
+    tmpdir.join('large').write('x' * 200000)
+    chunks = list(stream_context(path))
+    # files are streamed in chunks
+    assert max(len(chunk) for chunk in chunks) <= 65536
+    content = ''.join(chunks)
+    assert len(content) % tarfile.BLOCKSIZE == 0
+    t = tarfile.open(fileobj=io.BytesIO(content))
+    assert t.extractfile('large').read() == 'x' * 200000
+
+
+def test_context_stream_read():
+    stream = ContextStream(['abc', '', 'defg', 'h'])
+    assert stream.read(2) == 'ab'
+    assert stream.read(3) == 'cde'
+    assert ''.join(stream) == 'fgh'
+    assert stream.read(2) == ''
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
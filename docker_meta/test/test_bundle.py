@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import io
+import json
+import tarfile
+
+import pytest
+
+from docker_meta.bundle import chain_ids, load_bundle, write_bundle
+from docker_meta.container import bundle_images
+
+
+def _sha(data):
+    return 'sha256:' + hashlib.sha256(data).hexdigest()
+
+
+def _add(tar, name, data, linkname=None):
+    info = tarfile.TarInfo(name)
+    if linkname:
+        info.type = tarfile.SYMTYPE
+        info.linkname = linkname
+        tar.addfile(info)
+    else:
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+
+
+def docker_save(images):
+    """
+    returns an archive like ``docker save`` of the ``images`` mapping tags
+    to the contents of their layers.  Identical layers are stored once, and
+    referred to with symbolic links by later images.
+    """
+    fh = io.BytesIO()
+    manifest = []
+    stored = {}
+    chains_stored = set([])
+    with tarfile.open(fileobj=fh, mode='w') as tar:
+        for tag, layers in sorted(images.items()):
+            paths = []
+            chains = chain_ids([_sha(layer) for layer in layers])
+            for layer, chain in zip(layers, chains):
+                directory = chain[7:19]
+                path = '{}/layer.tar'.format(directory)
+                if chain not in chains_stored:
+                    if _sha(layer) in stored:
+                        _add(tar, path, None, '../{}'.format(
+                            stored[_sha(layer)]))
+                    else:
+                        _add(tar, path, layer)
+                        stored[_sha(layer)] = path
+                    chains_stored.add(chain)
+                paths.append(path)
+            config = json.dumps(
+                {'rootfs': {'diff_ids': [_sha(layer) for layer in layers]}})
+            _add(tar, _sha(config)[7:] + '.json', config)
+            manifest.append({
+                'Config': _sha(config)[7:] + '.json', 'RepoTags': [tag],
+                'Layers': paths})
+        _add(tar, 'manifest.json', json.dumps(manifest))
+    fh.seek(0)
+    return fh
+
+
+class LoadResponse(object):
+
+    def __init__(self, lines):
+        self.lines = lines
+
+    def iter_lines(self):
+        return iter(self.lines)
+
+
+class BundleDocker(object):
+    """
+    a docker client stand-in with the ``images`` mapping tags to the contents
+    of their layers, that records the loaded archives.
+    """
+
+    base_url = 'bundle'
+
+    def __init__(self, images):
+        self.local = images
+        self.loaded = []
+        self.pulled = []
+        self.load_output = ['{"stream": "Loaded image: test:latest"}']
+
+    def images(self, name=None):
+        return [
+            {'Id': tag, 'RepoTags': [tag]} for tag in sorted(self.local)
+            if name in [None, tag.rpartition(':')[0]]]
+
+    def inspect_image(self, image):
+        return {'RootFS': {
+            'Layers': [_sha(layer) for layer in self.local[image]]}}
+
+    def pull(self, repository, tag, stream):
+        self.pulled.append('{}:{}'.format(repository, tag))
+        self.local['{}:{}'.format(repository, tag)] = ['pulled']
+        return iter(['{"status": "Downloaded"}'])
+
+    def _url(self, path):
+        return path
+
+    def _raise_for_status(self, res):
+        pass
+
+    def _post(self, url, params=None, data=None, stream=False):
+        assert url == '/images/load'
+        fh = io.BytesIO(data.read())
+        with tarfile.open(fileobj=fh, mode='r:') as tar:
+            self.loaded.append(dict(
+                (m.name, tar.extractfile(m).read() if m.isreg() else
+                 m.linkname) for m in tar.getmembers()))
+        return LoadResponse(self.load_output)
+
+
+def _layers(loaded):
+    """
+    returns the contents of the layer files of a loaded archive and the
+    number of links to layer files.
+    """
+    layers = [v for k, v in loaded.items() if k.endswith('layer.tar')]
+    links = [v for v in layers if v.startswith('../')]
+    return sorted(set(layers) - set(links)), len(links)
+
+
+def test_chain_ids():
+    assert chain_ids([]) == []
+    assert chain_ids(['sha256:a', 'sha256:b']) == [
+        'sha256:a', _sha('sha256:a sha256:b')]
+
+
+def test_bundle(tmpdir):
+    images = {
+        'base:latest': ['base layer'],
+        'web:latest': ['base layer', 'web layer'],
+        'db:latest': ['base layer', 'db layer', 'web layer'],
+        'other:latest': ['web layer'],
+    }
+    plan = {
+        'unitcommand': 'unit/start', 'configurations': {},
+        'order_list': []}
+    filename = str(tmpdir.join('unit_start.bundle.tar'))
+    write_bundle(filename, plan, sorted(images), docker_save(images))
+    with tarfile.open(filename, 'r:') as tar:
+        names = tar.getnames()
+    assert 'bundle.yaml' in names and 'plan.yaml' in names
+    # the layers are stored once, and linked to by other images
+    assert len([n for n in names if n.endswith('layer.tar')]) == 5
+
+    # a new host receives all layers
+    dc = BundleDocker({})
+    assert load_bundle(dc, filename) == plan
+    assert _layers(dc.loaded[0]) == (
+        ['base layer', 'db layer', 'web layer'], 2)
+    assert 'manifest.json' in dc.loaded[0]
+
+    # a host with the base image receives the other layers
+    dc = BundleDocker({'base:latest': ['base layer']})
+    load_bundle(dc, filename)
+    assert _layers(dc.loaded[0]) == (['db layer', 'web layer'], 2)
+
+    # a host with all images receives no layers
+    dc = BundleDocker(images)
+    load_bundle(dc, filename)
+    assert _layers(dc.loaded[0]) == ([], 0)
+    assert len([k for k in dc.loaded[0] if k.endswith('.json')]) == 5
+
+    # errors reported by the daemon fail the import
+    dc.load_output = [
+        '{"stream": "Loading layer"}',
+        '{"errorDetail": {"message": "no space left on device"}, '
+        '"error": "no space left on device"}']
+    with pytest.raises(RuntimeError) as e:
+        load_bundle(dc, filename)
+    assert 'no space left on device' in str(e.value)
+
+
+def test_bundle_images():
+    dc = BundleDocker({'busybox:latest': ['busybox']})
+    configurations = {
+        'data': {'creation': {'image': 'busybox'}},
+        'web': {'creation': {'image': 'nginx', 'tag': '1.11'}},
+        'other': {'creation': {'image': 'nginx:1.11'}},
+    }
+    order_list = [
+        {'data': {'command': 'create'}},
+        {'web': {'command': 'start'}},
+        {'other': {'command': 'start'}},
+        {'host': {'command': 'execute', 'run': ['true']}},
+    ]
+    assert bundle_images(None, configurations, order_list, dc) == [
+        'busybox:latest', 'nginx:1.11']
+    assert dc.pulled == ['nginx:1.11']
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+import hashlib
+
+import pytest
+
+from docker_meta.chunk_store import ChunkStore
+from docker_meta.compression import GzipCodec
+
+
+def test_chunk_store(tmpdir):
+    store = ChunkStore(str(tmpdir), GzipCodec(threads=1))
+    digest = store.put('chunk')
+    assert digest == hashlib.sha256('chunk').hexdigest()
+    assert tmpdir.join(digest[:2], digest + '.gz').exists()
+    assert store.put('chunk') == digest
+    store.put('other')
+    assert (store.chunks, store.new_chunks) == (3, 2)
+    assert store.get(digest) == 'chunk'
+
+    tmpdir.join(digest[:2], digest + '.gz').write_binary(
+        GzipCodec().compress('x'))
+    with pytest.raises(RuntimeError) as e:
+        store.get(digest)
+    assert 'is corrupted' in str(e.value)
+    with pytest.raises(RuntimeError) as e:
+        store.get('0' * 64)
+    assert 'is missing' in str(e.value)
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
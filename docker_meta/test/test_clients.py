@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import BaseHTTPServer
+import json
+import SocketServer
+import threading
+
+import pytest
+import yaml
+from docker.constants import DEFAULT_DOCKER_API_VERSION
+
+from docker_meta.clients import ClientFactory
+
+
+@pytest.fixture
+def fake_daemon(request):
+    """
+    a fake docker daemon with keep-alive connections, that records the
+    requested paths and the client ports they came from.
+    """
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+        api_version = '1.22'
+        requests = []
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            self.server.requests.append((self.path, self.client_address[1]))
+            if self.path.endswith('/version'):
+                body = json.dumps({'ApiVersion': self.server.api_version})
+            else:
+                body = json.dumps({'Containers': 0})
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    request.addfinalizer(server.shutdown)
+    server.url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    return server
+
+
+def test_client_factory(fake_daemon, tmpdir):
+    cache = str(tmpdir.join('api_versions.yaml'))
+    factory = ClientFactory(cache)
+    client = factory.get(fake_daemon.url)
+    assert factory.get(fake_daemon.url) is client
+    assert client.api_version == '1.22'
+
+    client.info()
+    client.info()
+    assert [path for path, _ in fake_daemon.requests] == [
+        '/version', '/v1.22/info', '/v1.22/info']
+    # all requests share one keep-alive connection
+    assert len(set(port for _, port in fake_daemon.requests)) == 1
+
+    with open(cache, 'r') as fh:
+        assert yaml.safe_load(fh)[fake_daemon.url]['version'] == '1.22'
+
+    # a new process reuses the cached version
+    del fake_daemon.requests[:]
+    client = ClientFactory(cache).get(fake_daemon.url)
+    assert client.api_version == '1.22'
+    assert fake_daemon.requests == []
+
+    # ... until it expires
+    factory = ClientFactory(cache)
+    factory.max_age = 0
+    fake_daemon.api_version = '99.0'
+    client = factory.get(fake_daemon.url)
+    assert client.api_version == DEFAULT_DOCKER_API_VERSION
+    assert [path for path, _ in fake_daemon.requests] == ['/version']
+
+
+def test_client_factory_unreachable(tmpdir):
+    cache = tmpdir.join('api_versions.yaml')
+    client = ClientFactory(str(cache)).get('http://127.0.0.1:1')
+    assert client.api_version == DEFAULT_DOCKER_API_VERSION
+    assert not cache.check()
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import gzip
+import io
+import zlib
+
+import pytest
+
+from docker_meta.compression import (
+    BlockWriter, get_codec, has_zstd, GzipCodec)
+
+
+def test_gzip_codec():
+    codec = GzipCodec(level=1, threads=3)
+    codec.block_size = 1000
+    data = ''.join(str(i) for i in range(2000))
+    fh = io.BytesIO()
+    writer = codec.writer(fh)
+    for start in range(0, len(data), 300):
+        writer.write(data[start:start + 300])
+    writer.close()
+    # every block is a separate gzip member
+    assert writer.blocks == len(data) // 1000 + 1
+    fh.seek(0)
+    assert codec.reader(fh).read() == data
+    assert gzip.GzipFile(fileobj=io.BytesIO(fh.getvalue())).read() == data
+
+
+def test_gzip_codec_empty():
+    fh = io.BytesIO()
+    writer = GzipCodec().writer(fh)
+    writer.close()
+    assert writer.blocks == 1
+    assert zlib.decompress(fh.getvalue(), 31) == ''
+
+
+def test_block_writer_error():
+
+    def compress(data):
+        if data == 'b':
+            raise IOError('disk full')
+        return data
+
+    fh = io.BytesIO()
+    writer = BlockWriter(fh, compress, 2, 1)
+    with pytest.raises(IOError):
+        writer.write('abc')
+        writer.close()
+    assert not writer._workers
+
+
+def test_get_codec():
+    assert get_codec().name == 'gzip'
+    codec = get_codec({'codec': 'gzip', 'level': 9, 'threads': 2})
+    assert (codec.level, codec.threads) == (9, 2)
+    with pytest.raises(ValueError) as e:
+        get_codec('lzma')
+    assert 'Unknown compression codec lzma' in str(e.value)
+    with pytest.raises(ValueError):
+        get_codec({'level': 10})
+
+
+@pytest.mark.skipif(not has_zstd, reason='zstandard is not installed')
+def test_zstd_codec():
+    codec = get_codec({'codec': 'zstd', 'threads': 2})
+    codec.block_size = 100
+    fh = io.BytesIO()
+    writer = codec.writer(fh)
+    writer.write('x' * 1000)
+    writer.close()
+    fh.seek(0)
+    assert codec.reader(fh).read() == 'x' * 1000
+
+
+@pytest.mark.skipif(has_zstd, reason='zstandard is installed')
+def test_zstd_missing():
+    with pytest.raises(ValueError) as e:
+        get_codec('zstd')
+    assert 'requires the python package zstandard' in str(e.value)
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
@@ -57,7 +57,7 @@ def test_create_unit_configuration():
 
 @pytest.mark.parametrize('cmdline,expect', [
     ('run -H 172.17.42.1:4243 --print-only unit/start rest -c -v', {
-        'subparser': 'run', 'daemon': '172.17.42.1:4243',
+        'subparser': 'run', 'daemon': ['172.17.42.1:4243'],
         'print_only': True, 'unitcommand': 'unit/start',
         'args': ['rest', '-c', '-v']
         }),
@@ -274,6 +274,17 @@ test_configurations2 = {
     ), (
         dummy_modify_init_order_list,
         'build', ([{'x2_with_build': {'command': 'build'}}], None)
+    ), (
+        dummy_modify_init_order_list + [
+            {'x3_pulled': {'command': 'start'}},
+            {'x4_pulled': {'command': 'create'}},
+            {'x5_same_image': {'command': 'create'}},
+        ],
+        'build', ([
+            {'x2_with_build': {'command': 'build'}},
+            {'x3_pulled': {'command': 'build'}},
+            {'x4_pulled': {'command': 'build'}},
+        ], None)
     ), (
         dummy_modify_init_order_list,
         'create', ([
@@ -305,12 +316,14 @@ test_configurations2 = {
             {'x1_without_build': {
                 'command': 'backup',
                 'backup_dir': 'BACKUPDIR',
-                'backup_name': 'x1_without_build'
+                'backup_name': 'x1_without_build',
+                'per_volume': True
             }},
             {'x2_with_build': {
                 'command': 'backup',
                 'backup_dir': 'BACKUPDIR',
-                'backup_name': 'x2_with_build'
+                'backup_name': 'x2_with_build',
+                'per_volume': True
             }}], None)
     ), (
         dummy_modify_init_order_list,
@@ -328,8 +341,8 @@ test_configurations2 = {
     )
     ],
     ids=[
-        'stop', 'cleanup', 'purge', 'restart', 'build', 'create',
-        'test', 'testfull', 'testproduction', 'backup', 'restore',
+        'stop', 'cleanup', 'purge', 'restart', 'build', 'build_pulls',
+        'create', 'test', 'testfull', 'testproduction', 'backup', 'restore',
     ])
 def test_modify_order_list(test_init, init, command, expected):
 
@@ -340,6 +353,9 @@ def test_modify_order_list(test_init, init, command, expected):
     configurations = {
         'x1_without_build': {},
         'x2_with_build': {'build': {'tag': 'test'}},
+        'x3_pulled': {'creation': {'image': 'nginx'}},
+        'x4_pulled': {'creation': {'image': 'redis'}},
+        'x5_same_image': {'creation': {'image': 'redis', 'tag': 'latest'}},
     }
 
     new_configurations, new_order = c.modify_order_list(
@@ -365,6 +381,30 @@ def test_modify_order_list(test_init, init, command, expected):
     assert (_rearrange(new_order) == _rearrange(expected_order))
 
 
+def test_modify_order_list_builds(test_init):
+    c, etcdir = test_init
+    for path, dockerfile in [
+            ('app', 'FROM test/base AS builder\nFROM scratch\n'),
+            ('base', 'FROM busybox\n')]:
+        etcdir.join('builds', path).ensure_dir().join('Dockerfile').write(
+            dockerfile)
+    configurations = {
+        'app': {'build': {'path': 'builds/app', 'tag': 'test/app'}},
+        'base': {'build': {'path': 'builds/base', 'tag': 'test/base'}},
+        'base_user': {'creation': {'image': 'test/base:latest'}},
+        'busybox': {'creation': {'image': 'busybox'}},
+    }
+    init = [{name: {'command': 'start'}} for name in sorted(configurations)]
+
+    _, new_order = c.modify_order_list(configurations, init, 'build')
+    # the image of base is built before app, and not pulled for base_user
+    assert new_order == [
+        {'base': {'command': 'build'}},
+        {'app': {'command': 'build'}},
+        {'busybox': {'command': 'build'}},
+    ]
+
+
 def test_list_units(test_init):
     c, etcdir = test_init
 
@@ -1,3 +1,4 @@
+import copy
 import logging
 import os
 import re
@@ -12,7 +13,9 @@ import yaml
 import docker_meta
 from docker_meta.configurations import (Configuration)
 from docker_meta.container import (
-    DockerContainer, run_configuration, main_run, main_help, main)
+    DockerContainer, run_configuration, main_run, main_help, main,
+    FINGERPRINT_LABEL)
+from docker_meta.state import DockerState
 from docker_meta.logger import (
     configure_logger, last_info_line, last_error_line)
 
@@ -450,12 +453,15 @@ default_events = [
     ('start', ['x3', False, False, 10]), 12,
     ('create', ['x2']), 0,
     ('build_image', ['x1']), 0,
-    ('backup', ['x1', '/volume', os.getcwd(), 'testbackup', False]), 0,
-    ('restore', ['x1', os.getcwd(), 'testbackup']), 0,
+    ('backup', [
+        'x1', '/volume', os.getcwd(), 'testbackup', False, None, False,
+        False]), 0,
+    ('restore', ['x1', os.getcwd(), 'testbackup', None]), 0,
     ('stop', ['x1', 3]), 0,
     ('remove', ['x1', False, 10]), 0,
-    ('backup', ['x2', None, os.getcwd(), 'backup', False]), 0,
-    ('restore', ['x2', os.getcwd(), 'backup']), 0,
+    ('backup', [
+        'x2', None, os.getcwd(), 'backup', False, None, False, False]), 0,
+    ('restore', ['x2', os.getcwd(), 'backup', None]), 0,
     ('execute', ['x2', ['rm', '/var/cache'], False, {}]), 0,
     ('execute', ['host', ['echo', 'hallo'], True, {}]), 0,
     ('remove_image', ['x1', False, False]), 0,
@@ -661,6 +667,151 @@ def test_creation_manipulation():
     assert set(dc.creation['ports']) == set(ports)
 
 
+class FingerprintDocker(object):
+    """
+    a docker client stand-in for the fingerprint based creation plans.
+    """
+
+    def __init__(self, container_labels=None, image_labels=None,
+                 volumes={}):
+        self.calls = []
+        self._containers = []
+        self._images = []
+        self._volumes = volumes
+        if container_labels is not None:
+            self._containers.append({
+                'Id': 'cid', 'Names': ['/test'], 'State': 'exited',
+                'Labels': container_labels})
+        if image_labels is not None:
+            self._images.append({
+                'Id': 'iid', 'RepoTags': ['test/image:latest'],
+                'Labels': image_labels})
+
+    def containers(self, all=False):
+        return self._containers
+
+    def images(self):
+        return self._images
+
+    def inspect_container(self, name):
+        return {
+            'HostConfig': {'Binds': None, 'VolumesFrom': None},
+            'Volumes': self._volumes}
+
+    def create_container(self, **kwargs):
+        self.calls.append(('create_container', kwargs['labels']))
+        return {'Id': 'new', 'Warnings': None}
+
+    def remove_container(self, container, v):
+        self.calls.append(('remove_container', container['Id']))
+
+    def build(self, **kwargs):
+        self.calls.append(('build', kwargs['fileobj'].read()))
+        return []
+
+
+def _fingerprint_container(dc, command='true'):
+    return DockerContainer(
+        dc, 'test', creation={'command': command},
+        build={'fileobj': BytesIO('FROM busybox\n'), 'tag': 'test/image'},
+        state=DockerState(dc))
+
+
+def test_plan_create():
+    container = _fingerprint_container(FingerprintDocker())
+    assert container.plan_create() == 'create'
+    fp = container.container_fingerprint()
+    assert fp == _fingerprint_container(None).container_fingerprint()
+    assert fp != _fingerprint_container(None, 'false').container_fingerprint()
+
+    for labels, plan in [
+            ({}, 'skip'),
+            ({FINGERPRINT_LABEL: fp}, 'skip'),
+            ({FINGERPRINT_LABEL: 'outdated'}, 'recreate')]:
+        container = _fingerprint_container(FingerprintDocker(labels))
+        assert container.plan_create() == plan
+
+
+def test_create_keeps_configuration():
+    creation = {'image': 'busybox', 'labels': {'app': 'test'}}
+    configuration = {'creation': creation, 'startup': {}}
+    expected = copy.deepcopy(configuration)
+    dc = FingerprintDocker()
+    DockerContainer(
+        dc, 'test', state=DockerState(dc), **configuration).create()
+    assert configuration == expected
+
+
+@pytest.mark.parametrize('volumes,expected_calls', [
+    ({}, ['remove_container', 'create_container']),
+    ({'/data': '/var/lib/docker/vfs/data'}, []),
+])
+def test_create_recreates_outdated(volumes, expected_calls):
+    dc = FingerprintDocker({FINGERPRINT_LABEL: 'outdated'}, volumes=volumes)
+    container = _fingerprint_container(dc)
+    container.create()
+    assert [c[0] for c in dc.calls] == expected_calls
+    if expected_calls:
+        assert dc.calls[1][1] == {
+            FINGERPRINT_LABEL: container.container_fingerprint()}
+        assert container.plan_create() == 'skip'
+
+
+def test_plan_build():
+    container = _fingerprint_container(FingerprintDocker())
+    assert container.plan_build() == 'build'
+    fp = container.image_fingerprint()
+
+    for labels, plan in [
+            ({}, 'rebuild'),
+            ({FINGERPRINT_LABEL: fp}, 'skip'),
+            ({FINGERPRINT_LABEL: 'outdated'}, 'rebuild')]:
+        dc = FingerprintDocker(image_labels=labels)
+        container = _fingerprint_container(dc)
+        assert container.plan_build() == plan
+        container.build_image()
+        if plan == 'skip':
+            assert dc.calls == []
+        else:
+            assert dc.calls == [(
+                'build',
+                'FROM busybox\nLABEL "{}"="{}"\n'.format(
+                    FINGERPRINT_LABEL, fp))]
+
+    dc = FingerprintDocker()
+    container = DockerContainer(
+        dc, 'test', creation={'image': 'busybox'}, state=DockerState(dc))
+    assert container.plan_build() == 'pull'
+
+
+def test_image_fingerprint_cwd(tmpdir, monkeypatch):
+    config = Configuration(str(tmpdir))
+    tmpdir.join('data', 'repositories').ensure_dir().join(
+        'Dockerfile').write('FROM busybox\n')
+
+    def _fingerprint(dc=FingerprintDocker()):
+        return DockerContainer(
+            dc, 'test', creation={}, startup={},
+            build={'path': 'data/repositories', 'tag': 'test/image'},
+            global_config=config, state=DockerState(dc)).image_fingerprint()
+
+    monkeypatch.chdir(tmpdir)
+    fp = _fingerprint()
+    monkeypatch.chdir(tmpdir.join('data'))
+    assert _fingerprint() == fp
+
+    tmpdir.join('data', 'repositories').remove()
+    with pytest.raises(ValueError) as e:
+        _fingerprint()
+    assert 'does not exist' in str(e.value)
+
+    # existing images are used without their build context
+    dc = FingerprintDocker(image_labels={FINGERPRINT_LABEL: fp})
+    assert _fingerprint(dc) == fp
+    dc = FingerprintDocker(image_labels={})
+    assert _fingerprint(dc) is not None
+
+
 def test_statistics():
     """
     checks that the runtime statistics (junits) are collected correctly.
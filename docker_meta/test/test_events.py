@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+from docker_meta.container import DockerContainer
+from docker_meta.events import EventMonitor, parse_event
+from docker_meta.state import DockerState
+
+
+def new_event(action, container_id='cid', name='test', exit_code=None):
+    attributes = {'name': name}
+    if exit_code is not None:
+        attributes['exitCode'] = str(exit_code)
+    return {
+        'Type': 'container', 'Action': action, 'status': action,
+        'id': container_id,
+        'Actor': {'ID': container_id, 'Attributes': attributes}}
+
+
+@pytest.mark.parametrize('event,expected', [
+    (new_event('die', exit_code=3), ('cid', 'test', 'die', 3)),
+    (new_event('start'), ('cid', 'test', 'start', None)),
+    ({'status': 'start', 'id': 'cid', 'from': 'busybox'},
+     ('cid', None, 'start', None)),
+    ({'Type': 'image', 'Action': 'pull', 'Actor': {'ID': 'busybox'}}, None),
+    ({'status': 'start'}, None),
+])
+def test_parse_event(event, expected):
+    assert parse_event(event) == expected
+
+
+class EventDocker(object):
+    """
+    a docker client stand-in, that emits the events put into a queue.
+    """
+
+    def __init__(self, events=[]):
+        self.events_list = list(events)
+        self.feed = threading.Event()
+        self.waited = []
+
+    def events(self, since=None, decode=None):
+        self.feed.wait(5)
+        for event in self.events_list:
+            yield event
+
+    def containers(self, all=False):
+        return [{'Id': 'cid', 'Names': ['/test'], 'State': 'created'}]
+
+    def wait(self, container):
+        self.waited.append(container['Id'])
+        return 42
+
+
+def test_monitor_updates_state():
+    dc = EventDocker([new_event('start')])
+    state = DockerState(dc)
+    monitor = EventMonitor(dc, state)
+    assert state.monitor is monitor
+    assert not state.is_running('test')
+
+    monitor.start()
+    dc.feed.set()
+    monitor._thread.join(1)
+    assert monitor.get('cid')['status'] == 'running'
+    assert state.is_running('test')
+    # the stream ended, so the monitor is not available anymore
+    assert not monitor.available
+
+
+def test_monitor_wait_for_exit():
+    dc = EventDocker([
+        new_event('die', exit_code=137),
+        new_event('start'),
+        new_event('die', exit_code=3)])
+    monitor = EventMonitor(dc)
+    monitor.start()
+    monitor.reset('cid')
+    dc.feed.set()
+    assert monitor.wait_for_exit('cid', timeout=1) == 3
+
+
+def test_monitor_wait_timeout(monkeypatch):
+    monkeypatch.setattr(EventMonitor, 'join_timeout', 0.05)
+    dc = EventDocker()
+    monitor = EventMonitor(dc)
+    monitor.start()
+    assert monitor.wait_for_exit('cid', timeout=0.05) is None
+    monitor.stop()
+    assert monitor.wait_for_exit('cid') is None
+    dc.feed.set()
+
+
+class StreamResponse(object):
+    """
+    a streamed response of the docker daemon, that blocks on a socket.
+    """
+
+    def __init__(self):
+        self.sock, self.peer = socket.socketpair()
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+        self.peer.close()
+
+
+class StreamDocker(object):
+    """
+    a docker client stand-in, whose event stream never ends.
+    """
+
+    def __init__(self):
+        self.responses = []
+
+    def _url(self, path):
+        return path
+
+    def _get(self, url, params=None, stream=False):
+        self.responses.append(StreamResponse())
+        return self.responses[-1]
+
+    def _stream_helper(self, response, decode=False):
+        for line in iter(response.sock.makefile().readline, ''):
+            yield json.loads(line)
+
+    def _get_raw_response_socket(self, response):
+        return response.sock
+
+
+def _wait_until(condition, timeout=1):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.01)
+    assert condition()
+
+
+def test_monitor_stop_closes_stream():
+    dc = StreamDocker()
+    monitor = EventMonitor(dc)
+    monitor.start()
+    _wait_until(lambda: dc.responses)
+    dc.responses[0].peer.sendall(json.dumps(new_event('start')) + '\n')
+    _wait_until(lambda: monitor.get('cid'))
+    monitor.stop()
+    # the thread ended and closed its connection
+    assert not monitor._thread.is_alive()
+    assert [r.closed for r in dc.responses] == [True]
+
+
+def test_monitor_unavailable():
+    monitor = EventMonitor(None)
+    monitor.start()
+    monitor._thread.join(1)
+    assert not monitor.available
+
+
+@pytest.mark.parametrize('events,expected,waited', [
+    ([new_event('start'), new_event('die', exit_code=0)], 0, []),
+    ([new_event('start'), new_event('die')], 42, ['cid']),
+])
+def test_container_wait(events, expected, waited):
+    dc = EventDocker(events)
+    state = DockerState(dc)
+    monitor = EventMonitor(dc, state)
+    monitor.start()
+    container = DockerContainer(dc, 'test', state=state)
+    container._reset_events({'Id': 'cid'})
+    dc.feed.set()
+    assert container._wait({'Id': 'cid'}, timeout=1) == expected
+    assert dc.waited == waited
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
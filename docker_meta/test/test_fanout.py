@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+from argparse import Namespace
+
+import pytest
+
+import docker_meta
+from docker_meta.configurations import Configuration
+from docker_meta.container import main_run
+from docker_meta.fanout import (
+    current_host, make_thread, resolve_hosts, run_on_hosts, summarize,
+    HostFilter, HostLogCollector, DEFAULT_DAEMON)
+
+
+def test_resolve_hosts(tmpdir):
+    assert resolve_hosts() == [(DEFAULT_DAEMON, DEFAULT_DAEMON)]
+    assert resolve_hosts('tcp://a:2375') == [('tcp://a:2375', 'tcp://a:2375')]
+
+    inventory = tmpdir.join('hosts.yaml')
+    inventory.write('b: tcp://b:2375\na: tcp://a:2375\n')
+    assert resolve_hosts(['tcp://c:2375'], str(inventory)) == [
+        ('tcp://c:2375', 'tcp://c:2375'),
+        ('a', 'tcp://a:2375'),
+        ('b', 'tcp://b:2375')]
+
+    inventory.write('- tcp://a:2375\n- tcp://b:2375\n')
+    assert [name for name, _ in resolve_hosts(None, str(inventory))] == [
+        'tcp://a:2375', 'tcp://b:2375']
+
+    with pytest.raises(ValueError) as e:
+        resolve_hosts(['tcp://a:2375'], str(inventory))
+    assert 'tcp://a:2375 are given more than once' in str(e.value)
+
+    inventory.write('tcp://a:2375')
+    with pytest.raises(ValueError):
+        resolve_hosts(None, str(inventory))
+
+
+def test_run_on_hosts():
+    hosts = [('a', 'tcp://a:2375'), ('b', 'tcp://b:2375'),
+             ('c', 'tcp://c:2375')]
+    seen = []
+    lock = threading.Lock()
+
+    def _job(name, daemon):
+        result = []
+        thread = make_thread(lambda: result.append(current_host()))
+        thread.start()
+        thread.join()
+        with lock:
+            seen.append((name, daemon, current_host(), result[0]))
+        if name == 'b':
+            raise RuntimeError('failed on b')
+
+    results = run_on_hosts(hosts, _job, 2)
+    assert sorted(seen) == [
+        (name, daemon, name, name) for name, daemon in hosts]
+    assert [name for name, _ in results] == ['a', 'b', 'c']
+    assert results[0][1] is None and results[2][1] is None
+    assert str(results[1][1][1]) == 'failed on b'
+    assert current_host() is None
+
+    with pytest.raises(RuntimeError) as e:
+        summarize(results)
+    assert 'failed on 1 of 3 hosts: b' in str(e.value)
+
+
+def test_host_log():
+    log = logging.getLogger('docker_meta.test_fanout')
+    collector = HostLogCollector()
+    collector.addFilter(HostFilter())
+    log.addHandler(collector)
+    try:
+        def _job(name, daemon):
+            log.warning('careful')
+            log.info('fine')
+        run_on_hosts([('a', 'a'), ('b', 'b')], _job)
+        log.warning('outside of a host')
+    finally:
+        log.removeHandler(collector)
+
+    assert sorted(collector.records) == ['a', 'b']
+    assert [r.getMessage() for r in collector.records['a']] == [
+        '[a] careful']
+
+
+def test_main_run_on_hosts(tmpdir, monkeypatch):
+    config = Configuration(str(tmpdir))
+    config.initialize()
+    runs = []
+    lock = threading.Lock()
+
+    def _run_configuration(
+            global_config, configurations, order_list, dc, unitcommand,
+            jobs, timings, journal, check=False, prefetch=False):
+        order_list[0].values()[0].pop('command')
+        with lock:
+            runs.append((dc, jobs, journal.filename))
+
+    monkeypatch.setattr(
+        docker_meta.container, 'run_configuration', _run_configuration)
+    monkeypatch.setattr(
+        docker_meta.container, 'get_docker_client', lambda daemon: daemon)
+    monkeypatch.setattr(
+        config, 'read_unit_configuration',
+        lambda unitcommand: ({}, [{'web': {'command': 'start'}}]))
+
+    args = Namespace(
+        daemon=['tcp://a:2375', 'tcp://b:2375'], unitcommand='unit/start',
+        print_only=False, print_substitutions=False, jobs=2, host_jobs=2)
+    main_run(config, args)
+    assert sorted(runs) == [
+        ('tcp://a:2375', 2, str(tmpdir.join(
+            'journal', 'unit_start_tcp___a_2375.jsonl'))),
+        ('tcp://b:2375', 2, str(tmpdir.join(
+            'journal', 'unit_start_tcp___b_2375.jsonl'))),
+    ]
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+
+import pytest
+
+import docker_meta.container
+from docker_meta.container import DockerContainer
+from docker_meta.image_cache import ImageCache, parse_size
+from docker_meta.utils import FINGERPRINT_LABEL
+
+
+@pytest.mark.parametrize('size,expected', [
+    ('100', 100),
+    ('2k', 2048),
+    ('1.5 MB', 1536 * 1024),
+    ('10G', 10 * 1024 ** 3),
+    ('1TiB', 1024 ** 4),
+])
+def test_parse_size(size, expected):
+    assert parse_size(size) == expected
+
+
+def test_parse_size_invalid():
+    with pytest.raises(ValueError):
+        parse_size('ten')
+
+
+class CacheDocker(object):
+    """
+    a docker client stand-in with images in the ``registry``, that records
+    pulls, loads and tags.
+    """
+
+    base_url = 'cache'
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.local = {}
+        self.pulled = []
+        self.loaded = []
+        self.tagged = []
+
+    def images(self, name=None):
+        return [
+            {'Id': image['Id'], 'RepoTags': [tag],
+             'Labels': image.get('Labels')}
+            for tag, image in self.local.items()
+            if name in [None, tag.rpartition(':')[0]]]
+
+    def inspect_distribution(self, image):
+        if image not in self.registry:
+            raise RuntimeError('registry unreachable')
+        return {'Descriptor': {'digest': self.registry[image]['digest']}}
+
+    def pull(self, repository, tag, stream):
+        name = '{}:{}'.format(repository, tag)
+        self.pulled.append(name)
+        self.local[name] = self.registry[name]
+        return iter([json.dumps({'status': 'Downloaded'})])
+
+    def inspect_image(self, name):
+        image = self.local[name]
+        return {
+            'Id': image['Id'], 'RepoTags': [name],
+            'RepoDigests': ['{}@{}'.format(
+                name.rpartition(':')[0], image['digest'])],
+            'Config': {'Labels': image.get('Labels')}}
+
+    def get_image(self, name):
+        return io.BytesIO(b'tar of ' + self.local[name]['Id'])
+
+    def load_image(self, data):
+        self.loaded.append(data.read())
+
+    def tag(self, image, repository, tag, force=False):
+        self.tagged.append((image, '{}:{}'.format(repository, tag)))
+
+
+def _image(image_id):
+    return {'Id': image_id, 'digest': 'sha256:d' + image_id}
+
+
+def test_image_cache(tmpdir):
+    cache = ImageCache(str(tmpdir), 10 ** 6)
+    dc = CacheDocker({'busybox:latest': _image('b1')})
+    assert not cache.load(dc, 'busybox')
+
+    dc.local['busybox:latest'] = dc.registry['busybox:latest']
+    cache.save(dc, 'busybox')
+    assert tmpdir.join('b1.tar').read() == 'tar of b1'
+    assert cache.entries()['b1']['tags'] == ['busybox:latest']
+
+    # the same image is loaded, if the registry cannot be asked
+    assert cache.lookup('busybox') == 'b1'
+    dc = CacheDocker({})
+    assert cache.load(dc, 'busybox:latest')
+    assert dc.loaded == ['tar of b1']
+    assert dc.tagged == [('b1', 'busybox:latest')]
+
+    # but not if the registry has a newer image
+    dc = CacheDocker({'busybox:latest': _image('b2')})
+    assert not cache.load(dc, 'busybox')
+    dc = CacheDocker({'busybox:latest': _image('b1')})
+    assert cache.load(dc, 'busybox')
+
+
+def test_image_cache_gc(tmpdir):
+    cache = ImageCache(str(tmpdir), 30)
+    images = dict(
+        ('image{}:latest'.format(i), _image('i{}'.format(i)))
+        for i in range(4))
+    dc = CacheDocker(images)
+    dc.local = images
+    for i in range(3):
+        cache.save(dc, 'image{}'.format(i))
+    assert sorted(cache.entries()) == ['i0', 'i1', 'i2']
+
+    # using image0 makes image1 the least recently used one
+    assert cache.load(dc, 'image0')
+    cache.save(dc, 'image3')
+    assert sorted(cache.entries()) == ['i0', 'i2', 'i3']
+    assert not tmpdir.join('i1.tar').exists()
+
+    tmpdir.join('orphan.tar').write('')
+    assert cache.gc(20) == ['i2']
+    assert sorted(cache.entries()) == ['i0', 'i3']
+    assert sorted(f.basename for f in tmpdir.listdir()) == [
+        'i0.tar', 'i3.tar', 'index.json']
+
+
+def test_build_image_cache(tmpdir, monkeypatch):
+    cache = ImageCache(str(tmpdir), 10 ** 6)
+    monkeypatch.setattr(docker_meta.container, 'default_image_cache', cache)
+    registry = {'busybox:latest': _image('b1')}
+
+    dc = CacheDocker(registry)
+    container = DockerContainer(
+        dc, 'test', creation={'image': 'busybox'}, startup={}, build={})
+    container.build_image()
+    assert dc.pulled == ['busybox:latest']
+    assert sorted(cache.entries()) == ['b1']
+
+    # a wiped runner loads the image instead of pulling it
+    dc = CacheDocker(registry)
+    container = DockerContainer(
+        dc, 'test', creation={'image': 'busybox'}, startup={}, build={})
+    container.build_image()
+    assert dc.pulled == []
+    assert dc.loaded == ['tar of b1']
+
+
+def test_build_image_cache_tag(tmpdir, monkeypatch):
+    cache = ImageCache(str(tmpdir), 10 ** 6)
+    monkeypatch.setattr(docker_meta.container, 'default_image_cache', cache)
+    registry = {'postgres:9.6': _image('p1')}
+
+    dc = CacheDocker(registry)
+    container = DockerContainer(
+        dc, 'test', creation={'image': 'postgres:9.6'}, startup={}, build={})
+    container.build_image()
+    # the tag of the image is not followed by the default tag
+    assert dc.pulled == ['postgres:9.6']
+    assert cache.entries()['p1']['tags'] == ['postgres:9.6']
+
+
+def test_image_cache_fingerprint(tmpdir, monkeypatch):
+    cache = ImageCache(str(tmpdir.join('cache')), 10 ** 6)
+    monkeypatch.setattr(docker_meta.container, 'default_image_cache', cache)
+    tmpdir.join('context').ensure_dir().join('Dockerfile').write(
+        'FROM busybox\n')
+    container = DockerContainer(
+        None, 'test', creation={}, startup={},
+        build={'path': str(tmpdir.join('context')), 'tag': 'test/built'})
+    fingerprint = container.image_fingerprint()
+
+    dc = CacheDocker({})
+    dc.local['test/built:latest'] = dict(
+        _image('t1'), Labels={FINGERPRINT_LABEL: 'outdated'})
+    cache.save(dc, 'test/built')
+    assert not cache.load(dc, 'test/built', fingerprint)
+
+    dc.local['test/built:latest'] = dict(
+        _image('t2'), Labels={FINGERPRINT_LABEL: fingerprint})
+    cache.save(dc, 'test/built')
+    assert cache.load(dc, 'test/built', fingerprint)
+    assert dc.loaded == ['tar of t2']
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
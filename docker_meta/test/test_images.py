@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import pytest
+
+import docker_meta
+from docker_meta.container import (
+    _pull_container, run_configuration, DockerContainer)
+from docker_meta.fanout import current_host
+from docker_meta.images import Prefetcher, TransferLimits
+from docker_meta.state import DockerState
+
+
+def _run_transfers(limits, transfers):
+    """
+    runs the ``transfers`` concurrently and returns the maximal number of
+    concurrent transfers for every kind and daemon.
+    """
+    lock = threading.Lock()
+    running = {}
+    maximum = {}
+
+    def _transfer(kind, daemon, image):
+        with limits.transfer(kind, daemon, image):
+            with lock:
+                running[(kind, daemon)] = running.get((kind, daemon), 0) + 1
+                maximum[(kind, daemon)] = max(
+                    maximum.get((kind, daemon), 0), running[(kind, daemon)])
+            time.sleep(0.05)
+            with lock:
+                running[(kind, daemon)] -= 1
+
+    threads = [
+        threading.Thread(target=_transfer, args=args) for args in transfers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return maximum
+
+
+@pytest.mark.parametrize('builds,pulls', [(1, 2), (2, 3)])
+def test_transfer_limits(builds, pulls):
+    limits = TransferLimits(builds, pulls)
+    transfers = (
+        [('build', 'a', 'build{}'.format(i)) for i in range(4)] +
+        [('pull', 'a', 'pull{}'.format(i)) for i in range(4)] +
+        [('build', 'b', 'build{}'.format(i)) for i in range(4)])
+    maximum = _run_transfers(limits, transfers)
+    assert maximum == {
+        ('build', 'a'): builds, ('pull', 'a'): pulls, ('build', 'b'): builds}
+
+
+def test_same_image_is_serialized():
+    limits = TransferLimits(4, 4)
+    maximum = _run_transfers(limits, [('pull', 'a', 'busybox')] * 3)
+    assert maximum == {('pull', 'a'): 1}
+
+
+def test_configure():
+    limits = TransferLimits()
+    limits.configure(pulls=0)
+    assert (limits.builds, limits.pulls) == (2, 1)
+    maximum = _run_transfers(
+        limits, [('pull', 'a', 'pull{}'.format(i)) for i in range(3)])
+    assert maximum == {('pull', 'a'): 1}
+
+
+def test_prefetcher(monkeypatch):
+    fetched = []
+
+    def _fail():
+        raise RuntimeError('failed')
+
+    # the transfers are logged for the host of the run
+    monkeypatch.setattr(threading.current_thread(), 'host', 'web1', False)
+    prefetcher = Prefetcher()
+    prefetcher.start('a', lambda: fetched.append(('a', current_host())))
+    prefetcher.start('b', _fail)
+    prefetcher.join()
+    assert fetched == [('a', 'web1')]
+    assert prefetcher.images == ['a', 'b']
+
+
+class PrefetchDocker(object):
+    """
+    a docker client stand-in with a ``db`` container and the ``busybox`` image,
+    that records the pulled images.
+    """
+
+    base_url = 'prefetch'
+
+    def __init__(self):
+        self.pulled = []
+
+    def events(self, since=None, decode=None):
+        return iter([])
+
+    def containers(self, all=False):
+        return [{'Id': 'db_id', 'Names': ['/db'], 'State': 'exited'}]
+
+    def images(self):
+        return [{'Id': 'busybox_id', 'RepoTags': ['busybox:latest']}]
+
+    def pull(self, repository, tag, stream):
+        self.pulled.append('{}:{}'.format(repository, tag))
+        return iter(['{"status": "Downloaded newer image"}'])
+
+
+def test_prefetch_images(tmpdir, monkeypatch):
+    tmpdir.join('app').ensure_dir().join('Dockerfile').write(
+        'FROM python:2.7 AS builder\nFROM scratch\n')
+    tmpdir.join('child').ensure_dir().join('Dockerfile').write(
+        'FROM test/app\n')
+    configurations = {
+        'web': {'creation': {'image': 'nginx'}},
+        'proxy': {'creation': {'image': 'nginx', 'tag': 'latest'}},
+        'db': {'creation': {'image': 'postgres:9.6'}},
+        'app': {'build': {'path': str(tmpdir.join('app')), 'tag': 'test/app'}},
+        'child': {'build': {
+            'path': str(tmpdir.join('child')), 'tag': 'test/child'}},
+        'cache': {'creation': {'image': 'busybox'}},
+        'worker': {'creation': {'image': 'worker:1.0'}},
+    }
+    order_list = [
+        {name: {'command': 'start'}} for name in [
+            'app', 'child', 'web', 'proxy', 'db', 'cache']
+    ] + [{'worker': {'command': 'stop'}}]
+    executed = []
+    monkeypatch.setattr(
+        docker_meta.container, 'run_job',
+        lambda cmd, container, orders: executed.append(container.name))
+
+    dc = PrefetchDocker()
+    run_configuration(None, configurations, order_list, dc)
+    assert dc.pulled == []
+
+    run_configuration(
+        None, configurations, order_list, dc, prefetch=True)
+    assert sorted(dc.pulled) == ['nginx:latest', 'python:2.7']
+
+
+def test_prefetch_shares_transfers(monkeypatch):
+    transfers = []
+
+    class RecordingLimits(TransferLimits):
+
+        def transfer(self, kind, daemon, image):
+            transfers.append((kind, daemon, image))
+            return super(RecordingLimits, self).transfer(kind, daemon, image)
+
+    monkeypatch.setattr(
+        docker_meta.container, 'default_limits', RecordingLimits())
+    dc = PrefetchDocker()
+    state = DockerState(dc)
+    for creation in [{'image': 'nginx'}, {'image': 'nginx', 'tag': 'latest'},
+                     {'image': 'nginx:latest'}]:
+        container = DockerContainer(
+            dc, 'web', creation=creation, state=state)
+        container.build_image()
+    _pull_container(None, dc, state, 'nginx', 'latest').build_image()
+    # the orders and the prefetcher wait for the same image lock
+    assert set(transfers) == set([('pull', 'prefetch', 'nginx:latest')])
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import copy
+import os
+
+import pytest
+
+import docker_meta
+from docker_meta.configurations import Configuration
+from docker_meta.container import run_configuration
+from docker_meta.journal import Journal
+
+
+class JournalDocker(object):
+    """
+    a docker client stand-in with a running ``web`` and a created ``data``
+    container.
+    """
+
+    def __init__(self, web_state='running'):
+        self.web_state = web_state
+
+    def events(self, since=None, decode=None):
+        return iter([])
+
+    def containers(self, all=False):
+        return [
+            {'Id': 'web_id', 'Names': ['/web'], 'State': self.web_state},
+            {'Id': 'data_id', 'Names': ['/data'], 'State': 'created'}]
+
+    def images(self):
+        return []
+
+
+configurations = {
+    'data': {'creation': {'image': 'busybox'}},
+    'web': {'creation': {'image': 'nginx'}},
+}
+
+order_list = [
+    {'web': {'command': 'create'}},
+    {'web': {'command': 'start', 'timeout': 3}},
+    {'data': {'command': 'create'}},
+    {'host': {'command': 'execute', 'run': ['true']}},
+    {'data': {'command': 'start'}},
+]
+
+
+@pytest.fixture
+def run(tmpdir, monkeypatch):
+    config = Configuration(str(tmpdir))
+    executed = []
+    failing = []
+
+    def _run_job(cmd, container, orders):
+        if (container.name, cmd) in failing:
+            raise RuntimeError('failed')
+        executed.append((container.name, cmd))
+
+    monkeypatch.setattr(docker_meta.container, 'run_job', _run_job)
+
+    def _run(orders=order_list, resume=False, fail=[], dc=JournalDocker()):
+        del executed[:]
+        failing[:] = fail
+        journal = Journal.for_config(config, 'unit/start:v1', resume)
+        run_configuration(
+            config, configurations, copy.deepcopy(orders), dc,
+            'unit/start:v1', 1, None, journal)
+        return executed
+
+    _run.journal = str(tmpdir.join('journal').join('unit_start_v1.jsonl'))
+    return _run
+
+
+def test_resume(run):
+    with pytest.raises(RuntimeError):
+        run(fail=[('data', 'start')])
+    assert os.path.exists(run.journal)
+    with open(run.journal, 'r') as fh:
+        assert len(fh.readlines()) == 4
+
+    assert run(resume=True) == [('data', 'start')]
+    # the journal of a successful run is removed
+    assert not os.path.exists(run.journal)
+    assert len(run(resume=True)) == 5
+
+
+def test_resume_verifies_orders(run):
+    with pytest.raises(RuntimeError):
+        run(fail=[('data', 'start')])
+    # the first order on web is trusted, because the second one completed
+    assert run(resume=True, dc=JournalDocker('exited')) == [
+        ('web', 'start'), ('data', 'start')]
+
+
+def test_resume_changed_orders(run):
+    with pytest.raises(RuntimeError):
+        run(fail=[('host', 'execute')])
+    orders = copy.deepcopy(order_list)
+    orders[1]['web']['timeout'] = 5
+    assert run(orders, resume=True) == [
+        ('web', 'start'), ('host', 'execute'), ('data', 'start')]
+
+
+def test_resume_keeps_entries(run):
+    with pytest.raises(RuntimeError):
+        run(fail=[('data', 'start')])
+    # a resumed run, that fails early, keeps the entries of the failed run
+    with pytest.raises(RuntimeError):
+        run(resume=True, dc=JournalDocker('exited'), fail=[('web', 'start')])
+    # the entry of the failed order is invalidated
+    assert sorted(Journal(run.journal, True)._resumable) == [0, 2, 3]
+    assert run(resume=True) == [('web', 'start'), ('data', 'start')]
+
+
+def test_resume_without_journal(run):
+    with pytest.raises(RuntimeError):
+        run(fail=[('data', 'start')])
+    # without --resume all orders are executed again
+    assert len(run()) == 5
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
@@ -1,3 +1,4 @@
+import json
 import logging
 import sys
 from StringIO import StringIO
@@ -119,6 +120,32 @@ def test_output_filter_pull(v, expected):
         assert infos[0].endswith('(bc) a: {}'.format(repr({u"0": 40})))
 
 
+@pytest.mark.parametrize('v,expected', [
+    (0, []),
+    (1, ['Downloading: 0% of 1.0 KB', 'Downloading: 25% of 2.0 KB',
+         'Downloading: 50% of 2.0 KB', 'Downloading: 100% of 2.0 KB']),
+    (3, ['Downloading: 0% of 1.0 KB', 'Downloading: 0% of 2.0 KB',
+         'Downloading: 25% of 2.0 KB', 'Downloading: 50% of 2.0 KB',
+         'Downloading: 54% of 2.0 KB', 'Downloading: 100% of 2.0 KB']),
+    ], ids=['verbose={}'.format(i) for i in [0, 1, 3]])
+def test_output_filter_pull_progress(v, expected):
+    configure_logger(test=True, verbosity=v)
+    for name in ['first', 'second']:
+        dc = docker_meta.container.DockerContainer(
+            None, name, creation={'image': name})
+        for layer, current in [
+                ('l1', 0), ('l2', 0), ('l1', 512), ('l1', 1024), ('l2', 100),
+                ('l2', 1024)]:
+            dc._log_output(json.dumps({
+                'status': 'Downloading', 'id': layer,
+                'progressDetail': {'current': current, 'total': 1024}}),
+                'pull')
+    infos = [line.split(': ', 2)[-1] for line in last_info_line(None) if line]
+    assert infos == (
+        ['[first] ' + line for line in expected] +
+        ['[second] ' + line for line in expected])
+
+
 @pytest.mark.parametrize('v,expected', [
     (0, 1),
     (1, 2),
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+import json
+import socket
+import time
+
+import pytest
+
+import docker_meta.container
+from docker_meta.container import DockerContainer
+from docker_meta.package_caches import (
+    CACHES, dockerfile_args, find_caches, PackageCaches)
+
+
+def test_dockerfile_args(tmpdir):
+    tmpdir.join('Dockerfile').write(
+        'FROM debian\n'
+        'ARG PIP_INDEX_URL\n'
+        '  arg PIP_TRUSTED_HOST=localhost\n'
+        'RUN echo ARG NOT_AN_ARG\n')
+    assert dockerfile_args(str(tmpdir)) == set([
+        'PIP_INDEX_URL', 'PIP_TRUSTED_HOST'])
+    assert dockerfile_args(str(tmpdir.join('missing'))) == set([])
+
+
+def test_find_caches():
+    configurations = {
+        'apt-cacher-ng': {'build': {'tag': 'mdrohmann/apt-cacher-ng'}},
+        'pypi': {'creation': {'image': 'mdrohmann/pypicloud'}},
+        'data_pypi': {'build': {'tag': 'data/pypicloud-data'}},
+        'web': {'creation': {'image': 'nginx'}},
+    }
+    assert find_caches(configurations) == {
+        'apt-cacher-ng': ('apt', 3142),
+        'pypi': ('pypi', 3031),
+        'data_pypi': ('pypi', 3031),
+    }
+
+
+class CachesDocker(object):
+    """
+    a docker client stand-in with running cache containers, that fails builds
+    with the ``failing`` build arguments.
+    """
+
+    base_url = 'caches'
+
+    def __init__(self, running, failing=None):
+        self.running = running
+        self.failing = failing
+        self.builds = []
+
+    def inspect_container(self, name):
+        return {
+            'State': {'Running': name in self.running},
+            'NetworkSettings': {'IPAddress': '127.0.0.1'}}
+
+    def images(self, name=None):
+        return []
+
+    def build(self, **kwargs):
+        self.builds.append(kwargs.get('buildargs'))
+        if self.failing and self.failing in (kwargs.get('buildargs') or {}):
+            return [json.dumps({'error': 'Could not resolve host'})]
+        return [json.dumps({'stream': 'Successfully built'})]
+
+
+@pytest.fixture
+def caches(monkeypatch):
+    """
+    package caches with a listening apt cache and a pypi cache, that does not
+    accept connections.
+    """
+    listening = socket.socket()
+    listening.bind(('127.0.0.1', 0))
+    listening.listen(10)
+    closed = socket.socket()
+    closed.bind(('127.0.0.1', 0))
+    monkeypatch.setitem(CACHES, 'apt', dict(
+        CACHES['apt'], port=listening.getsockname()[1]))
+    monkeypatch.setitem(CACHES, 'pypi', dict(
+        CACHES['pypi'], port=closed.getsockname()[1]))
+    caches = PackageCaches()
+    caches.configure(True, {
+        'apt-cacher-ng': {'build': {'tag': 'mdrohmann/apt-cacher-ng'}},
+        'pypicloud': {'build': {'tag': 'mdrohmann/pypicloud'}},
+    })
+    yield caches
+    listening.close()
+    closed.close()
+
+
+def test_build_args(caches, monkeypatch):
+    now = [100.]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    apt = 'http://127.0.0.1:{}'.format(CACHES['apt']['port'])
+    assert caches.build_args(CachesDocker([])) == {}
+    # missing caches are only probed again after a while
+    assert caches.build_args(CachesDocker(['apt-cacher-ng'])) == {}
+    now[0] += caches.retry
+    assert caches.build_args(CachesDocker(['apt-cacher-ng'])) == {
+        'http_proxy': apt}
+    # available caches are remembered for every daemon
+    assert caches.build_args(CachesDocker([])) == {'http_proxy': apt}
+
+    caches.configure(True, caches.configurations)
+    dc = CachesDocker(['apt-cacher-ng', 'pypicloud'])
+    assert caches.build_args(dc) == {'http_proxy': apt}
+
+    # the pypi cache is used, if it accepts connections and is declared
+    caches.configure(True, caches.configurations)
+    port = CACHES['apt']['port']
+    monkeypatch.setitem(CACHES, 'pypi', dict(CACHES['pypi'], port=port))
+    assert caches.build_args(dc, ['PIP_INDEX_URL']) == {
+        'http_proxy': apt,
+        'PIP_INDEX_URL': 'http://127.0.0.1:{}/simple/'.format(port)}
+
+    caches.configure(False, caches.configurations)
+    assert caches.build_args(dc) == {}
+
+
+def test_build_args_remote(caches):
+    class RemoteDocker(CachesDocker):
+        base_url = 'http://docker.example.com:2375'
+
+    # the caches of remote daemons are used, as soon as they are running
+    dc = RemoteDocker(['apt-cacher-ng', 'pypicloud'])
+    port = CACHES['pypi']['port']
+    assert caches.build_args(dc, ['PIP_INDEX_URL']) == {
+        'http_proxy': 'http://127.0.0.1:{}'.format(CACHES['apt']['port']),
+        'PIP_INDEX_URL': 'http://127.0.0.1:{}/simple/'.format(port)}
+
+
+def test_build_fallback(tmpdir, monkeypatch, caches):
+    monkeypatch.setattr(
+        docker_meta.container, 'default_package_caches', caches)
+    tmpdir.join('Dockerfile').write('FROM debian\n')
+    dc = CachesDocker(['apt-cacher-ng'], failing='http_proxy')
+    container = DockerContainer(
+        dc, 'test', creation={}, startup={},
+        build={'path': str(tmpdir), 'tag': 'test',
+               'buildargs': {'VERSION': '1'}})
+    container.build_image()
+    apt = 'http://127.0.0.1:{}'.format(CACHES['apt']['port'])
+    assert dc.builds == [
+        {'http_proxy': apt, 'VERSION': '1'}, {'VERSION': '1'}]
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
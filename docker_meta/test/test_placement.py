@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+import BaseHTTPServer
+import json
+import threading
+
+import docker
+import pytest
+
+import docker_meta
+from docker_meta.container import run_configuration_placed
+from docker_meta.placement import (
+    container_groups, host_resources, place_containers, split_orders,
+    DEFAULT_MEMORY)
+
+
+GB = 1024 * 1024 * 1024
+
+
+@pytest.fixture
+def fake_daemons(request):
+    """
+    starts fake docker daemons, that answer the ``info`` requests with the
+    given memory and CPUs.
+    """
+
+    def _start(*infos):
+        daemons = []
+        for info in infos:
+
+            class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+                body = json.dumps(info)
+
+                def do_GET(self):
+                    if self.path.endswith('/info'):
+                        self.send_response(200)
+                        self.send_header('Content-Type', 'application/json')
+                        self.end_headers()
+                        self.wfile.write(self.body)
+                    else:
+                        self.send_response(404)
+                        self.end_headers()
+
+                def log_message(self, *args):
+                    pass
+
+            server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            request.addfinalizer(server.shutdown)
+            daemons.append(
+                'http://127.0.0.1:{}'.format(server.server_address[1]))
+        return daemons
+
+    return _start
+
+
+def test_host_resources(fake_daemons):
+    daemon, = fake_daemons(
+        {'MemTotal': 4 * GB, 'NCPU': 4, 'ContainersRunning': 2})
+    dc = docker.Client(daemon, version='1.24')
+    assert host_resources(dc) == {
+        'memory': 4 * GB - 2 * DEFAULT_MEMORY, 'cpus': 3.}
+
+
+configurations = {
+    'db': {'creation': {'image': 'postgres', 'mem_limit': '2g'}},
+    'data': {'creation': {'image': 'busybox'}},
+    'app': {'creation': {'image': 'app', 'cpu_shares': 2048},
+            'startup': {'links': [('db', 'database')],
+                        'volumes_from': ['data']}},
+    'cache': {'creation': {'image': 'redis', 'mem_limit': 512 * 1024 ** 2}},
+    'web': {'creation': {'image': 'nginx'},
+            'startup': {'links': {'cache': 'cache'}}},
+    'single': {'creation': {'image': 'busybox'}},
+}
+
+order_list = [
+    {'data': {'command': 'create'}},
+    {'db': {'command': 'start'}},
+    {'cache': {'command': 'start'}},
+    {'host': {'command': 'execute', 'run': ['true']}},
+    {'app': {'command': 'start'}},
+    {'web': {'command': 'start'}},
+    {'single': {'command': 'start'}},
+]
+
+
+def test_container_groups():
+    assert container_groups(configurations, order_list) == [
+        ['data', 'db', 'app'], ['cache', 'web'], ['single']]
+
+
+def test_place_containers():
+    resources = {
+        'a': {'memory': 3 * GB, 'cpus': 2},
+        'b': {'memory': 2 * GB, 'cpus': 4},
+    }
+    assert place_containers(configurations, order_list, resources) == {
+        'data': 'a', 'db': 'a', 'app': 'a',
+        'cache': 'b', 'web': 'b', 'single': 'b'}
+
+    with pytest.raises(ValueError):
+        place_containers(configurations, order_list, {})
+
+
+def test_split_orders():
+    placement = {
+        'data': 'a', 'db': 'a', 'app': 'a',
+        'cache': 'b', 'web': 'b', 'single': 'b'}
+    assert split_orders(order_list, placement) == [
+        {'a': order_list[:2], 'b': order_list[2:3]},
+        order_list[3:4],
+        {'a': order_list[4:5], 'b': order_list[5:]},
+    ]
+
+
+def test_run_configuration_placed(fake_daemons, monkeypatch):
+    daemons = fake_daemons(
+        {'MemTotal': 4 * GB, 'NCPU': 2}, {'MemTotal': 3 * GB, 'NCPU': 8})
+    hosts = [('a', daemons[0]), ('b', daemons[1])]
+    runs = []
+    lock = threading.Lock()
+
+    def _run_configuration(
+            global_config, configurations, order_list, dc, unitcommand,
+            jobs, timings):
+        with lock:
+            runs.append((
+                dc.base_url, jobs, [item.keys()[0] for item in order_list]))
+
+    monkeypatch.setattr(
+        docker_meta.container, 'run_configuration', _run_configuration)
+    monkeypatch.setattr(
+        docker_meta.container, 'get_docker_client',
+        lambda daemon: docker.Client(daemon, version='1.24'))
+
+    run_configuration_placed(
+        None, configurations, order_list, hosts, 'unit/start', 3)
+    assert sorted(runs[:2]) == sorted([
+        (daemons[0], 3, ['data', 'db']), (daemons[1], 3, ['cache'])])
+    assert runs[2] == (daemons[0], 1, ['host'])
+    assert sorted(runs[3:]) == sorted([
+        (daemons[0], 3, ['app']), (daemons[1], 3, ['web', 'single'])])
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
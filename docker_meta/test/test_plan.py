@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+from argparse import Namespace
+
+import pytest
+import yaml
+
+import docker_meta
+from docker_meta.configurations import Configuration
+from docker_meta.container import (
+    make_plan, main_run, main_plan, run_configuration)
+from docker_meta.plan import (
+    critical_path, format_plan, load_plan, save_plan, Timings)
+from docker_meta.utils import fingerprint
+
+
+class PlanDocker(object):
+    """
+    a docker client stand-in with a running ``web`` container and a
+    ``busybox`` image.
+    """
+
+    def containers(self, all=False):
+        return [{'Id': 'web_id', 'Names': ['/web'], 'State': 'running'}]
+
+    def images(self):
+        return [{'Id': 'busybox_id', 'RepoTags': ['busybox:latest']}]
+
+
+configurations = {
+    'data': {'creation': {'image': 'busybox', 'volumes': ['/data']}},
+    'web': {'creation': {'image': 'nginx'},
+            'startup': {'volumes_from': 'data'}},
+    'app': {'build': {'fileobj': None, 'tag': 'test/app'}},
+}
+
+
+def test_timings(tmpdir):
+    filename = str(tmpdir.join('timings.yaml'))
+    timings = Timings(filename)
+    assert timings.estimate('web', 'no-op') == 0.
+    assert timings.estimate('web', 'pull+create+start') == 33.
+    for seconds in range(10):
+        timings.record('web', 'start', seconds)
+    timings.save()
+
+    timings = Timings(filename)
+    assert timings.estimate('web', 'start') == 7.
+    assert timings.estimate('data', 'start') == 2.
+
+
+def test_make_plan(tmpdir):
+    timings = Timings(str(tmpdir.join('timings.yaml')))
+    timings.record('web', 'stop', 1.5)
+    order_list = [
+        {'data': {'command': 'create'}},
+        {'web': {'command': 'start'}},
+        {'web': {'command': 'stop'}},
+        {'web': {'command': 'stop'}},
+        {'data': {'command': 'start', 'wait': 3}},
+        {'web': {'command': 'remove', 'v': True}},
+        {'data': {'command': 'remove_image'}},
+        {'host': {'command': 'execute', 'run': ['true']}},
+    ]
+    plan = make_plan(
+        Configuration(str(tmpdir)), configurations, order_list,
+        PlanDocker(), 'unit/start', timings)
+
+    assert [
+        (a['container'], a['command'], a['action'], a['api_calls'])
+        for a in plan['actions']] == [
+        ('data', 'create', 'create', 1),
+        ('web', 'start', 'no-op', 0),
+        ('web', 'stop', 'stop', 1),
+        ('web', 'stop', 'no-op', 0),
+        ('data', 'start', 'start', 1),
+        ('web', 'remove', 'remove', 1),
+        ('data', 'remove_image', 'remove_image', 1),
+        ('host', 'execute', 'execute', 0),
+    ]
+    assert [a['estimate'] for a in plan['actions']] == [
+        1., 0., 1.5, 0., 5., 1., 1., 5.]
+    assert plan['api_calls'] == 7
+    assert plan['estimate'] == 14.5
+    assert plan['critical_path'] == 14.5
+    assert plan['unitcommand'] == 'unit/start'
+
+    output = format_plan(plan)
+    assert 'remove_image' in output.splitlines()[7]
+    assert output.splitlines()[-1] == (
+        '8 orders, 7 API calls, estimated time: 14.5s sequential, 14.5s '
+        'critical path')
+
+
+def test_make_plan_missing_images(tmpdir):
+    order_list = [
+        {'web': {'command': 'stop'}},
+        {'web': {'command': 'remove'}},
+        {'web': {'command': 'start', 'attach': True}},
+        {'app': {'command': 'build'}},
+        {'app': {'command': 'build'}},
+    ]
+    plan = make_plan(
+        Configuration(str(tmpdir)), configurations, order_list,
+        PlanDocker())
+    assert [(a['action'], a['api_calls']) for a in plan['actions']] == [
+        ('stop', 1),
+        ('remove', 2),
+        ('pull+create+start+attach', 6),
+        ('build', 1),
+        ('no-op', 0),
+    ]
+
+
+def test_run_fingerprints_when_ordered(tmpdir, monkeypatch):
+    tmpdir.join('app').ensure_dir().join('Dockerfile').write(
+        'FROM busybox\n')
+    bind = tmpdir.join('generated')
+    build_configurations = {
+        'app': {'build': {'path': str(tmpdir.join('app')), 'tag': 'busybox'}},
+        'web': {'creation': {'image': 'busybox'},
+                'startup': {'binds': {str(bind): '/data'}}},
+    }
+    monkeypatch.setattr(
+        docker_meta.container, 'context_digest',
+        lambda path, *args: open(path + '/Dockerfile').read())
+    fingerprints = []
+
+    def run_job(cmd, container, orders):
+        if cmd == 'execute':
+            # an execute order generates the bind path and the context
+            bind.ensure_dir()
+            tmpdir.join('app', 'Dockerfile').write('FROM alpine\n')
+        elif cmd == 'build':
+            fingerprints.append(container.image_fingerprint())
+
+    monkeypatch.setattr(docker_meta.container, 'run_job', run_job)
+
+    order_list = [
+        {'host': {'command': 'execute', 'shell': 'generate'}},
+        {'app': {'command': 'build'}},
+        {'web': {'command': 'create'}},
+    ]
+    config = Configuration(str(tmpdir))
+    plan = make_plan(
+        config, build_configurations, order_list, PlanDocker(), 'unit/start')
+    assert plan['actions'][2]['action'] == 'unknown'
+
+    timings = Timings(str(tmpdir.join('timings.yaml')))
+    run_configuration(
+        config, build_configurations, order_list, PlanDocker(),
+        'unit/start', 1, timings)
+    # the fingerprint is taken from the context rewritten by execute
+    expected = dict(build_configurations['app']['build'])
+    expected['context'] = 'FROM alpine\n'
+    assert fingerprints == [fingerprint(expected)]
+    assert 'unknown' not in timings._timings.get('web', {})
+
+
+def test_critical_path():
+    order_list = [
+        {'data': {'command': 'create'}},
+        {'app': {'command': 'build'}},
+        {'web': {'command': 'start'}},
+    ]
+    assert critical_path(order_list, configurations, [1., 10., 2.]) == 10.
+
+
+def test_save_load_plan(tmpdir):
+    filename = str(tmpdir.join('plan.yaml'))
+    plan = {
+        'unitcommand': 'unit/start',
+        'configurations': {'data': configurations['data']},
+        'order_list': [{'data': {'command': 'create'}}],
+        'actions': []}
+    save_plan(plan, filename)
+    assert load_plan(filename) == plan
+
+    tmpdir.join('invalid.yaml').write('unitcommand: unit/start')
+    with pytest.raises(ValueError) as e:
+        load_plan(str(tmpdir.join('invalid.yaml')))
+    assert 'does not contain a configurations entry' in str(e.value)
+
+
+def test_main_plan_and_run(tmpdir, monkeypatch, capsys):
+    config = Configuration(str(tmpdir))
+    config.initialize()
+    tmpdir.join('units').join('plan_test').join('start.yaml').ensure(
+        file=1).write(yaml.safe_dump_all([
+            {'web': configurations['web'], 'data': configurations['data']},
+            [{'data': {'command': 'create'}},
+             {'web': {'command': 'start'}}]]))
+    events = []
+    monkeypatch.setattr(
+        docker_meta.container, 'get_docker_client', lambda _: PlanDocker())
+    monkeypatch.setattr(
+        docker_meta.container, 'run_configuration',
+        lambda *args: events.append(list(args)))
+
+    filename = str(tmpdir.join('plan.yaml'))
+    args = Namespace(
+        daemon=None, unitcommand='plan_test/start', output=filename)
+    main_plan(config, args)
+    out, _ = capsys.readouterr()
+    assert 'estimated time' in out
+
+    plan = load_plan(filename)
+    args = Namespace(daemon=None, plan=filename, jobs=3)
+    main_run(config, args)
+    (_, run_configurations, order_list, _, unitcommand, jobs, timings,
+     journal, check, prefetch) = events.pop()
+    assert run_configurations == plan['configurations']
+    assert order_list == plan['order_list']
+    assert unitcommand == 'plan_test/start'
+    assert jobs == 3
+    assert timings.filename == str(tmpdir.join('timings.yaml'))
+    assert journal.filename == str(
+        tmpdir.join('journal').join('plan_test_start.jsonl'))
+    assert check and prefetch
+
+    args = Namespace(daemon=None, plan=None, unitcommand=None)
+    with pytest.raises(ValueError):
+        main_run(config, args)
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+import docker
+import pytest
+import requests
+
+import docker_meta
+from docker_meta.container import preflight, run_configuration
+from docker_meta.preflight import check_pullable, host_ports, PreflightError
+
+
+class PreflightDocker(object):
+    """
+    a docker client stand-in with a running ``proxy`` container publishing
+    port 80, the local image ``busybox`` and the image ``nginx`` in the
+    registry.
+    """
+
+    def __init__(self):
+        self.inspected = []
+
+    def events(self, since=None, decode=None):
+        return iter([])
+
+    def containers(self, all=False):
+        return [
+            {'Id': 'proxy_id', 'Names': ['/proxy'], 'State': 'running',
+             'Ports': [
+                 {'IP': '0.0.0.0', 'PrivatePort': 80, 'PublicPort': 80,
+                  'Type': 'tcp'}]},
+            {'Id': 'db_id', 'Names': ['/db'], 'State': 'exited'}]
+
+    def images(self):
+        return [{'Id': 'busybox_id', 'RepoTags': ['busybox:latest']}]
+
+    def inspect_distribution(self, image):
+        self.inspected.append(image)
+        if image != 'nginx:latest':
+            response = requests.Response()
+            response.status_code = 404
+            raise docker.errors.APIError(
+                'not found', response, 'manifest unknown')
+        return {'Descriptor': {}}
+
+
+@pytest.mark.parametrize('port_bindings,expected', [
+    (None, []),
+    ({80: 8080}, [('', 8080, 'tcp')]),
+    ({'53/udp': ('127.0.0.1', 53)}, [('127.0.0.1', 53, 'udp')]),
+    ({'80/tcp': [8080, ('::', '8081')]},
+     [('', 8080, 'tcp'), ('::', 8081, 'tcp')]),
+    ({80: None, 81: ('127.0.0.1',)}, []),
+])
+def test_host_ports(port_bindings, expected):
+    assert sorted(host_ports(port_bindings)) == sorted(expected)
+
+
+def test_preflight(tmpdir):
+    configurations = {
+        'web': {
+            'creation': {'image': 'nginx', 'volumes_from': ['data']},
+            'startup': {
+                'links': [('cache', 'cache')],
+                'port_bindings': {80: ('127.0.0.1', 80)},
+                'binds': {str(tmpdir.join('missing')): '/srv'}}},
+        'data': {
+            'creation': {'image': 'unknown'},
+            'startup': {'binds': {str(tmpdir): '/data'}}},
+        'app': {
+            'build': {'path': str(tmpdir.join('app')), 'tag': 'app'},
+            'startup': {'links': ['db'], 'port_bindings': {8080: 8080}}},
+        'admin': {
+            'creation': {'image': 'busybox'},
+            'startup': {'port_bindings': {'8080/tcp': 8080}}},
+        'proxy': {
+            'creation': {'image': 'nginx'},
+            'startup': {'port_bindings': {80: 80}}},
+    }
+    order_list = [
+        {'web': {'command': 'start'}},
+        {'data': {'command': 'create'}},
+        {'app': {'command': 'start'}},
+        {'admin': {'command': 'start'}},
+        {'proxy': {'command': 'start'}},
+    ]
+    dc = PreflightDocker()
+    with pytest.raises(PreflightError) as e:
+        preflight(None, configurations, order_list, dc)
+    assert e.value.problems == [
+        'The path {} to bind to, does not exist, maybe you started in the '
+        'wrong directory?'.format(tmpdir.join('missing')),
+        'The image unknown:latest cannot be pulled: manifest unknown',
+        'The build context {} of the image app for container app does not '
+        'contain a Dockerfile'.format(tmpdir.join('app')),
+        'The port 8080/tcp of the container app is already published by the '
+        'container admin',
+    ]
+    assert sorted(dc.inspected) == ['unknown:latest']
+    assert '4 problem(s)' in str(e.value)
+
+    tmpdir.join('missing').ensure_dir()
+    dc = PreflightDocker()
+    with pytest.raises(PreflightError) as e:
+        preflight(None, configurations, order_list, dc)
+    assert e.value.problems == [
+        'The container web refers to the container cache, that neither '
+        'exists nor is created',
+        'The container web refers to the container data, that is only '
+        'created afterwards',
+        'The image unknown:latest cannot be pulled: manifest unknown',
+        'The build context {} of the image app for container app does not '
+        'contain a Dockerfile'.format(tmpdir.join('app')),
+        'The port 8080/tcp of the container app is already published by the '
+        'container admin',
+        'The port 80/tcp of the container web is already published by the '
+        'running container proxy',
+    ]
+    assert sorted(dc.inspected) == ['nginx:latest', 'unknown:latest']
+    # the bind paths of the configurations are not substituted in place
+    assert configurations['web']['startup']['binds'] == {
+        str(tmpdir.join('missing')): '/srv'}
+
+
+class DistributionDocker(object):
+    """
+    a docker client stand-in, whose distribution endpoint fails with
+    ``status``.
+    """
+
+    def __init__(self, status, explanation):
+        self.status = status
+        self.explanation = explanation
+
+    def inspect_distribution(self, image):
+        response = requests.Response()
+        response.status_code = self.status
+        raise docker.errors.APIError('failed', response, self.explanation)
+
+
+@pytest.mark.parametrize('status,explanation,expected', [
+    (404, 'manifest unknown',
+     'The image private:latest cannot be pulled: manifest unknown'),
+    (404, '404 page not found', None),
+    (401, 'unauthorized: authentication required', None),
+    (403, 'denied: requested access to the resource is denied', None),
+    (500, 'Get https://registry/v2/: net/http: timeout', None),
+])
+def test_check_pullable(status, explanation, expected):
+    dc = DistributionDocker(status, explanation)
+    assert check_pullable(dc, 'private:latest') == expected
+
+
+def test_preflight_after_execute(tmpdir):
+    configurations = {
+        'web': {
+            'creation': {'image': 'nginx'},
+            'startup': {'binds': {str(tmpdir.join('generated')): '/srv'}}},
+        'other': {
+            'creation': {'image': 'unknown'},
+            'startup': {'binds': {str(tmpdir.join('generated')): '/srv'}}},
+    }
+    order_list = [
+        {'host': {'command': 'execute', 'run': ['generate']}},
+        {'web': {'command': 'start'}},
+        {'other': {'command': 'start'}},
+    ]
+    # the execute order may create the bind paths, the image is checked
+    with pytest.raises(PreflightError) as e:
+        preflight(None, configurations, order_list, PreflightDocker())
+    assert e.value.problems == [
+        'The image unknown:latest cannot be pulled: manifest unknown']
+
+    with pytest.raises(PreflightError) as e:
+        preflight(None, configurations, order_list[1:], PreflightDocker())
+    assert e.value.problems == [
+        'The path {} to bind to, does not exist, maybe you started in the '
+        'wrong directory?'.format(tmpdir.join('generated'))]
+
+
+def test_run_configuration_check(monkeypatch):
+    executed = []
+    monkeypatch.setattr(
+        docker_meta.container, 'run_job',
+        lambda cmd, container, orders: executed.append(container.name))
+    configurations = {
+        'web': {'creation': {'image': 'nginx'}, 'startup': {}},
+        'other': {'creation': {'image': 'other'}, 'startup': {}},
+    }
+    order_list = [
+        {'web': {'command': 'start'}}, {'other': {'command': 'start'}}]
+
+    with pytest.raises(PreflightError):
+        run_configuration(
+            None, configurations, order_list, PreflightDocker(), check=True)
+    assert executed == []
+
+    run_configuration(None, configurations, order_list, PreflightDocker())
+    assert executed == ['web', 'other']
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+import BaseHTTPServer
+import socket
+import threading
+
+import pytest
+
+from docker_meta.container import DockerContainer, run_job
+from docker_meta.probes import (
+    published_address, wait_until_ready, make_probes, HTTPProbe)
+
+
+class ProbeDocker(object):
+    base_url = 'http://dockerhost:2375'
+
+    def __init__(self, logs=[], health=None):
+        self._logs = logs
+        self._health = health
+
+    def inspect_container(self, name):
+        state = {'Running': True}
+        if self._health:
+            state['Health'] = {'Status': self._health}
+        return {
+            'State': state,
+            'NetworkSettings': {
+                'IPAddress': '172.17.0.5',
+                'Ports': {'443/tcp': [{'HostPort': '32768'}]},
+            }
+        }
+
+    def logs(self, name, **kwargs):
+        for line in self._logs:
+            yield line
+
+
+@pytest.mark.parametrize('bindings,port,expected', [
+    ({80: 8080, 22: 2222}, None, ('dockerhost', 2222)),
+    ({80: 8080}, 80, ('dockerhost', 8080)),
+    ({'80/tcp': ('127.0.0.1', 8080)}, None, ('127.0.0.1', 8080)),
+    ({80: [('0.0.0.0', 8080)]}, '80/tcp', ('dockerhost', 8080)),
+    ({443: None}, None, ('dockerhost', 32768)),
+    ({80: 8080}, 5432, ('172.17.0.5', 5432)),
+])
+def test_published_address(bindings, port, expected):
+    container = DockerContainer(
+        ProbeDocker(), 'test', startup={'port_bindings': bindings})
+    assert published_address(container, port) == expected
+
+
+def test_published_address_needs_port():
+    container = DockerContainer(ProbeDocker(), 'test')
+    with pytest.raises(ValueError) as e:
+        published_address(container)
+    assert 'Cannot guess a port' in str(e.value)
+
+
+def test_make_probes_fail():
+    container = DockerContainer(ProbeDocker(), 'test')
+    with pytest.raises(ValueError) as e:
+        make_probes(container, {'timeout': 3})
+    assert 'needs at least one of the probes' in str(e.value)
+
+
+@pytest.fixture
+def http_server(request):
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            self.send_response(self.path == '/ok' and 200 or 503)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    request.addfinalizer(server.shutdown)
+    return server.server_address[1]
+
+
+def _local_container(port):
+    return DockerContainer(
+        ProbeDocker(), 'test',
+        startup={'port_bindings': {80: ('127.0.0.1', port)}})
+
+
+def test_tcp_probe(http_server):
+    wait_until_ready(
+        _local_container(http_server),
+        {'tcp': True, 'timeout': 1, 'interval': 0.01})
+
+
+def test_tcp_probe_timeout():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    with pytest.raises(RuntimeError) as e:
+        wait_until_ready(
+            _local_container(port),
+            {'tcp': 80, 'timeout': 0.05, 'interval': 0.01})
+    assert 'did not become ready within 0.05 seconds' in str(e.value)
+    assert 'tcp port' in str(e.value)
+
+
+@pytest.mark.parametrize('path,status,ready', [
+    ('/ok', 200, True),
+    ('/fail', 200, False),
+    ('/fail', 503, True),
+])
+def test_http_probe(http_server, path, status, ready):
+    probe = HTTPProbe(
+        _local_container(http_server), {'path': path, 'status': status})
+    assert probe(1) == ready
+    assert probe.url() == 'http://127.0.0.1:{}{}'.format(http_server, path)
+
+
+def test_log_probe():
+    container = DockerContainer(
+        ProbeDocker(logs=['starting\n', 'listening on port 80\n']), 'test')
+    wait_until_ready(
+        container, {'log': 'listening on port \d+', 'timeout': 1})
+
+    container = DockerContainer(ProbeDocker(logs=['starting\n']), 'test')
+    with pytest.raises(RuntimeError):
+        wait_until_ready(
+            container, {'log': {'pattern': 'listening'}, 'timeout': 0.05,
+                        'interval': 0.01})
+
+
+class StreamResponse(object):
+    """
+    a streamed response of the docker daemon, that blocks on a socket.
+    """
+
+    def __init__(self):
+        self.sock, self.peer = socket.socketpair()
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+        self.peer.close()
+
+
+class StreamDocker(ProbeDocker):
+    """
+    a docker client stand-in, whose logs never end.
+    """
+
+    def __init__(self):
+        super(StreamDocker, self).__init__()
+        self.responses = []
+
+    def _url(self, path, *args):
+        return path.format(*args)
+
+    def _get(self, url, params=None, stream=False):
+        self.responses.append(StreamResponse())
+        self.responses[-1].peer.sendall('starting\n')
+        return self.responses[-1]
+
+    def _get_result(self, container, stream, response):
+        return iter(response.sock.makefile().readline, '')
+
+    def _get_raw_response_socket(self, response):
+        return response.sock
+
+
+def test_log_probe_closes_stream():
+    dc = StreamDocker()
+    container = DockerContainer(dc, 'test')
+    threads = threading.active_count()
+    with pytest.raises(RuntimeError):
+        wait_until_ready(
+            container, {'log': 'listening', 'timeout': 0.05,
+                        'interval': 0.01})
+    # the thread following the logs ended and closed its connection
+    assert threading.active_count() == threads
+    assert [r.closed for r in dc.responses] == [True]
+
+
+@pytest.mark.parametrize('health,expected', [
+    ('healthy', None),
+    ('starting', 'did not become ready'),
+    (None, 'has no healthcheck'),
+])
+def test_health_probe(health, expected):
+    container = DockerContainer(ProbeDocker(health=health), 'test')
+    ready = {'health': True, 'timeout': 0.05, 'interval': 0.01}
+    if expected:
+        with pytest.raises(RuntimeError) as e:
+            wait_until_ready(container, ready)
+        assert expected in str(e.value)
+    else:
+        wait_until_ready(container, ready)
+
+
+def test_run_job_waits_until_ready(monkeypatch):
+    events = []
+    monkeypatch.setattr(
+        DockerContainer, 'start', lambda *args: events.append('start'))
+    monkeypatch.setattr(
+        'docker_meta.container.wait_until_ready',
+        lambda container, ready: events.append(ready))
+    container = DockerContainer(None, 'test')
+    run_job('start', container, {'command': 'start', 'ready': {'tcp': 80}})
+    assert events == ['start', {'tcp': 80}]
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import pytest
+
+from docker_meta.scheduler import (
+    build_order_graph, container_dependencies, OrderScheduler)
+
+
+configurations = {
+    'data': {'creation': {'volumes': ['/data']}},
+    'db': {'startup': {'volumes_from': 'data'}},
+    'web': {'startup': {'links': {'db': 'database'}}},
+    'cache': {'creation': {'image': 'redis'}},
+    'proxy': {'startup': {'links': [('cache', 'cache')]}},
+}
+
+
+@pytest.mark.parametrize('config,expected', [
+    ({}, set([])),
+    ('invalid', set([])),
+    ({'startup': {'links': {'db': 'database'}}}, set(['db'])),
+    ({'startup': {'links': ['db:database', 'cache']}}, set(['db', 'cache'])),
+    ({'startup': {'links': [('db', 'database')]}}, set(['db'])),
+    ({'startup': {'volumes_from': 'data:ro'}}, set(['data'])),
+    ({'creation': {'volumes_from': ['data', 'more']}},
+     set(['data', 'more'])),
+])
+def test_container_dependencies(config, expected):
+    assert container_dependencies(config) == expected
+
+
+def test_build_order_graph():
+    order_list = [
+        {'data': {'command': 'create'}},
+        {'cache': {'command': 'start'}},
+        {'db': {'command': 'start'}},
+        {'web': {'command': 'start'}},
+        {'proxy': {'command': 'start'}},
+        {'host': {'command': 'execute', 'run': ['true']}},
+        {'cache': {'command': 'stop'}},
+        {'db': {'command': 'stop'}},
+    ]
+    graph = build_order_graph(order_list, configurations)
+    assert graph == [
+        set([]),
+        set([]),
+        set([0]),
+        set([2]),
+        set([1]),
+        set([0, 1, 2, 3, 4]),
+        set([1, 4, 5]),
+        set([0, 2, 3, 5]),
+    ]
+
+
+def test_wait_is_a_barrier():
+    order_list = [
+        {'cache': {'command': 'start', 'wait': 5}},
+        {'data': {'command': 'create'}},
+    ]
+    assert build_order_graph(order_list, configurations) == [
+        set([]), set([0])]
+
+
+def test_image_orders_are_independent():
+    order_list = [
+        {'data': {'command': 'build'}},
+        {'db': {'command': 'build'}},
+        {'db': {'command': 'build'}},
+        {'db': {'command': 'start'}},
+        {'web': {'command': 'build'}},
+    ]
+    assert build_order_graph(order_list, configurations) == [
+        set([]), set([]), set([1]), set([0, 1, 2]), set([3])]
+
+
+def test_image_orders_on_built_images():
+    image_configurations = {
+        'base': {'build': {'tag': 'test/base'}},
+        'app': {'build': {'tag': 'test/app'}},
+        'user': {'creation': {'image': 'test/base', 'tag': 'latest'}},
+        'other': {'creation': {'image': 'busybox'}},
+    }
+    order_list = [
+        {'base': {'command': 'build'}},
+        {'app': {'command': 'build'}},
+        {'user': {'command': 'build'}},
+        {'other': {'command': 'build'}},
+    ]
+    # app builds on base, and user pulls the image, that base builds
+    assert build_order_graph(
+        order_list, image_configurations,
+        {'app': ['test/base:latest'], 'base': ['busybox:latest']}) == [
+        set([]), set([0]), set([0]), set([])]
+
+
+def test_start_orders_on_built_images():
+    image_configurations = {
+        'base': {'build': {'tag': 'test/base'}},
+        'app': {'build': {'tag': 'test/app'}},
+        'user': {'creation': {'image': 'test/base'}},
+    }
+    order_list = [
+        {'base': {'command': 'build'}},
+        {'user': {'command': 'create'}},
+        {'app': {'command': 'start'}},
+    ]
+    # user pulls the image, that base builds, and app builds on it
+    assert build_order_graph(
+        order_list, image_configurations, {'app': ['test/base:latest']}) == [
+        set([]), set([0]), set([0])]
+
+
+def test_image_orders_on_implicit_builds():
+    image_configurations = {
+        'base': {'build': {'tag': 'test/base'}},
+        'app': {'build': {'tag': 'test/app'}},
+        'user': {'creation': {'image': 'test/base'}},
+    }
+    order_list = [
+        {'base': {'command': 'start'}},
+        {'app': {'command': 'build'}},
+        {'user': {'command': 'start'}},
+    ]
+    # starting base builds its image, if it is missing
+    assert build_order_graph(
+        order_list, image_configurations, {'app': ['test/base:latest']}) == [
+        set([]), set([0]), set([0])]
+
+
+def test_backup_orders_are_independent():
+    order_list = [
+        {'data': {'command': 'backup'}},
+        {'db': {'command': 'backup'}},
+        {'db': {'command': 'restore'}},
+        {'web': {'command': 'backup'}},
+    ]
+    assert build_order_graph(order_list, configurations) == [
+        set([]), set([]), set([0, 1]), set([2])]
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_scheduler_respects_dependencies(workers):
+    order_list = [
+        {'data': {'command': 'create'}},
+        {'cache': {'command': 'start'}},
+        {'db': {'command': 'start'}},
+        {'web': {'command': 'start'}},
+        {'proxy': {'command': 'start'}},
+    ]
+    finished = []
+    lock = threading.Lock()
+
+    def job(item):
+        name = item.keys()[0]
+        time.sleep(0.01)
+        with lock:
+            finished.append(name)
+
+    OrderScheduler(order_list, configurations, workers).run(job)
+
+    assert sorted(finished) == sorted(
+        [item.keys()[0] for item in order_list])
+    for before, after in [('data', 'db'), ('db', 'web'), ('cache', 'proxy')]:
+        assert finished.index(before) < finished.index(after)
+    if workers == 1:
+        assert finished == [item.keys()[0] for item in order_list]
+
+
+def test_scheduler_runs_concurrently():
+    order_list = [
+        {'c{}'.format(i): {'command': 'start'}} for i in range(4)]
+    active = []
+    peak = []
+    lock = threading.Lock()
+
+    def job(item):
+        with lock:
+            active.append(item)
+            peak.append(len(active))
+        time.sleep(0.05)
+        with lock:
+            active.remove(item)
+
+    OrderScheduler(order_list, {}, 2).run(job)
+    assert max(peak) == 2
+
+
+def test_scheduler_stops_after_failure():
+    order_list = [
+        {'data': {'command': 'create'}},
+        {'db': {'command': 'start'}},
+        {'web': {'command': 'start'}},
+    ]
+    called = []
+
+    def job(item):
+        name = item.keys()[0]
+        called.append(name)
+        if name == 'data':
+            raise ValueError('failed {}'.format(name))
+
+    with pytest.raises(ValueError) as e:
+        OrderScheduler(order_list, configurations, 4).run(job)
+    assert 'failed data' in str(e.value)
+    assert called == ['data']
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
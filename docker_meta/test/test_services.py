@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+import threading
+
+import pytest
+
+from docker_meta.configurations import Configuration
+from docker_meta.container import (
+    _service_container, build_services, plan_services)
+from docker_meta.services import (
+    build_waves, collect_services, dockerfile_parents, normalize_image,
+    service_graph)
+from docker_meta.utils import FINGERPRINT_LABEL
+
+
+@pytest.mark.parametrize('image,expected', [
+    ('busybox', 'busybox:latest'),
+    ('busybox:1.0', 'busybox:1.0'),
+    ('localhost:5000/busybox', 'localhost:5000/busybox:latest'),
+    ('busybox@sha256:abc', 'busybox@sha256:abc'),
+])
+def test_normalize_image(image, expected):
+    assert normalize_image(image) == expected
+
+
+def test_dockerfile_parents(tmpdir):
+    tmpdir.join('Dockerfile').write(
+        '# FROM commented\n'
+        'FROM golang:1.7 AS builder\n'
+        'RUN make\n'
+        'from --platform=linux/amd64 debian:latest\n'
+        'COPY --from=builder /app /app\n'
+        'FROM builder\n')
+    assert dockerfile_parents(str(tmpdir)) == ['golang:1.7', 'debian:latest']
+
+
+@pytest.fixture
+def services_config(tmpdir):
+    """
+    a configuration directory with the images
+
+      - ``base``, tagged by ``services/tags.yaml``,
+      - ``child`` and ``other`` building on ``base``,
+      - ``grandchild`` building on ``child``, tagged by a unit, and
+      - ``data/volume``, which is tagged with its path.
+    """
+    services = tmpdir.join('services')
+    for path, content in [
+            ('base', 'FROM debian\n'),
+            ('python/child', 'FROM test/base:latest\n'),
+            ('python/other', 'FROM test/base\n'),
+            ('grandchild', 'FROM test/child\n')]:
+        services.join(path).ensure_dir().join('Dockerfile').write(content)
+    tmpdir.join('data', 'volume').ensure_dir().join('Dockerfile').write(
+        'FROM busybox\n')
+    services.join('tags.yaml').write(
+        'base: test/base\n'
+        'python/child: test/child\n'
+        'python/other: test/other\n')
+    tmpdir.join('units', 'grand').ensure_dir().join('start.yaml').write(
+        'grandchild:\n'
+        '    build:\n'
+        '        path: services/grandchild\n'
+        '        tag: test/grandchild\n'
+        '---\n'
+        '- grandchild: {command: start}\n')
+    return Configuration(str(tmpdir))
+
+
+def test_service_graph(services_config):
+    services = collect_services(services_config)
+    assert sorted(services) == [
+        'data/volume', 'test/base', 'test/child', 'test/grandchild',
+        'test/other']
+    graph = service_graph(services)
+    assert graph == {
+        'data/volume': set([]),
+        'test/base': set([]),
+        'test/child': set(['test/base']),
+        'test/other': set(['test/base']),
+        'test/grandchild': set(['test/child']),
+    }
+    assert build_waves(graph) == [
+        ['data/volume', 'test/base'],
+        ['test/child', 'test/other'],
+        ['test/grandchild']]
+
+
+def test_build_waves_cycle():
+    with pytest.raises(RuntimeError) as e:
+        build_waves({'a': set([]), 'b': set(['c']), 'c': set(['b'])})
+    assert 'b, c build on each other in a cycle' in str(e.value)
+
+
+class ServicesDocker(object):
+    """
+    records the builds and returns images with fingerprint labels.
+    """
+
+    base_url = 'fake'
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.built = []
+        self._lock = threading.Lock()
+
+    def containers(self, all=False):
+        return []
+
+    def images(self):
+        return [
+            {'Id': tag, 'RepoTags': [tag + ':latest'],
+             'Labels': {FINGERPRINT_LABEL: fp}}
+            for tag, fp in self.labels.items()]
+
+    def build(self, **kwargs):
+        with self._lock:
+            self.built.append(kwargs['tag'])
+        return []
+
+
+@pytest.mark.parametrize('outdated,expected', [
+    ([], set([])),
+    (['test/child'], set(['test/child', 'test/grandchild'])),
+    (['test/base'], set([
+        'test/base', 'test/child', 'test/other', 'test/grandchild'])),
+    (['data/volume', 'test/grandchild'],
+     set(['data/volume', 'test/grandchild'])),
+])
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_build_services(services_config, outdated, expected, jobs):
+    services = collect_services(services_config)
+    graph = service_graph(services)
+    labels = {}
+    for tag in services:
+        container = _service_container(
+            services_config, services, tag, None, None)
+        labels[tag] = 'outdated' if tag in outdated else (
+            container.image_fingerprint())
+
+    dc = ServicesDocker(labels)
+    assert plan_services(services_config, services, graph, dc) == expected
+    assert build_services(
+        services_config, services, graph, dc, jobs) == expected
+    assert set(dc.built) == expected
+    # every image is built after the images it builds on
+    for tag in dc.built:
+        for parent in graph[tag] & expected:
+            assert dc.built.index(parent) < dc.built.index(tag)
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
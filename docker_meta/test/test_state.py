@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from docker_meta.container import DockerContainer
+from docker_meta.state import DockerState
+
+
+class CountingDocker(object):
+    """
+    a docker client stand-in, that counts the calls to the daemon.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self._containers = [
+            {'Id': 'id1', 'Names': ['/running'], 'State': 'running',
+             'Status': 'Up 2 hours'},
+            {'Id': 'id2', 'Names': ['/stopped'], 'Status': 'Exited (0)'},
+        ]
+        self._images = [
+            {'Id': 'img1', 'RepoTags': ['busybox:latest']},
+            {'Id': 'img2', 'RepoTags': ['test/image:1.0', 'test/image:2.0']},
+            {'Id': 'img3', 'RepoTags': ['registry:5000/test/image:1.0']},
+        ]
+
+    def containers(self, all=False):
+        self.calls.append('containers')
+        return [dict(c) for c in self._containers]
+
+    def images(self):
+        self.calls.append('images')
+        return self._images
+
+    def stop(self, container, timeout):
+        self.calls.append(('stop', container['Id']))
+
+    def create_container(self, **kwargs):
+        self.calls.append('create_container')
+        return {'Id': 'new_id', 'Warnings': None}
+
+    def start(self, container, **kwargs):
+        self.calls.append(('start', container['Id']))
+
+    def remove_container(self, container, v):
+        self.calls.append(('remove_container', container['Id']))
+
+
+def test_state_lookups():
+    dc = CountingDocker()
+    state = DockerState(dc)
+    assert state.get_container('running')['Id'] == 'id1'
+    assert state.get_container('stopped')['Id'] == 'id2'
+    assert state.get_container('run') == {}
+    assert state.is_running('running')
+    assert not state.is_running('stopped')
+    assert not state.is_running('nonexistent')
+    assert state.get_image('busybox')['Id'] == 'img1'
+    assert state.get_image('busybox:latest')['Id'] == 'img1'
+    assert state.get_image('test/image:2.0')['Id'] == 'img2'
+    assert state.get_image('test/image')['Id'] == 'img2'
+    assert state.get_image('test/image:3.0') == {}
+    assert state.get_image('test') == {}
+    assert state.get_image('registry:5000/test/image')['Id'] == 'img3'
+    assert state.get_image('registry:5000/test/image:1.0')['Id'] == 'img3'
+    assert state.get_image('registry:5000/test/image:2.0') == {}
+    assert dc.calls == ['containers', 'images']
+
+    state.invalidate()
+    state.get_container('running')
+    assert dc.calls == ['containers', 'images', 'containers']
+
+
+def test_state_updates():
+    dc = CountingDocker()
+    state = DockerState(dc)
+    state.refresh()
+    state.container_created('new', 'new_id', 'busybox')
+    assert state.get_container('new')['Id'] == 'new_id'
+    assert not state.is_running('new')
+    state.container_started('new')
+    assert state.is_running('new')
+    state.container_stopped('new')
+    assert not state.is_running('new')
+    state.container_removed('new')
+    assert state.get_container('new') == {}
+    assert dc.calls == ['containers', 'images']
+
+    state.images_changed()
+    state.get_image('busybox')
+    assert dc.calls == ['containers', 'images', 'images']
+
+
+@pytest.mark.parametrize('name,expected_calls', [
+    ('running', ['containers', ('stop', 'id1')]),
+    ('stopped', ['containers']),
+    ('nonexistent', ['containers']),
+])
+def test_container_stop_with_state(name, expected_calls):
+    dc = CountingDocker()
+    container = DockerContainer(dc, name, state=DockerState(dc))
+    container.stop()
+    assert dc.calls == expected_calls
+    assert not container.is_started()
+
+
+def test_container_lifecycle_with_state():
+    dc = CountingDocker()
+    state = DockerState(dc)
+    container = DockerContainer(
+        dc, 'new', creation={'image': 'busybox'}, state=state)
+    container.start()
+    assert str(container) == 'new_id'
+    assert container.is_started()
+    container.remove(v=True)
+    assert str(container) == 'No id yet'
+    assert dc.calls == [
+        'containers', 'create_container', ('start', 'new_id'),
+        ('stop', 'new_id'), ('remove_container', 'new_id')]
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
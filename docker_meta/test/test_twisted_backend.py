@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+import json
+import struct
+
+import pytest
+
+pytest_twisted = pytest.importorskip('pytest_twisted')
+
+from twisted.internet import defer, reactor  # noqa: E402
+from twisted.web import resource, server  # noqa: E402
+
+from docker_meta.configurations import Configuration  # noqa: E402
+from docker_meta.twisted_backend import (  # noqa: E402
+    run_configuration_async, run_orders, APIError, TwistedDockerClient)
+
+
+class FakeDaemon(resource.Resource):
+    """
+    a fake docker daemon, that knows a ``busybox`` image and the containers
+    created by the requests.
+    """
+
+    isLeaf = True
+
+    def __init__(self):
+        self.requests = []
+        self.containers = {}
+        self.images = [{'Id': 'busybox_id', 'RepoTags': ['busybox:latest']}]
+
+    def _json(self, request, obj, code=200):
+        request.setResponseCode(code)
+        request.setHeader('Content-Type', 'application/json')
+        return json.dumps(obj)
+
+    def render(self, request):
+        method = request.method
+        parts = request.path.split('/')[2:]
+        path = '/' + '/'.join(parts)
+        self.requests.append((method, path))
+        if path == '/containers/json':
+            return self._json(request, self.containers.values())
+        elif path == '/images/json':
+            return self._json(request, self.images)
+        elif path == '/images/create':
+            image = request.args['fromImage'][0]
+            self.images.append({
+                'Id': image + '_id', 'RepoTags': [image + ':latest']})
+            return '{"status": "Pulling"}\n{"status": "Downloaded"}\n'
+        elif path == '/containers/create':
+            name = request.args['name'][0]
+            config = json.loads(request.content.read())
+            if not any(config['Image'] in i['RepoTags'] or
+                       config['Image'] + ':latest' in i['RepoTags']
+                       for i in self.images):
+                return self._json(
+                    request, {'message': 'No such image'}, 404)
+            self.containers[name + '_id'] = {
+                'Id': name + '_id', 'Names': ['/' + name],
+                'State': 'created', 'Labels': config.get('Labels')}
+            return self._json(request, {'Id': name + '_id'}, 201)
+        elif method == 'DELETE' and parts[0] == 'images':
+            self.images = [i for i in self.images if i['Id'] != parts[1]]
+            return self._json(request, [{'Deleted': parts[1]}])
+        container = self.containers.get(parts[1])
+        if container is None:
+            return self._json(
+                request, {'message': 'No such container'}, 404)
+        action = parts[2] if len(parts) > 2 else None
+        if action in ['start', 'restart']:
+            container['State'] = 'running'
+            request.setResponseCode(204)
+            return ''
+        elif action == 'stop':
+            container['State'] = 'exited'
+            request.setResponseCode(204)
+            return ''
+        elif action == 'wait':
+            container['State'] = 'exited'
+            return self._json(request, {'StatusCode': 0})
+        elif action == 'logs':
+            return ''.join(
+                struct.pack('>BxxxL', stream, len(line)) + line
+                for stream, line in [(1, 'hello\n'), (2, 'wor'),
+                                     (2, 'ld\n')])
+        elif method == 'DELETE':
+            del self.containers[parts[1]]
+            request.setResponseCode(204)
+            return ''
+        return self._json(request, {'message': 'Not found'}, 404)
+
+
+@pytest.fixture
+def fake_daemon(request, tmpdir):
+    daemon = FakeDaemon()
+    socket = str(tmpdir.join('docker.sock'))
+    port = reactor.listenUNIX(socket, server.Site(daemon))
+    request.addfinalizer(lambda: pytest_twisted.blockon(port.stopListening()))
+    daemon.client = TwistedDockerClient('unix://' + socket, '1.24')
+    return daemon
+
+
+@pytest_twisted.inlineCallbacks
+def test_run_orders():
+    configurations = {'web': {'startup': {'links': {'db': 'db'}}}}
+    order_list = [
+        {'db': {'command': 'start'}},
+        {'cache': {'command': 'start'}},
+        {'web': {'command': 'start'}},
+        {'other': {'command': 'start'}},
+    ]
+    pending = {}
+    events = []
+
+    def _job(item):
+        name = item.keys()[0]
+        events.append(name)
+        pending[name] = defer.Deferred()
+        return pending[name]
+
+    d = run_orders(order_list, configurations, _job, concurrency=2)
+    assert events == ['db', 'cache']
+    pending['cache'].callback(None)
+    assert events == ['db', 'cache', 'other']
+    pending['db'].callback(None)
+    pending['other'].callback(None)
+    assert events == ['db', 'cache', 'other', 'web']
+    assert not d.called
+    pending['web'].callback(None)
+    yield d
+
+    events[:] = []
+    d = run_orders(order_list, configurations, _job)
+    pending['db'].errback(RuntimeError('db failed'))
+    pending['cache'].callback(None)
+    pending['other'].callback(None)
+    # web is never started
+    assert events == ['db', 'cache', 'other']
+    with pytest.raises(RuntimeError) as e:
+        yield d
+    assert 'db failed' in str(e.value)
+
+
+@pytest_twisted.inlineCallbacks
+def test_client(fake_daemon):
+    client = fake_daemon.client
+    res = yield client.create_container('busybox', name='test')
+    assert res == {'Id': 'test_id'}
+    yield client.start(res)
+    lines = []
+    yield client.logs(res, lines.append)
+    assert lines == ['hello', 'world']
+    exitcode = yield client.wait(res)
+    assert exitcode == 0
+    with pytest.raises(APIError) as e:
+        yield client.create_container('nginx', name='web')
+    assert e.value.code == 404
+    assert 'No such image' in str(e.value)
+
+
+@pytest_twisted.inlineCallbacks
+def test_run_configuration_async(fake_daemon, tmpdir):
+    configurations = {
+        'data': {'creation': {'image': 'busybox', 'volumes': ['/data']},
+                 'startup': {}},
+        'web': {'creation': {'image': 'nginx'}, 'startup': {}},
+        'job': {'creation': {'image': 'busybox'}, 'startup': {}},
+    }
+    order_list = [
+        {'data': {'command': 'create'}},
+        {'web': {'command': 'start'}},
+        {'job': {'command': 'start', 'attach': True}},
+        {'web': {'command': 'start'}},
+        {'web': {'command': 'remove', 'v': True}},
+    ]
+    yield run_configuration_async(
+        Configuration(str(tmpdir)), configurations, order_list,
+        fake_daemon.client, concurrency=10)
+
+    assert sorted(fake_daemon.containers) == ['data_id', 'job_id']
+    assert fake_daemon.containers['job_id']['State'] == 'exited'
+    requests = fake_daemon.requests
+    assert requests[:2] == [
+        ('GET', '/containers/json'), ('GET', '/images/json')]
+    # the image of web is pulled, before web is created
+    assert requests.index(('POST', '/images/create')) < requests.index(
+        ('POST', '/containers/web_id/start'))
+    # the second start of web is skipped
+    assert requests.count(('POST', '/containers/web_id/start')) == 1
+    assert ('POST', '/containers/web_id/restart') not in requests
+    assert ('DELETE', '/containers/web_id') in requests
+
+
+@pytest_twisted.inlineCallbacks
+def test_remove_image_async(fake_daemon, tmpdir):
+    configurations = {
+        'data': {'creation': {'image': 'busybox'}, 'startup': {}}}
+    order_list = [
+        {'data': {'command': 'remove_image'}},
+        {'data': {'command': 'create'}},
+    ]
+    # without a synchronous client, the images are reloaded by the twisted
+    # client after the removal
+    yield run_configuration_async(
+        Configuration(str(tmpdir)), configurations, order_list,
+        fake_daemon.client)
+    requests = fake_daemon.requests
+    assert requests.count(('GET', '/images/json')) == 2
+    assert requests.index(('DELETE', '/images/busybox_id')) < requests.index(
+        ('POST', '/images/create'))
+    assert 'data_id' in fake_daemon.containers
+
+
+# vim:set ft=python sw=4 et spell spelllang=en:
@@ -13,6 +13,13 @@ def test_deepupdate():
     assert utils.deepupdate(init, update) == expect
 
 
+def test_fingerprint():
+    fp = utils.fingerprint({'a': 1, 'b': [1, 2]}, None)
+    assert fp == utils.fingerprint({'b': [1, 2], 'a': 1}, None)
+    assert fp != utils.fingerprint({'a': 1, 'b': [2, 1]}, None)
+    assert fp != utils.fingerprint({'a': 1, 'b': [1, 2]}, 'image')
+
+
 def test_recursive_walk(tmpdir):
 
     tmpdir.chdir()